@@ -0,0 +1,364 @@
+"""
+Benchmarks for Pypond. Run from the parent folder of the package with:
+    python -m pypond.PondBenchmark
+The process exits with status 1 when a measurement goes over its budget, or
+when a hot path is slower or uses more memory than the stored baseline.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+from .PondCore import DurationInterface
+from .PondFile import PondDoc
+from .PondMusic import PondMelody, PondFragment, PondTuplet, PondNote, PondChord, PondPitch
+from .PondParser import PondParser
+from .PondScore import PondScore, PondStaff
+from .PondSnapshot import PondSnapshot
+
+
+MEMORY_BUDGET = {"plain note": 280,
+                 "note with marks": 700,
+                 "chord": 480,
+                 }
+
+
+def plain_note(idx):
+    return PondNote(idx % 24, "8")
+
+
+def marked_note(idx):
+    note = PondNote(idx % 24, "8", articulation="-.")
+    note.trill_marks(pitched=idx % 12 + 1)
+    return note
+
+
+def chord(idx):
+    return PondChord([PondPitch(idx % 12), PondPitch(idx % 12 + 4), PondPitch(idx % 12 + 7)])
+
+
+MEMORY_CASES = {"plain note": plain_note,
+                "note with marks": marked_note,
+                "chord": chord,
+                }
+
+
+def bytes_per_object(factory, count=10000):
+    objects = [None] * count
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for idx in range(count):
+            objects[idx] = factory(idx)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count
+
+
+def memory_report(count=10000):
+    return {name: bytes_per_object(factory, count) for name, factory in MEMORY_CASES.items()}
+
+
+def check_memory(report):
+    return [name for name, value in report.items() if value > MEMORY_BUDGET[name]]
+
+
+def parse_throughput(count=100000):
+    durations = ("4", "8", "16", "2.", "8.")
+    notes = [PondNote(idx % 49 - 24, durations[idx % 5], articulation="-." if idx % 3 else "",
+                      tie=idx % 10 == 0) for idx in range(count)]
+    text = str(PondMelody(notes))
+    start = time.perf_counter()
+    melody = PondParser.parse(text)
+    elapsed = time.perf_counter() - start
+    assert str(melody) == text, "Parsed melody does not render back to its source"
+    return count / elapsed
+
+
+SIZES = {"1k": 1000,
+         "100k": 100000,
+         "1M": 1000000,
+         }
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+SYNTHETIC_DURATIONS = ("8", "8", "4", "16", "16", "8.", "16", "4")
+
+
+def synthetic_melody(count):
+    """
+    Deterministic melody of count notes, grouped in fragments of eight notes,
+    with a tuplet every sixteenth group and some chords and articulations.
+    """
+    fragments = []
+    for start in range(0, count, 8):
+        size = min(8, count - start)
+        if (start // 8) % 16 == 15 and size >= 3:
+            notes = [PondNote((start + idx) % 36 - 12, "8") for idx in range(3)]
+            fragments.append(PondTuplet(3, 2, 8, notes))
+            start, size = start + 3, size - 3
+        notes = []
+        for idx in range(start, start + size):
+            duration = SYNTHETIC_DURATIONS[idx % 8]
+            if idx % 29 == 0:
+                notes.append(PondChord([PondPitch(idx % 12), PondPitch(idx % 12 + 4)], duration))
+            else:
+                notes.append(PondNote(idx % 36 - 12, duration,
+                                      articulation="-." if idx % 5 == 0 else ""))
+        fragments.append(PondFragment(notes))
+    return PondMelody(fragments)
+
+
+def clear_caches(melody):
+    melody.invalidate()
+    for fragment in melody.fragments:
+        if isinstance(fragment, PondMelody):
+            clear_caches(fragment)
+        else:
+            fragment._cache = None
+
+
+def build_score(melody):
+    staff = PondStaff()
+    staff.add_voice(melody)
+    score = PondScore()
+    score.add_staff(staff)
+    return score
+
+
+def run_as_string(melody):
+    melody.as_string()
+
+
+def run_ordered_notes(melody):
+    melody.ordered_notes()
+
+
+def run_transpose(melody):
+    melody.transpose(1)
+
+
+def run_real_duration(melody):
+    return melody.real_duration
+
+
+def run_duration_list(melody):
+    get_duration_list = DurationInterface.get_duration_list
+    for idx in range(len(melody.fragments) * 8):
+        get_duration_list(idx % 48 / 4 + 0.125)
+
+
+def run_score(melody):
+    build_score(melody).as_string()
+
+
+def run_create_file(melody):
+    document = PondDoc()
+    document.score = build_score(melody)
+    document.create_file()
+
+
+# Each hot path is run on a melody whose caches were cleared first.
+HOT_PATHS = {"as_string": run_as_string,
+             "ordered_notes": run_ordered_notes,
+             "transpose": run_transpose,
+             "real_duration": run_real_duration,
+             "get_duration_list": run_duration_list,
+             "score": run_score,
+             "create_file": run_create_file,
+             }
+
+
+def measure(run, melody, repeat=3):
+    seconds = None
+    for _ in range(repeat):
+        clear_caches(melody)
+        start = time.perf_counter()
+        run(melody)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    clear_caches(melody)
+    tracemalloc.start()
+    try:
+        run(melody)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak}
+
+
+def reference_workload(count=200000):
+    """
+    Plain Python work like the hot paths do, with no Pypond code: building
+    small objects, looking them up and joining strings.
+    """
+    names = {idx: f"n{idx % 24}" for idx in range(24)}
+    items = [(names[idx % 24], str(1 << idx % 4)) for idx in range(count)]
+    return "".join(f"{name}{duration} " for name, duration in items)
+
+
+def calibrate(repeat=3):
+    """
+    Returns the fastest time of reference_workload. Hot path times are compared
+    with the baseline relative to it, so the speed of the machine cancels out.
+    """
+    seconds = None
+    for _ in range(repeat):
+        _, elapsed = timed(reference_workload)
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    return seconds
+
+
+def hot_path_report(sizes=("1k", "100k"), repeat=3):
+    report = {}
+    for size in sizes:
+        melody = synthetic_melody(SIZES[size])
+        report[size] = {name: measure(run, melody, repeat) for name, run in HOT_PATHS.items()}
+    return report
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def snapshot_report(count=100000):
+    """
+    Compares PondSnapshot with pickle on a synthetic melody: bytes, seconds to
+    write, seconds to read everything back, and seconds to open the data and read
+    one fragment from the middle.
+    """
+    melody = synthetic_melody(count)
+    text = str(melody)
+    report = {}
+    for name, dumps, loads, load_one in (
+            ("pickle", pickle.dumps, pickle.loads,
+             lambda data: pickle.loads(data).fragments[len(melody.fragments) // 2]),
+            ("snapshot", PondSnapshot.dumps, PondSnapshot.loads,
+             lambda data: PondSnapshot(data).root[len(melody.fragments) // 2].materialize())):
+        data, dump_seconds = timed(dumps, melody)
+        loaded, load_seconds = timed(loads, data)
+        assert str(loaded) == text, f"{name} does not round trip"
+        fragment, fragment_seconds = timed(load_one, data)
+        assert str(fragment) == str(melody.fragments[len(melody.fragments) // 2])
+        report[name] = {"bytes": len(data), "dump": dump_seconds, "load": load_seconds,
+                        "one fragment": fragment_seconds}
+    return report
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rt') as file:
+        return json.load(file)
+
+
+def save_baseline(report, calibration, path=BASELINE_PATH):
+    baseline = load_baseline(path)
+    baseline.update(report)
+    baseline["calibration"] = calibration
+    with open(path, 'wt') as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def missing_baseline(report, baseline):
+    """
+    Returns (size, hot path) for every measurement the baseline has no entry for,
+    which check_baseline cannot compare.
+    """
+    return [(size, name) for size, results in report.items() for name in results
+            if name not in baseline.get(size, {})]
+
+
+def check_baseline(report, baseline, calibration, tolerance=0.25, min_seconds=0.005,
+                   min_bytes=65536):
+    """
+    Returns (size, hot path, measure, expected value) for every measurement more
+    than tolerance over the baseline. Baseline seconds are first scaled by
+    calibration over the calibration stored with them, so a faster or slower
+    machine does not show up as a change. Differences under min_seconds or
+    min_bytes are noise.
+    """
+    scale = calibration / baseline.get("calibration", calibration)
+    regressions = []
+    for size, results in report.items():
+        for name, result in results.items():
+            expected = baseline.get(size, {}).get(name)
+            if expected is None:
+                continue
+            for key, floor, factor in (("seconds", min_seconds, scale),
+                                       ("peak_bytes", min_bytes, 1)):
+                limit = expected[key] * factor
+                if result[key] - limit > max(limit * tolerance, floor):
+                    regressions.append((size, name, key, limit))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pypond benchmarks")
+    parser.add_argument("--count", type=int, default=10000,
+                        help="objects created per memory measurement")
+    parser.add_argument("--parse-notes", type=int, default=100000,
+                        help="notes parsed by the parser measurement")
+    parser.add_argument("--snapshot-notes", type=int, default=100000,
+                        help="notes in the snapshot and pickle comparison")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=["1k", "100k"],
+                        help="synthetic melody sizes for the hot path measurements")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per hot path; the fastest one is reported")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="JSON file with the baseline results")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown or memory growth over the baseline")
+    args = parser.parse_args(argv)
+
+    report = memory_report(args.count)
+    for name, value in report.items():
+        print(f"{name:<20}{value:>10.1f} bytes  (budget {MEMORY_BUDGET[name]})")
+    failed = check_memory(report)
+    for name in failed:
+        print(f"Memory regression: {name} uses {report[name]:.1f} bytes, "
+              f"budget is {MEMORY_BUDGET[name]}")
+    print(f"{'parser':<20}{parse_throughput(args.parse_notes):>10.0f} notes/s")
+    for name, result in snapshot_report(args.snapshot_notes).items():
+        print(f"{name:<20}{result['bytes'] / 1024:>10.0f} KiB  dump {result['dump'] * 1000:.0f} ms"
+              f"  load {result['load'] * 1000:.0f} ms"
+              f"  one fragment {result['one fragment'] * 1000:.1f} ms")
+
+    calibration = calibrate(args.repeat)
+    report = hot_path_report(args.sizes, args.repeat)
+    baseline = load_baseline(args.baseline)
+    scale = calibration / baseline.get("calibration", calibration)
+    print(f"{'calibration':<26}{calibration * 1000:>10.1f} ms"
+          f"  (baseline times scaled by {scale:.2f})")
+    for size, results in report.items():
+        for name, result in results.items():
+            expected = baseline.get(size, {}).get(name)
+            compared = ""
+            if expected:
+                compared = f"  (baseline {expected['seconds'] * scale * 1000:.1f} ms)"
+            print(f"{size:<6}{name:<20}{result['seconds'] * 1000:>10.1f} ms"
+                  f"{result['peak_bytes'] / 1024:>12.0f} KiB peak{compared}")
+    regressions = check_baseline(report, baseline, calibration, args.tolerance)
+    for size, name, key, expected in regressions:
+        print(f"Regression: {name} on {size} notes, {key} is {report[size][name][key]:.4g}, "
+              f"baseline is {expected:.4g}")
+    missing = missing_baseline(report, baseline)
+    if args.save_baseline:
+        save_baseline(report, calibration, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+        regressions = missing = []
+    for size, name in missing:
+        print(f"No baseline: {name} on {size} notes cannot be checked, "
+              f"record one with --save-baseline")
+    return 1 if failed or regressions or missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,10 @@
 from abc import ABC, abstractmethod
+from fractions import Fraction
 
 
 class PondObject(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def as_string(self):
         return ""
@@ -9,6 +12,128 @@ class PondObject(ABC):
     def __str__(self):
         return self.as_string()
 
+    def iter_chunks(self):
+        yield self.as_string()
+
+    def write_to(self, fp):
+        for chunk in self.iter_chunks():
+            fp.write(chunk)
+
+
+def chunks_of(value):
+    if isinstance(value, PondObject):
+        return value.iter_chunks()
+    return (str(value),)
+
+
+class PondNode(PondObject, ABC):
+    """
+    PondObject that memoizes its rendered string. Setting any public attribute,
+    or calling invalidate() after an in-place change, marks the node and all of
+    its parents as dirty, so only the changed path is rendered again.
+    Attributes listed in timing_attributes also invalidate cached durations.
+    """
+    __slots__ = ('_cache', '_parents')
+    timing_attributes = frozenset()
+
+    def __init__(self):
+        object.__setattr__(self, '_cache', None)
+        object.__setattr__(self, '_parents', [])
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != "_":
+            timing = name in self.timing_attributes
+            if timing or self._cache is not None or self._parents:
+                self.invalidate(timing)
+
+    def attach(self, parent):
+        self._parents.append(parent)
+
+    def detach(self, parent):
+        self._parents.remove(parent)
+
+    def invalidate(self, timing=True):
+        """
+        Clears the node and its ancestors without recursion. A parent is only
+        cached while its children are, so the climb stops at ancestors that had
+        nothing to clear, and an ancestor reached through several paths is only
+        visited once.
+        """
+        if not self.clear_cache(timing) and not timing:
+            return
+        stack = list(self._parents)
+        visited = set()
+        while stack:
+            node = stack.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            if node.clear_cache(timing):
+                stack.extend(node._parents)
+
+    def clear_cache(self, timing=True):
+        """Clears the caches of this node only, and returns whether it had any."""
+        cached = self._cache is not None
+        self._cache = None
+        return cached
+
+    @classmethod
+    def slot_names(cls):
+        names = cls.__dict__.get('_slot_names')
+        if names is None:
+            names = []
+            for klass in cls.__mro__:
+                for name in getattr(klass, '__slots__', ()):
+                    if name.startswith('__') and not name.endswith('__'):
+                        name = f"_{klass.__name__.lstrip('_')}{name}"
+                    names.append(name)
+            names = tuple(names)
+            cls._slot_names = names
+        return names
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for name in self.slot_names():
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def __copy__(self):
+        node = object.__new__(type(self))
+        node.__setstate__(self.__getstate__())
+        node._cache = None
+        node._parents = []
+        return node
+
+    @abstractmethod
+    def render_string(self):
+        return ""
+
+    def render_chunks(self, stream=False):
+        yield self.render_string()
+
+    def as_string(self):
+        string = self._cache
+        if string is None:
+            string = self.render_string()
+            set_cache(self, string)
+        return string
+
+    def iter_chunks(self):
+        if self._cache is not None:
+            yield self._cache
+        else:
+            yield from self.render_chunks(stream=True)
+
+
+# Sets PondNode._cache without going through PondNode.__setattr__.
+set_cache = PondNode._cache.__set__
+
 
 class CustomFunction(PondObject):
     def __init__(self, name, effect):
@@ -20,66 +145,97 @@ class CustomFunction(PondObject):
 
 
 class DurationInterface:
-    simple_converter = {0.125: "32",
-                        0.25: "16",
-                        0.5: "8",
-                        1: "4",
-                        2: "2",
-                        4: "1",
+    """
+    Durations are exact: real durations are Fractions of a quarter note, and
+    get_duration_list reads from tables precomputed in ticks (one tick being a
+    demisemiquaver) up to max_table_duration quarter notes.
+    """
+    ticks_per_quarter = 8
+    max_table_duration = 64
+    simple_converter = {Fraction(1, 8): "32",
+                        Fraction(1, 4): "16",
+                        Fraction(1, 2): "8",
+                        Fraction(1): "4",
+                        Fraction(2): "2",
+                        Fraction(4): "1",
                         }
-    dotted_converter = {0.125: "32",
-                        0.25: "16",
-                        0.375: "16.",
-                        0.5: "8",
-                        0.75: "8.",
-                        1: "4",
-                        1.5: "4.",
-                        2: "2",
-                        3: "2.",
-                        4: "1",
-                        6: "1."
+    dotted_converter = {Fraction(1, 8): "32",
+                        Fraction(1, 4): "16",
+                        Fraction(3, 8): "16.",
+                        Fraction(1, 2): "8",
+                        Fraction(3, 4): "8.",
+                        Fraction(1): "4",
+                        Fraction(3, 2): "4.",
+                        Fraction(2): "2",
+                        Fraction(3): "2.",
+                        Fraction(4): "1",
+                        Fraction(6): "1."
                         }
 
     reverse_dotted_converter = {value: key for key, value in dotted_converter.items()}
+    __decomposition_tables = {}
 
     @classmethod
-    def get_duration_list(cls, duration, simple=False, start=0, max_duration=6):
-        if duration % 0.125:
+    def set_table_size(cls, max_duration):
+        cls.max_table_duration = max_duration
+        cls.__decomposition_tables.clear()
+
+    @classmethod
+    def to_ticks(cls, duration):
+        ticks = Fraction(duration) * cls.ticks_per_quarter
+        if ticks.denominator != 1:
             raise ValueError(f"DurationConverter currently only accepts "
                              f"values up to the semiquaver. Attempted value: {duration}")
+        return int(ticks)
+
+    @classmethod
+    def __decomposition_table(cls, simple, max_duration):
+        key = (simple, max_duration)
+        if key not in cls.__decomposition_tables:
+            converter = cls.simple_converter if simple else cls.dotted_converter
+            max_ticks = cls.to_ticks(max_duration)
+            values = sorted((cls.to_ticks(value), string) for value, string in converter.items()
+                            if cls.to_ticks(value) <= max_ticks)
+            table = [()]
+            for ticks in range(1, cls.to_ticks(cls.max_table_duration) + 1):
+                value, string = max(item for item in values if item[0] <= ticks)
+                table.append((string,) + table[ticks - value])
+            cls.__decomposition_tables[key] = (table, values[-1])
+        return cls.__decomposition_tables[key]
+
+    @classmethod
+    def get_duration_list(cls, duration, simple=False, start=0, max_duration=6):
+        current_ticks = cls.to_ticks(duration) - cls.to_ticks(start)
         duration_list = []
-        current_value = duration - start
-        next_value = 0
-        converter = cls.simple_converter if simple else cls.dotted_converter
         if start:
             duration_list.append(cls.dotted_converter[start])
-        while current_value > 0:
-            if current_value > max_duration:
-                current_value -= max_duration
-                duration_list.append(converter[max_duration])
-            elif current_value in converter:
-                duration_list.append(converter[current_value])
-                current_value = next_value
-                next_value = 0
-            else:
-                current_value -= 0.125
-                next_value += 0.125
+        table, (max_ticks, max_string) = cls.__decomposition_table(simple, max_duration)
+        if current_ticks >= len(table):
+            chunks = (current_ticks - len(table)) // max_ticks + 1
+            duration_list.extend([max_string] * chunks)
+            current_ticks -= chunks * max_ticks
+        if current_ticks > 0:
+            duration_list.extend(table[current_ticks])
         return duration_list
 
     @classmethod
     def get_fragment_duration(cls, fragment):
         """
-        Warning: does not provide correct duration of tuplets
+        Duration of the contents of a fragment, as written. Nested tuplets
+        are scaled exactly.
         """
-        mapped = map(lambda x: cls.get_real_duration(x.duration), fragment.ordered_notes())
-        return sum(mapped)
+        fragments = getattr(fragment, 'fragments', None)
+        if fragments is None:
+            return fragment.real_duration
+        return sum((element.real_duration for element in fragments), Fraction(0))
 
     @classmethod
-    def get_remainig_tuplet_time(cls, tuplet):
+    def get_remainig_tuplet_time(cls, tuplet, total_duration=None):
         target, base_value, duration = tuplet.data
         pond_duration = int(base_value) * int(duration)
         base_duration = cls.get_real_duration(pond_duration)
-        total_duration = cls.get_fragment_duration(tuplet)
+        if total_duration is None:
+            total_duration = cls.get_fragment_duration(tuplet)
         remaining_beats = target - ((total_duration / base_duration) % target)
         if remaining_beats == target:
             remaining_beats = 0
@@ -88,8 +244,8 @@ class DurationInterface:
     @classmethod
     def get_pond_duration(cls, duration):
         try:
-            return cls.dotted_converter[float(duration)]
-        except KeyError:
+            return cls.dotted_converter[Fraction(duration)]
+        except (KeyError, ValueError, TypeError):
             raise ValueError(f"DurationConverter currently only accepts "
                              f"values up to the semiquaver. Attempted value: {duration}")
 
@@ -102,8 +258,8 @@ class DurationInterface:
                              f"Attempted value: {duration}")
 
     @classmethod
-    def is_complete_tuplet(cls, tuplet):
-        remaining, base = cls.get_remainig_tuplet_time(tuplet)
+    def is_complete_tuplet(cls, tuplet, total_duration=None):
+        remaining, base = cls.get_remainig_tuplet_time(tuplet, total_duration)
         if remaining != 0:
             return False
         return True
@@ -1,13 +1,72 @@
+import asyncio
+import glob
+import hashlib
+import itertools
+import math
 import os
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import weakref
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from .PondCore import PondObject, CustomFunction, chunks_of
+from .PondMusic import (PondMelody, PondColumnMelody, melody_substitutions, subtree_digests,
+                        walk, NOTE)
+from .PondParser import PondParser
+from .PondScore import PondScore, PondStaff, PondTimeSignature, PondBarSplitter
+
+
+RenderResult = namedtuple("RenderResult", ["source", "output", "returncode", "log"])
+RenderData = namedtuple("RenderData", ["pages", "returncode", "log"])
+job_ids = itertools.count(1)
+COMMAND_NOT_FOUND = 127
+TIMED_OUT = 124
+
+
+def run_lilypond(arguments, timeout=None, cwd=None):
+    """
+    Runs LilyPond and returns its exit code and log. A missing executable is
+    reported with the shell's exit code 127, and a run that takes longer than
+    timeout seconds is killed and reported with the exit code 124 of timeout(1)
+    and the log written so far, instead of raising.
+    """
+    try:
+        completed = subprocess.run(arguments, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, timeout=timeout, cwd=cwd)
+    except FileNotFoundError as error:
+        return COMMAND_NOT_FOUND, f"error: cannot run {arguments[0]}: {error.strerror}\n"
+    except subprocess.TimeoutExpired as error:
+        log = error.output or ""
+        if isinstance(log, bytes):
+            log = log.decode(errors="replace")
+        if log and not log.endswith("\n"):
+            log += "\n"
+        return TIMED_OUT, f"{log}error: {arguments[0]} timed out after {timeout} seconds\n"
+    return completed.returncode, completed.stdout
 
 
 class PondDoc:
+    """
+    With deduplicate set, every melody that appears more than once in the score
+    and renders to at least min_repeat_bytes characters is written once as a
+    variable, and each occurrence is replaced by a reference to it.
+    """
     def __init__(self):
         self.__header = str()
         self.__paper = str()
         self.__layout = str()
         self.__score = str()
         self.__functions = []
+        self.deduplicate = False
+        self.min_repeat_bytes = 64
+        self.variable_prefix = "pypond"
 
     @property
     def header(self):
@@ -35,11 +94,11 @@ class PondDoc:
 
     @property
     def score(self):
-        return self.__score
+        return str(self.__score)
 
     @score.setter
     def score(self, value):
-        self.__score = str(value)
+        self.__score = value if isinstance(value, PondObject) else str(value)
 
     @property
     def functions(self):
@@ -48,9 +107,231 @@ class PondDoc:
     def add_function(self, name, value):
         self.__functions.append(f"{name} = {value}")
 
+    @staticmethod
+    def variable_name(prefix, idx):
+        # LilyPond variable names can only contain letters.
+        letters = ""
+        idx += 1
+        while idx:
+            idx, letter = divmod(idx - 1, 26)
+            letters = chr(ord("A") + letter) + letters
+        return prefix + letters
+
+    def variable_names(self):
+        """
+        Yields the names variables can use, skipping the ones taken by functions.
+        """
+        taken = {function.partition(" = ")[0] for function in self.__functions}
+        for idx in itertools.count():
+            name = self.variable_name(self.variable_prefix, idx)
+            if name not in taken:
+                yield name
+
+    def voices(self):
+        return [voice for staff in getattr(self.__score, "staves", ())
+                for voice in getattr(staff, "voices", ()) if isinstance(voice, PondMelody)]
+
+    def count_notes(self):
+        """
+        Notes, rests and chords in the score, counted from the walk events of its
+        melodies. Voices and scores given as LilyPond code are counted with
+        PondParser.count_notes.
+        """
+        score = self.__score
+        if not isinstance(score, PondObject):
+            return PondParser.count_notes(score)
+        staves = score.staves if isinstance(score, PondScore) else (score,)
+        count = 0
+        for staff in staves:
+            for voice in getattr(staff, "voices", (staff,)):
+                if isinstance(voice, PondMelody):
+                    for event, node in walk(voice):
+                        if event is NOTE:
+                            count += len(node) if isinstance(node, PondColumnMelody) else 1
+                elif isinstance(voice, PondColumnMelody):
+                    count += len(voice)
+                else:
+                    count += PondParser.count_notes(str(voice))
+        return count
+
+    @staticmethod
+    def __is_written(idx, parents, digests, chosen):
+        parent = parents[idx]
+        while parent != -1:
+            variable = chosen.get(digests[parent])
+            if variable is not None and variable[1] != parent:
+                return False
+            parent = parents[parent]
+        return True
+
+    def plan_variables(self):
+        """
+        Chooses the repeated melodies to write as variables, largest first. A repeat
+        only counts where it would still be written out, so repeats inside another
+        variable are counted once. Returns the variables as (name, melody) pairs,
+        and the substitutions to set in melody_substitutions.
+        """
+        melodies, parents, digests = subtree_digests(self.voices())
+        occurrences = {}
+        for idx, digest in enumerate(digests):
+            occurrences.setdefault(digest, []).append(idx)
+        sizes = {}
+        for digest, indexes in occurrences.items():
+            if len(indexes) > 1:
+                size = len(melodies[indexes[0]].as_string())
+                if size >= self.min_repeat_bytes:
+                    sizes[digest] = size
+        chosen = {}
+        names = self.variable_names()
+        name = next(names)
+        for digest in sorted(sizes, key=lambda digest: (-sizes[digest], occurrences[digest][0])):
+            written = [idx for idx in occurrences[digest]
+                       if self.__is_written(idx, parents, digests, chosen)]
+            saved = len(written) * (sizes[digest] - len(name) - 1) - (len(name) + 5 + sizes[digest])
+            if len(written) > 1 and saved > 0:
+                chosen[digest] = (name, written[0])
+                name = next(names)
+        variables, references, containing = [], {}, set()
+        for digest, (name, representative) in chosen.items():
+            variables.append((name, melodies[representative]))
+            for idx in occurrences[digest]:
+                references[id(melodies[idx])] = "\\" + name
+                parent = parents[idx]
+                while parent != -1 and id(melodies[parent]) not in containing:
+                    containing.add(id(melodies[parent]))
+                    parent = parents[parent]
+        return variables, (references, containing)
+
+    @staticmethod
+    def render_variable(melody):
+        text = "".join(melody.render_chunks(stream=True))
+        if type(melody) is PondMelody and not melody.time_string:
+            return text.rstrip("\n")
+        return "{" + text + "}"
+
+    def __deduplicated_chunks(self):
+        variables, substitutions = self.plan_variables()
+        # The substitutions only apply while this generator runs, not in the caller.
+        context = copy_context()
+        context.run(melody_substitutions.set, substitutions)
+        # Smaller variables are chosen later and can be used by larger ones.
+        for name, melody in reversed(variables):
+            yield f"{CustomFunction(name, context.run(self.render_variable, melody))}\n"
+        chunks = chunks_of(self.__score)
+        for chunk in iter(lambda: context.run(next, chunks, None), None):
+            yield chunk
+
+    def iter_chunks(self):
+        yield "\n".join([self.header, self.paper, self.functions, ""])
+        if self.deduplicate:
+            yield from self.__deduplicated_chunks()
+        else:
+            yield from chunks_of(self.__score)
+        yield "\n" + self.layout
+
+    def deduplication_report(self):
+        deduplicate = self.deduplicate
+        try:
+            self.deduplicate = False
+            bytes_before = sum(len(chunk.encode()) for chunk in self.iter_chunks())
+            self.deduplicate = True
+            variables = len(self.plan_variables()[0])
+            bytes_after = sum(len(chunk.encode()) for chunk in self.iter_chunks())
+        finally:
+            self.deduplicate = deduplicate
+        return {"variables": variables, "bytes_before": bytes_before,
+                "bytes_after": bytes_after, "bytes_saved": bytes_before - bytes_after}
+
+    def write_to(self, fp):
+        for chunk in self.iter_chunks():
+            fp.write(chunk)
+
     def create_file(self):
-        return "\n".join([self.header, self.paper, self.functions,
-                          self.score, self.layout])
+        return "".join(self.iter_chunks())
+
+
+class PondRenderStats:
+    """
+    Measurements of the build, write and render stages of a PondRender. Pass one as
+    PondRender(stats=PondRenderStats()); without it nothing is measured. Each hook
+    is called as hook(stage, seconds, stats) after every measured stage.
+    LilyPond only reports its own timings when run with verbose output. Updates
+    hold a lock, so one object can be shared by renders running in several threads.
+    """
+    warning_pattern = re.compile(r"^.*\bwarning: .*$", re.MULTILINE)
+    error_pattern = re.compile(r"^.*\berror: .*$", re.MULTILINE)
+    timing_pattern = re.compile(r"^(?:(.*?)\.\.\..*\n)?.*elapsed time: ([\d.]+) seconds",
+                                re.MULTILINE)
+
+    def __init__(self, *hooks):
+        self.hooks = list(hooks)
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = OrderedDict()
+        self.calls = {}
+        self.bytes_written = 0
+        self.notes_serialized = 0
+        self.cache_hits = 0
+        self.returncode = None
+        self.warnings = []
+        self.errors = []
+        self.lilypond_timings = OrderedDict()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def record(self, stage, seconds):
+        with self.__lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+        for hook in self.hooks:
+            hook(stage, seconds, self)
+
+    def count(self, name, amount=1):
+        """Adds amount to the counter name, such as "cache_hits" or "bytes_written"."""
+        with self.__lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def read_log(self, returncode, log):
+        warnings = self.warning_pattern.findall(log)
+        errors = self.error_pattern.findall(log)
+        timings = self.timing_pattern.findall(log)
+        with self.__lock:
+            self.returncode = returncode
+            self.warnings.extend(warnings)
+            self.errors.extend(errors)
+            for phase, seconds in timings:
+                phase = phase.strip() or "lilypond"
+                self.lilypond_timings[phase] = (self.lilypond_timings.get(phase, 0) +
+                                                float(seconds))
+
+    def as_dict(self):
+        with self.__lock:
+            return {"stages": dict(self.stages), "calls": dict(self.calls),
+                    "bytes_written": self.bytes_written,
+                    "notes_serialized": self.notes_serialized,
+                    "cache_hits": self.cache_hits, "returncode": self.returncode,
+                    "warnings": list(self.warnings), "errors": list(self.errors),
+                    "lilypond_timings": dict(self.lilypond_timings)}
+
+    def __str__(self):
+        lines = [f"{stage:<10}{seconds * 1000:>10.1f} ms  ({self.calls[stage]} calls)"
+                 for stage, seconds in self.stages.items()]
+        lines.append(f"{self.bytes_written} bytes written, {self.notes_serialized} notes, "
+                     f"{self.cache_hits} cache hits")
+        lines.append(f"LilyPond exit code {self.returncode}, {len(self.warnings)} warnings, "
+                     f"{len(self.errors)} errors")
+        return "\n".join(lines)
 
 
 class PondRender:
@@ -61,7 +342,15 @@ class PondRender:
         self._version = '\\version "2.22.1"'
         self._format = "png"
         self._resolution = 200
-        self.current_file = self._version + "\n"
+        self._backend = "eps"
+        self._workers = None
+        self._max_concurrency = 4
+        self._cache = None
+        self._stats = None
+        self._workspace = None
+        self.__semaphores = weakref.WeakKeyDictionary()
+        self.__document = ""
+        self.__written = None
         self.set_config(**config)
 
     @property
@@ -69,28 +358,763 @@ class PondRender:
         return os.path.join(self._folder_path, self._file_name)
 
     @property
-    def __render_options(self):
-        return (f"-o{self._folder_path} "
-                f"-f{self._format} -dbackend=eps -dresolution={self._resolution} "
-                f"-dno-gs-load-fonts -dinclude-eps-fonts "
-                f""
-                f"{self.__file_path}")
+    def __output_base(self):
+        return os.path.join(self._folder_path, os.path.splitext(self._file_name)[0])
+
+    def render_arguments(self, file_path, output=None, **options):
+        output = self._folder_path if output is None else output
+        options = self.render_options(**options)
+        return ["lilypond", f"-o{output}", f"-f{options['format']}",
+                f"-dbackend={options['backend']}", f"-dresolution={options['resolution']}",
+                "-dno-gs-load-fonts", "-dinclude-eps-fonts", file_path]
+
+    def render_options(self, **options):
+        """The configured render options, with options given for one call on top."""
+        values = {"format": self._format, "resolution": self._resolution,
+                  "backend": self._backend, "version": self._version}
+        unknown = set(options) - set(values)
+        if unknown:
+            raise ValueError(f"Unknown render options: {', '.join(sorted(unknown))}")
+        values.update(options)
+        return values
+
+    def digest(self, document=None, version=None):
+        text_hash = hashlib.sha256()
+        for chunk in self.iter_chunks(document, version):
+            text_hash.update(chunk.encode())
+        return text_hash.hexdigest()
+
+    @staticmethod
+    def file_digest(path):
+        text_hash = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(65536), b""):
+                text_hash.update(block)
+        return text_hash.hexdigest()
+
+    def cache_key(self, document=None, digest=None, **options):
+        """
+        Hash of the render options and of the LilyPond text: the text of document,
+        or the text whose digest is given.
+        """
+        options = self.render_options(**options)
+        if digest is None:
+            digest = self.digest(document, options["version"])
+        options = repr(sorted(options.items()))
+        return hashlib.sha256(f"{options}\n{digest}".encode()).hexdigest()
 
     def set_config(self, **config):
         for name, value in config.items():
             attr_name = f"_{name}"
             setattr(self, attr_name, value)
 
+    @property
+    def current_file(self):
+        return "".join(self.iter_chunks())
+
     def update(self, new_file):
-        if isinstance(new_file, PondDoc):
-            new_file = new_file.create_file()
-        self.current_file = self._version + "\n" + new_file
+        """
+        Sets the document to render. A PondDoc is kept as the object and only
+        serialized when the file is written, so changes made to it after update()
+        are part of the next write(). Pass str(document) to keep the current text.
+        """
+        if not isinstance(new_file, PondDoc):
+            new_file = str(new_file)
+        self.__document = new_file
         if self._auto_write:
-            self.write()
+            self.write(force=False)
 
-    def write(self):
+    def iter_chunks(self, document=None, version=None):
+        document = self.__document if document is None else document
+        yield (self._version if version is None else version) + "\n"
+        if isinstance(document, PondDoc):
+            yield from document.iter_chunks()
+        else:
+            yield str(document)
+
+    def write_to(self, fp):
+        for chunk in self.iter_chunks():
+            fp.write(chunk)
+
+    def write(self, force=True):
+        if self._stats is not None:
+            return self.__measured_write(force)
+        written = (self.__file_path, self.digest())
+        if not force and written == self.__written and os.path.exists(self.__file_path):
+            return
         with open(self.__file_path, 'wt') as file:
-            file.write(self.current_file)
+            self.write_to(file)
+        self.__written = written
+
+    def __measured_write(self, force):
+        """
+        Streams the document like write_to. Hashing the text and building each
+        chunk count as the build stage, encoding and writing it as the write stage.
+        """
+        stats = self._stats
+        start = time.perf_counter()
+        written = (self.__file_path, self.digest())
+        build = time.perf_counter() - start
+        if not force and written == self.__written and os.path.exists(self.__file_path):
+            stats.record("build", build)
+            return
+        chunks = self.iter_chunks()
+        write = size = 0
+        with open(self.__file_path, 'wb') as file:
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                built = time.perf_counter()
+                build += built - start
+                if chunk is None:
+                    break
+                data = chunk.encode()
+                file.write(data)
+                size += len(data)
+                write += time.perf_counter() - built
+        stats.record("build", build)
+        stats.record("write", write)
+        stats.count("bytes_written", size)
+        stats.count("notes_serialized", self.count_notes())
+        self.__written = written
+
+    def count_notes(self, document=None):
+        """
+        Notes, rests and chords in document, counted from the music tree when it is
+        a PondDoc. Text is counted with PondParser.count_notes.
+        """
+        document = self.__document if document is None else document
+        if isinstance(document, PondDoc):
+            return document.count_notes()
+        return PondParser.count_notes(str(document))
+
+    def write_job(self, document, tag="job"):
+        stem = os.path.splitext(self._file_name)[0]
+        output = os.path.join(self._folder_path, f"{stem}_{tag}{os.getpid()}_{next(job_ids)}")
+        source = f"{output}.ly"
+        with open(source, 'wt') as file:
+            for chunk in self.iter_chunks(document):
+                file.write(chunk)
+        return source, output
+
+    def output_files(self, output_base, format=None):
+        format = self._format if format is None else format
+        return (glob.glob(glob.escape(output_base) + f".{format}") +
+                sorted(glob.glob(glob.escape(output_base) + f"-*.{format}"),
+                       key=self.page_number))
+
+    @staticmethod
+    def page_number(path):
+        match = re.search(r"-(\d+)\.\w+$", path)
+        return int(match.group(1)) if match else 0
+
+    def render_bytes(self, document=None, **options):
+        """
+        Renders document in a private temporary folder and returns a RenderData
+        with the bytes of every output page, in order. options override format,
+        resolution, backend and version for this call only, and timeout limits
+        LilyPond's run time in seconds; a run that is stopped returns TIMED_OUT and
+        the log so far. The folder is removed before returning and the PondRender is
+        left unchanged, so calls can run at the same time from several threads,
+        sharing its cache and stats. The folder is created inside the configured workspace,
+        such as a tmpfs mount, or the system's temporary folder.
+        """
+        timeout = options.pop("timeout", None)
+        options = self.render_options(**options)
+        stats = self._stats
+        with tempfile.TemporaryDirectory(prefix="pypond-", dir=self._workspace) as workspace:
+            source = os.path.join(workspace, "score.ly")
+            output = os.path.join(workspace, "score")
+            key = None
+            restored = False
+            if self._cache is not None:
+                key = self.cache_key(document, **options)
+                restored = self._cache.restore(key, output)
+            if restored:
+                returncode, log = 0, ""
+                if stats is not None:
+                    stats.count("cache_hits")
+            else:
+                with open(source, 'wt') as file:
+                    for chunk in self.iter_chunks(document, options["version"]):
+                        file.write(chunk)
+                start = time.perf_counter()
+                returncode, log = run_lilypond(self.render_arguments(source, output, **options),
+                                               timeout, workspace)
+                if stats is not None:
+                    stats.record("render", time.perf_counter() - start)
+                    stats.read_log(returncode, log)
+            files = self.output_files(output, options["format"])
+            if key is not None and not restored and returncode == 0:
+                self._cache.store(key, output, files)
+            pages = []
+            for path in files:
+                with open(path, 'rb') as file:
+                    pages.append(file.read())
+        return RenderData(tuple(pages), returncode, log)
 
     def render(self):
-        os.system(f"lilypond {self.__render_options} {self.__file_path}")
+        """
+        Renders the written file. Returns a RenderResult with LilyPond's exit code
+        and its captured log. The cache key is taken from the file on disk, which
+        is what LilyPond renders, even if the document changed since write().
+        """
+        stats = self._stats
+        output = f"{self.__output_base}.{self._format}"
+        key = None
+        if self._cache is not None and os.path.exists(self.__file_path):
+            key = self.cache_key(digest=self.file_digest(self.__file_path))
+            if self._cache.restore(key, self.__output_base):
+                if stats is not None:
+                    stats.count("cache_hits")
+                return RenderResult(self.__file_path, output, 0, "")
+        start = time.perf_counter()
+        returncode, log = run_lilypond(self.render_arguments(self.__file_path))
+        if stats is not None:
+            stats.record("render", time.perf_counter() - start)
+            stats.read_log(returncode, log)
+        if key is not None and returncode == 0:
+            self._cache.store(key, self.__output_base, self.output_files(self.__output_base))
+        return RenderResult(self.__file_path, output, returncode, log)
+
+    def __loop_semaphore(self):
+        # asyncio primitives belong to one event loop, so each loop gets its own.
+        loop = asyncio.get_running_loop()
+        semaphore = self.__semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.__semaphores[loop] = asyncio.Semaphore(self._max_concurrency)
+        return semaphore
+
+    async def render_async(self, document=None, timeout=None):
+        """
+        Renders without blocking the event loop. The document is written to its own
+        file and LilyPond runs through create_subprocess_exec, at most
+        max_concurrency jobs at a time per PondRender and event loop. If the job
+        takes longer than timeout seconds, or the task is cancelled, the process is
+        killed and the exception is raised. Returns a RenderResult with the
+        captured log.
+        """
+        async with self.__loop_semaphore():
+            source, output = await asyncio.to_thread(self.write_job, document, "async")
+            key = None
+            if self._cache is not None:
+                key = self.cache_key(document)
+                if self._cache.restore(key, output):
+                    if self._stats is not None:
+                        self._stats.count("cache_hits")
+                    return RenderResult(source, f"{output}.{self._format}", 0, "")
+            start = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                *self.render_arguments(source, output),
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            try:
+                log, _ = await asyncio.wait_for(process.communicate(), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+            log = log.decode(errors="replace")
+            if self._stats is not None:
+                self._stats.record("render", time.perf_counter() - start)
+                self._stats.read_log(process.returncode, log)
+            if key is not None and process.returncode == 0:
+                self._cache.store(key, output, self.output_files(output))
+            return RenderResult(source, f"{output}.{self._format}", process.returncode, log)
+
+    def render_batch(self, documents, workers=None):
+        """
+        Renders many PondDoc objects or strings at once. Each document is written to
+        its own uniquely named file in the folder path and rendered by a pool of
+        threads, each waiting on its own Lilypond process, so at most workers
+        Lilypond processes run at once. Returns one RenderResult per document, in
+        the same order.
+        """
+        workers = self._workers if workers is None else workers
+        sources, outputs, keys, results = [], [], [], []
+        jobs = {}
+        for idx, document in enumerate(documents):
+            source, output = self.write_job(document, "batch")
+            sources.append(source)
+            outputs.append(output)
+            key = None if self._cache is None else self.cache_key(document)
+            keys.append(key)
+            if key is not None and self._cache.restore(key, output):
+                results.append((0, ""))
+                if self._stats is not None:
+                    self._stats.count("cache_hits")
+            else:
+                results.append(None)
+                jobs[idx] = self.render_arguments(source, output)
+        if jobs:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for idx, result in zip(jobs, pool.map(run_lilypond, jobs.values())):
+                    results[idx] = result
+                    if self._stats is not None:
+                        self._stats.read_log(*result)
+                    if keys[idx] is not None and result[0] == 0:
+                        self._cache.store(keys[idx], outputs[idx],
+                                          self.output_files(outputs[idx]))
+            if self._stats is not None:
+                self._stats.record("render", time.perf_counter() - start)
+        return [RenderResult(source, f"{output}.{self._format}", returncode, log)
+                for source, output, (returncode, log) in zip(sources, outputs, results)]
+
+
+class PondRenderCache:
+    """
+    On-disk cache of rendered outputs, keyed by PondRender.cache_key: a hash of
+    the final LilyPond text and the render options. The least recently used
+    entries are removed once the cache holds more than max_entries entries or
+    more than max_bytes bytes. Lookups and updates hold a lock, so one cache can
+    be shared by renders running in several threads.
+    """
+    entry_name = "output"
+
+    def __init__(self, folder_path=os.path.join("ly_files", "cache"), max_entries=256,
+                 max_bytes=None):
+        self.folder_path = folder_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+        self.__load()
+
+    def __load(self):
+        if not os.path.isdir(self.folder_path):
+            return
+        entries = []
+        for key in os.listdir(self.folder_path):
+            path = os.path.join(self.folder_path, key)
+            if os.path.isdir(path):
+                entries.append((os.path.getmtime(path), key, self.__entry_size(path)))
+        for modified, key, size in sorted(entries):
+            self.__entries[key] = size
+
+    @staticmethod
+    def __entry_size(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    def __entry_path(self, key):
+        return os.path.join(self.folder_path, key)
+
+    @property
+    def size(self):
+        return sum(self.__entries.values())
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def get(self, key):
+        with self.__lock:
+            if key not in self.__entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            path = self.__entry_path(key)
+            os.utime(path)
+            return [os.path.join(path, name) for name in sorted(os.listdir(path))]
+
+    def restore(self, key, output_base):
+        # Held while copying, so the entry cannot be evicted halfway.
+        with self.__lock:
+            files = self.get(key)
+            if files is None:
+                return False
+            for file in files:
+                suffix = os.path.basename(file)[len(self.entry_name):]
+                shutil.copyfile(file, output_base + suffix)
+            return True
+
+    def store(self, key, output_base, files):
+        if not files:
+            return
+        with self.__lock:
+            path = self.__entry_path(key)
+            os.makedirs(path, exist_ok=True)
+            for file in files:
+                suffix = file[len(output_base):]
+                shutil.copyfile(file, os.path.join(path, self.entry_name + suffix))
+            self.__entries[key] = self.__entry_size(path)
+            self.__entries.move_to_end(key)
+            self.__evict()
+
+    def __evict(self):
+        while self.__entries and (len(self.__entries) > self.max_entries or
+                                  (self.max_bytes is not None and self.size > self.max_bytes)):
+            key, size = self.__entries.popitem(last=False)
+            shutil.rmtree(self.__entry_path(key), ignore_errors=True)
+
+    def clear(self):
+        with self.__lock:
+            for key in self.__entries:
+                shutil.rmtree(self.__entry_path(key), ignore_errors=True)
+            self.__entries.clear()
+
+    def stats(self):
+        with self.__lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self.__entries), "bytes": self.size}
+
+
+class PondRenderWorker:
+    """
+    Long-lived LilyPond process that renders successive jobs, so the start-up cost
+    of Guile and LilyPond is paid once. Each job is written to its own file and sent
+    as one "<file>\\t<folder>" line; the process answers with a line starting with
+    done_marker and the job status. If the process dies it is started again and the
+    job is reported as failed. A job that gets no answer within timeout seconds
+    is reported with TIMED_OUT, and the process is killed and started again.
+    Any command that follows the same protocol can be used instead of LilyPond.
+    """
+    done_marker = "pypond-job-done"
+    scheme_loop = ("(begin (use-modules (ice-9 rdelim)) "
+                   "(let loop ((line (read-line))) "
+                   "(if (not (eof-object? line)) "
+                   "(let* ((fields (string-split line #\\tab)) "
+                   "(status (catch #t (lambda () (chdir (cadr fields)) "
+                   "(ly:parse-file (car fields)) 0) (lambda args 1)))) "
+                   "(format #t \"pypond-job-done ~a~%\" status) (force-output) "
+                   "(loop (read-line))))))")
+
+    def __init__(self, render=None, command=None, timeout=None):
+        self.render = PondRender() if render is None else render
+        self.command = self.default_command() if command is None else command
+        self.timeout = timeout
+        self.latencies = []
+        self.restarts = 0
+        self.__process = None
+        self.__lines = None
+
+    def default_command(self):
+        arguments = self.render.render_arguments(os.devnull)
+        return arguments[:1] + arguments[2:-1] + ["-e", self.scheme_loop, os.devnull]
+
+    @property
+    def alive(self):
+        return self.__process is not None and self.__process.poll() is None
+
+    def start(self):
+        if not self.alive:
+            self.__process = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                              text=True, bufsize=1)
+            # Lines are read on a thread, so that waiting for them can time out.
+            self.__lines = queue.Queue()
+            threading.Thread(target=self.read_lines, args=(self.__process.stdout, self.__lines),
+                             daemon=True).start()
+
+    @staticmethod
+    def read_lines(stream, lines):
+        try:
+            for line in stream:
+                lines.put(line)
+        except (OSError, ValueError):
+            pass
+        lines.put(None)
+
+    def stop(self):
+        if self.__process is not None:
+            self.__process.stdin.close()
+            try:
+                self.__process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.__process.kill()
+                self.__process.wait()
+            self.__process.stdout.close()
+            self.__process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __restart(self):
+        if self.__process is not None:
+            self.__process.kill()
+            self.__process.wait()
+            self.__process.stdout.close()
+            self.__process = None
+        self.restarts += 1
+        self.start()
+
+    def submit(self, document, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        source, output = self.render.write_job(document, "worker")
+        if not self.alive:
+            self.__restart() if self.__process is not None else self.start()
+        start_time = time.perf_counter()
+        deadline = None if timeout is None else start_time + timeout
+        log = []
+        returncode = -1
+        try:
+            self.__process.stdin.write(f"{os.path.abspath(source)}\t"
+                                       f"{os.path.abspath(self.render._folder_path)}\n")
+            self.__process.stdin.flush()
+            while True:
+                remaining = None if deadline is None else max(deadline - time.perf_counter(), 0)
+                line = self.__lines.get(timeout=remaining)
+                if line is None:
+                    break
+                if line.startswith(self.done_marker):
+                    returncode = int(line[len(self.done_marker):])
+                    break
+                log.append(line)
+        except queue.Empty:
+            returncode = TIMED_OUT
+            log.append(f"error: no answer from the worker after {timeout} seconds\n")
+        except (BrokenPipeError, ValueError):
+            pass
+        if returncode in (-1, TIMED_OUT):
+            self.__restart()
+        self.latencies.append(time.perf_counter() - start_time)
+        return RenderResult(source, f"{output}.{self.render._format}", returncode, "".join(log))
+
+    def latency_stats(self):
+        if not self.latencies:
+            return {"jobs": 0, "mean": 0, "max": 0}
+        return {"jobs": len(self.latencies),
+                "mean": sum(self.latencies) / len(self.latencies),
+                "max": max(self.latencies)}
+
+
+class PondWorkerPool:
+    """
+    Group of PondRenderWorker objects. render_batch sends every document to the
+    next idle worker and returns one RenderResult per document, in order.
+    """
+    def __init__(self, size=2, render=None, command=None, timeout=None):
+        self.workers = [PondRenderWorker(render, command, timeout) for _ in range(size)]
+        self.__idle = queue.Queue()
+        for worker in self.workers:
+            self.__idle.put(worker)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __submit(self, document):
+        worker = self.__idle.get()
+        try:
+            return worker.submit(document)
+        finally:
+            self.__idle.put(worker)
+
+    def render_batch(self, documents):
+        with ThreadPoolExecutor(max_workers=len(self.workers)) as pool:
+            return list(pool.map(self.__submit, documents))
+
+
+class PondLiveStaff:
+    """
+    One staff of a PondLiveRender. Keeps the last bars added to it, each with the
+    clef, key and time signature in effect when it was added.
+    """
+    def __init__(self, time_signature=None, key=None, clef="treble", bars=4):
+        self.clef = clef
+        self.key = key
+        self.bars = deque(maxlen=bars)
+        self.bar_count = 0
+        self.__splitter = None
+        self.__time_signature = PondTimeSignature(4, 4)
+        if time_signature is not None:
+            self.time_signature = time_signature
+
+    @property
+    def time_signature(self):
+        return self.__time_signature
+
+    @time_signature.setter
+    def time_signature(self, value):
+        if self.__splitter is not None:
+            self.__splitter.change_time(value)
+        self.__time_signature = value
+
+    def state(self):
+        clef = f"\\clef {self.clef}\n" if self.clef else ""
+        key = "" if self.key is None else str(self.key)
+        return clef, key, str(self.time_signature)
+
+    def add_bar(self, bar):
+        self.bars.append((self.state(), bar))
+        self.bar_count += 1
+
+    def feed(self, music):
+        """
+        Cuts music into bars with the current time signature and adds them. Notes
+        that do not fill the last bar wait for the next call, or for flush.
+        """
+        if self.__splitter is None:
+            self.__splitter = PondBarSplitter(self.time_signature, write_time=False)
+        for item in PondBarSplitter.iter_events(music):
+            for bar in self.__splitter.feed(item):
+                self.__time_signature = self.__splitter.time_signature
+                self.add_bar(bar)
+
+    def flush(self):
+        if self.__splitter is not None:
+            for bar in self.__splitter.flush():
+                self.add_bar(bar)
+
+    def spacer(self):
+        """Spacer rest that fills one bar of the current time signature."""
+        return f"s1*{self.time_signature.beat_number}/{self.time_signature.beat_value}"
+
+    def window_chunks(self, count, last_bar=None):
+        """
+        Chunks of the count bars that end at bar number last_bar, counting from 1,
+        by default the last bar of this staff. Bars the staff does not have yet are
+        written as spacer rests, so staves of different lengths stay aligned.
+        """
+        last_bar = self.bar_count if last_bar is None else last_bar
+        previous = None
+        for number in range(max(1, last_bar - count + 1), last_bar + 1):
+            if number > self.bar_count:
+                state, bar = self.state(), self.spacer()
+            else:
+                idx = len(self.bars) - 1 - (self.bar_count - number)
+                if idx < 0:
+                    continue
+                state, bar = self.bars[idx]
+            if previous is not None:
+                yield " |\n"
+            if previous is None:
+                yield "".join(state)
+            else:
+                yield "".join(part for part, old in zip(state, previous) if part != old)
+            # Bars are kept between frames, so their cached strings are reused.
+            yield str(bar)
+            previous = state
+
+    def window_staff(self, count, bar_number=None, last_bar=None):
+        staff = PondStaff()
+        if bar_number is not None:
+            staff.top_level_text.append(f"\\set Score.currentBarNumber = #{bar_number}\n")
+        staff.add_voice("".join(self.window_chunks(count, last_bar)))
+        return staff
+
+
+class PondLiveRender:
+    """
+    Live mode for interactive pieces, where only the last bars change between
+    frames. Only a rolling window of the most recent bars of each staff is
+    written and rendered, so the cost of a frame does not grow with the piece.
+    Clef, key and time signature are written again at the start of the window
+    and wherever they change, and bar numbers continue from the full piece.
+    With latency_target (in seconds), a slower frame shrinks the window by one
+    bar, down to min_bars, and a frame faster than half the target grows it back.
+    Frames are rendered on worker if given, a started PondRenderWorker, and with
+    render otherwise.
+    """
+    def __init__(self, bars=4, render=None, worker=None, latency_target=None, min_bars=1,
+                 history=1000):
+        if not 1 <= min_bars <= bars:
+            raise ValueError(f"min_bars must be between 1 and bars ({bars}). "
+                             f"Current value: {min_bars}")
+        self.bars = bars
+        self.min_bars = min_bars
+        self.window = bars
+        self.latency_target = latency_target
+        self.render = PondRender() if render is None else render
+        self.worker = worker
+        self.document = PondDoc()
+        self.staves = []
+        self.latencies = deque(maxlen=history)
+        self.frames = 0
+        self.skipped = 0
+        self.missed = 0
+        self.__last_text = None
+        self.__last_result = None
+
+    def add_staff(self, time_signature=None, key=None, clef="treble"):
+        staff = PondLiveStaff(time_signature, key, clef, self.bars)
+        self.staves.append(staff)
+        return staff
+
+    def push(self, *bars):
+        """Adds the next bar of every staff, in the order the staves were added."""
+        if len(bars) != len(self.staves):
+            raise ValueError(f"Got {len(bars)} bars for {len(self.staves)} staves")
+        for staff, bar in zip(self.staves, bars):
+            staff.add_bar(bar)
+
+    def frame_document(self):
+        score = PondScore()
+        bar_count = max((staff.bar_count for staff in self.staves), default=0)
+        first_bar = max(1, bar_count - self.window + 1)
+        for idx, staff in enumerate(self.staves):
+            score.add_staff(staff.window_staff(self.window, first_bar if idx == 0 else None,
+                                               bar_count))
+        self.document.score = score
+        return self.document
+
+    def render_frame(self):
+        """
+        Writes and renders the current window and returns its RenderResult. If the
+        window did not change since the last frame, the last result is returned and
+        the frame is counted as skipped: its latency is not recorded and the window
+        is not adapted.
+        """
+        start = time.perf_counter()
+        text = self.frame_document().create_file()
+        if text == self.__last_text:
+            self.skipped += 1
+            return self.__last_result
+        if self.worker is not None:
+            result = self.worker.submit(text)
+        else:
+            self.render.update(text)
+            self.render.write()
+            result = self.render.render()
+        self.__last_text, self.__last_result = text, result
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        self.frames += 1
+        self.adapt_window(latency)
+        return result
+
+    def adapt_window(self, latency):
+        if self.latency_target is None:
+            return
+        if latency > self.latency_target:
+            self.missed += 1
+            self.window = max(self.min_bars, self.window - 1)
+        elif latency < self.latency_target / 2:
+            self.window = min(self.bars, self.window + 1)
+
+    @staticmethod
+    def percentile(values, percent):
+        values = sorted(values)
+        if not values:
+            return 0
+        return values[max(1, math.ceil(percent / 100 * len(values))) - 1]
+
+    def frame_stats(self):
+        """
+        p50 and p99 are measured over the last history rendered frames. Skipped
+        frames are only counted.
+        """
+        return {"frames": self.frames, "skipped": self.skipped, "p50": self.percentile(self.latencies, 50),
+                "p99": self.percentile(self.latencies, 99),
+                "max": max(self.latencies, default=0), "missed": self.missed,
+                "window": self.window}
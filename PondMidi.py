@@ -0,0 +1,237 @@
+"""
+Standard MIDI File export, to listen to music without engraving it with LilyPond.
+"""
+
+import io
+import re
+import struct
+from .PondCore import PondObject
+from .PondMarks import Dynamics
+from .PondMusic import PondNote, PondChord, walk, ENTER, EXIT
+from .PondParser import PondParser
+from .PondScore import PondScore, PondStaff
+
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+PROGRAM_CHANGE = 0xC0
+DRUM_CHANNEL = 9
+
+
+class PondMidi:
+    """
+    Writes a PondMelody, PondStaff or PondScore as a Standard MIDI File (format 1).
+    Every voice of every staff becomes a track on its own channel. Tied notes of
+    the same pitch are joined, tuplets are timed exactly and dynamics set the
+    velocity of the notes that follow them; accents such as \\sf only change their
+    own note. Events are written as the music is read, without sorting.
+    """
+    header_tag = b"MThd"
+    track_tag = b"MTrk"
+    middle_c = 60
+    velocities = {Dynamics.pianissimo: 33, Dynamics.piano: 49, Dynamics.mezzo_piano: 64,
+                  Dynamics.mezzo_forte: 80, Dynamics.forte: 96, Dynamics.fortissimo: 112,
+                  Dynamics.subito_piano: 49, Dynamics.subitpo_pianissimo: 33,
+                  Dynamics.custom_dynamic("p", 3): 20, Dynamics.custom_dynamic("p", 4): 12,
+                  Dynamics.custom_dynamic("p", 5): 6, Dynamics.custom_dynamic("f", 3): 120,
+                  Dynamics.custom_dynamic("f", 4): 127, Dynamics.custom_dynamic("f", 5): 127}
+    accents = {Dynamics.sforzato: 112, Dynamics.sforzatissimo: 127, Dynamics.sforzando: 112,
+               Dynamics.riforzando: 104, Dynamics.forte_piano: 96}
+    dynamic_pattern = re.compile(r"\\[a-z]+")
+    time_pattern = re.compile(r"\\time\s+(\d+)/(\d+)")
+
+    def __init__(self, tempo=60, ticks_per_quarter=480, program=0, default_velocity=80):
+        self.tempo = tempo
+        self.ticks_per_quarter = ticks_per_quarter
+        self.program = program
+        self.default_velocity = default_velocity
+
+    @classmethod
+    def dynamic_velocity(cls, dynamic, velocity):
+        """
+        Velocity of a note marked with dynamic, and the velocity of the notes
+        after it, when the previous notes were played at velocity.
+        """
+        note_velocity = velocity
+        for mark in cls.dynamic_pattern.findall(dynamic):
+            if mark in cls.velocities:
+                velocity = note_velocity = cls.velocities[mark]
+            elif mark in cls.accents:
+                note_velocity = cls.accents[mark]
+                if mark == Dynamics.forte_piano:
+                    velocity = cls.velocities[Dynamics.piano]
+        return note_velocity, velocity
+
+    @classmethod
+    def note_pitches(cls, note):
+        if note.is_rest():
+            return frozenset()
+        pitches = note.pitches if isinstance(note, PondChord) else (note.pitch,)
+        pitches = frozenset(cls.middle_c - 12 + pitch.absolute_int for pitch in pitches
+                            if pitch.pitch != -1)
+        if pitches and not (0 <= min(pitches) and max(pitches) <= 127):
+            raise ValueError(f"Note {note} is outside of the MIDI range")
+        return pitches
+
+    def note_events(self, music):
+        """
+        (tick, status, pitch, velocity) of every note on and off of one voice, in
+        order. status is NOTE_ON or NOTE_OFF.
+        """
+        velocity = self.default_velocity
+        # Lengths in ticks for each (duration, tuplet scale) and pitch sets for each
+        # pitch. Positions stay integers unless a tuplet does not divide the ticks.
+        lengths = {}
+        pitch_sets = {}
+        position = 0
+        scale = 1
+        scales = []
+        sounding = frozenset()
+        held = frozenset()
+        for event, node in walk(music):
+            if event is ENTER:
+                scales.append(scale)
+                scale = scale * node.time_scale
+                continue
+            if event is EXIT:
+                scale = scales.pop()
+                continue
+            if isinstance(node, PondNote):
+                notes = ((node, scale),)
+            elif hasattr(node, "iter_timed_notes"):
+                # Views and persistent melodies keep their tuplets inside.
+                notes = ((note, scale * inner) for note, inner in node.iter_timed_notes())
+            else:
+                notes = ((note, scale) for note in node.iter_notes())
+            for note, note_scale in notes:
+                tick = position if position.__class__ is int else round(position)
+                if isinstance(note, PondChord):
+                    pitches = self.note_pitches(note)
+                else:
+                    pitches = pitch_sets.get(note.pitch)
+                    if pitches is None:
+                        pitches = pitch_sets[note.pitch] = self.note_pitches(note)
+                if note.dynamic:
+                    note_velocity, velocity = self.dynamic_velocity(note.dynamic, velocity)
+                else:
+                    note_velocity = velocity
+                if held:
+                    held = held & pitches
+                for pitch in sorted(sounding - held):
+                    yield tick, NOTE_OFF, pitch, 0
+                for pitch in sorted(pitches - held):
+                    yield tick, NOTE_ON, pitch, note_velocity
+                sounding = pitches
+                held = pitches if note.tie else frozenset()
+                key = (note.duration, note_scale)
+                length = lengths.get(key)
+                if length is None:
+                    length = note.real_duration * note_scale * self.ticks_per_quarter
+                    length = lengths[key] = int(length) if length.denominator == 1 else length
+                position += length
+        tick = position if position.__class__ is int else round(position)
+        for pitch in sorted(sounding):
+            yield tick, NOTE_OFF, pitch, 0
+
+    @staticmethod
+    def variable_length(value):
+        data = bytearray([value & 0x7F])
+        value >>= 7
+        while value:
+            data.insert(0, 0x80 | (value & 0x7F))
+            value >>= 7
+        return bytes(data)
+
+    @classmethod
+    def meta_event(cls, kind, data):
+        return b"\x00\xff" + bytes([kind]) + cls.variable_length(len(data)) + data
+
+    @staticmethod
+    def voices(music):
+        """
+        (name, music) for every voice in music. Voices given as LilyPond code
+        are read with PondParser.
+        """
+        if isinstance(music, PondScore):
+            staves = music.staves
+        elif isinstance(music, PondStaff):
+            staves = (music,)
+        else:
+            return [("Voice 1", music)]
+        voices = []
+        for staff_idx, staff in enumerate(staves, 1):
+            staff_voices = staff.voices if isinstance(staff, PondStaff) else (staff,)
+            for voice_idx, voice in enumerate(staff_voices, 1):
+                if not isinstance(voice, PondObject):
+                    voice = PondParser.parse(str(voice))
+                voices.append((f"Staff {staff_idx} voice {voice_idx}", voice))
+        return voices
+
+    def tempo_track(self, music):
+        data = self.meta_event(0x51, struct.pack(">I", round(60000000 / self.tempo))[1:])
+        staves = music.staves if isinstance(music, PondScore) else (music,)
+        time_signature = next((staff.time_signature for staff in staves
+                               if isinstance(staff, PondStaff) and staff.time_signature), "")
+        match = self.time_pattern.search(time_signature)
+        if match is not None:
+            numerator, denominator = map(int, match.groups())
+            data += self.meta_event(0x58, bytes([numerator, denominator.bit_length() - 1,
+                                                 24, 8]))
+        return data + self.meta_event(0x2F, b"")
+
+    def iter_track_chunks(self, name, melody, channel):
+        yield self.meta_event(0x03, name.encode())
+        yield bytes([0, PROGRAM_CHANGE | channel, self.program])
+        variable_length = self.variable_length
+        last_tick = 0
+        chunk = bytearray()
+        for tick, status, pitch, velocity in self.note_events(melody):
+            delta = tick - last_tick
+            if delta < 0x80:
+                chunk.append(delta)
+            else:
+                chunk += variable_length(delta)
+            chunk += bytes((status | channel, pitch, velocity))
+            last_tick = tick
+            if len(chunk) >= 65536:
+                yield bytes(chunk)
+                chunk.clear()
+        yield bytes(chunk)
+        yield self.meta_event(0x2F, b"")
+
+    def write_to(self, music, fp):
+        """
+        Writes music to a binary file. Tracks are streamed to seekable files and
+        their lengths written afterwards; other files receive one track at a time.
+        """
+        voices = self.voices(music)
+        fp.write(self.header_tag + struct.pack(">IHHH", 6, 1, len(voices) + 1,
+                                               self.ticks_per_quarter))
+        tempo_track = self.tempo_track(music)
+        fp.write(self.track_tag + struct.pack(">I", len(tempo_track)) + tempo_track)
+        channels = [channel for channel in range(16) if channel != DRUM_CHANNEL]
+        for idx, (name, melody) in enumerate(voices):
+            chunks = self.iter_track_chunks(name, melody, channels[idx % len(channels)])
+            if fp.seekable():
+                start = fp.tell()
+                fp.write(self.track_tag + b"\x00\x00\x00\x00")
+                size = 0
+                for chunk in chunks:
+                    fp.write(chunk)
+                    size += len(chunk)
+                end = fp.tell()
+                fp.seek(start + 4)
+                fp.write(struct.pack(">I", size))
+                fp.seek(end)
+            else:
+                track = b"".join(chunks)
+                fp.write(self.track_tag + struct.pack(">I", len(track)) + track)
+
+    def dumps(self, music):
+        fp = io.BytesIO()
+        self.write_to(music, fp)
+        return fp.getvalue()
+
+    def dump(self, music, path):
+        with open(path, 'wb') as fp:
+            self.write_to(music, fp)
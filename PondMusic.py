@@ -1,13 +1,129 @@
-from .PondCore import PondObject, DurationInterface
-
+from array import array
+from bisect import bisect_right
+from contextvars import ContextVar
+import copy
+from fractions import Fraction
+import hashlib
+from operator import add
+from .PondCore import PondObject, PondNode, DurationInterface, set_cache
+
+
+# (references, containing) while a document is written with variables: references
+# maps id(melody) to the variable that replaces it, containing holds the ids of
+# the melodies that have a reference somewhere inside them.
+melody_substitutions = ContextVar("melody_substitutions", default=None)
+
+
+# Events yielded by walk.
+ENTER, NOTE, TEXT, EXIT = "enter", "note", "text", "exit"
+# Event of each type of item in a melody, filled in by walk. Looking the type up
+# is much faster than isinstance against the abstract PondObject classes.
+item_kinds = {str: TEXT}
+
+
+def walk(root, descend=None, children=None):
+    """
+    Depth-first event stream over a music tree, driven by an explicit stack so
+    the nesting depth is not bounded by the recursion limit. A PondMelody yields
+    (ENTER, melody), the events of its children and (EXIT, melody); notes,
+    column melodies and melodies for which descend returns False are yielded
+    as (NOTE, leaf), and strings as (TEXT, string). children(melody) gives what
+    is visited inside a melody, by default its fragments.
+    """
+    if not isinstance(root, PondMelody) or (descend is not None and not descend(root)):
+        yield NOTE, root
+        return
+    if children is None:
+        children = lambda melody: melody.fragments
+    kinds = item_kinds
+    yield ENTER, root
+    stack = [(root, iter(children(root)))]
+    while stack:
+        melody, items = stack[-1]
+        for item in items:
+            try:
+                kind = kinds[type(item)]
+            except KeyError:
+                kind = kinds[type(item)] = ENTER if issubclass(type(item), PondMelody) else NOTE
+            if kind is TEXT:
+                yield TEXT, item
+            elif kind is ENTER and (descend is None or descend(item)):
+                yield ENTER, item
+                stack.append((item, iter(children(item))))
+                break
+            else:
+                yield NOTE, item
+        else:
+            stack.pop()
+            yield EXIT, melody
+
+
+def item_kind(item):
+    """The event walk yields for item: TEXT, ENTER for melodies or NOTE."""
+    try:
+        return item_kinds[type(item)]
+    except KeyError:
+        kind = item_kinds[type(item)] = ENTER if isinstance(item, PondMelody) else NOTE
+        return kind
+
+
+def iter_chunk_list(chunks):
+    """The strings of a chunk list built by PondMelody.chunk_list, in order."""
+    stack = [iter(chunks)]
+    while stack:
+        for chunk in stack[-1]:
+            if type(chunk) is list:
+                stack.append(iter(chunk))
+                break
+            yield chunk
+        else:
+            stack.pop()
+
+
+def subtree_digests(roots):
+    """
+    Merkle digests of every PondMelody in roots and below. Equal digests mean
+    equal LilyPond code. Returns the parallel lists (melodies, parents, digests)
+    in document order, where parents holds the index of the enclosing melody,
+    or -1 for roots.
+    """
+    melodies, parents, digests = [], [], []
+    for root in roots:
+        open_melodies = []
+        for event, node in walk(root):
+            if event is ENTER:
+                parents.append(open_melodies[-1][0] if open_melodies else -1)
+                digest = hashlib.blake2b(digest_size=16)
+                digest.update(f"{type(node).__name__}\0{node.time_string}\0"
+                              f"{getattr(node, 'string_data', '')}\0".encode())
+                open_melodies.append((len(melodies), digest))
+                melodies.append(node)
+                digests.append(None)
+            elif event is EXIT:
+                idx, digest = open_melodies.pop()
+                digests[idx] = digest.digest()
+                if open_melodies and node.real_duration > 0:
+                    open_melodies[-1][1].update(digests[idx])
+            elif node.real_duration > 0:
+                open_melodies[-1][1].update(
+                    hashlib.blake2b(node.as_string().encode(), digest_size=16).digest())
+    return melodies, parents, digests
+
+
+class PondMelody(PondNode):
+    __slots__ = ('_written_duration', '_notes', '_onsets', '__fragments', '__transposition',
+                 'time_string')
+    time_scale = 1
 
-class PondMelody(PondObject):
     def __init__(self, fragments=None, time_string=""):
+        super().__init__()
+        self._written_duration = None
+        self._notes = None
+        self._onsets = None
         self.__fragments = []
         self.__transposition = 0
         if fragments is not None:
-            for fragment in fragments:
-                self.append_fragment(fragment)
+            self.extend_fragments(fragments)
         self.time_string = time_string
 
     @property
@@ -18,112 +134,732 @@ class PondMelody(PondObject):
         self.insert_fragment(len(self.fragments), fragment)
 
     def get_note(self, idx):
-        return self.ordered_notes()[idx]
-
-    def insert_fragment(self, index, fragment):
-        if isinstance(fragment, (PondMelody, PondNote)):
-            self.__fragments.insert(index, fragment)
+        return self.note_index()[0][idx]
+
+    def note_index(self):
+        """
+        Flat list of the notes in the melody, and the onset of each one measured
+        from the start of the melody. Built on first use and kept up to date by
+        append_fragment.
+        """
+        if self._notes is None:
+            notes, onsets = [], []
+            offset = Fraction(0)
+            for fragment in self.fragments:
+                offset = self.index_fragment(notes, onsets, offset, fragment)
+            self._notes, self._onsets = notes, onsets
+        return self._notes, self._onsets
+
+    @staticmethod
+    def index_fragment(notes, onsets, offset, fragment, scale=1):
+        scales = []
+        for event, node in walk(fragment, lambda melody: melody._notes is None):
+            if event is ENTER:
+                scales.append(scale)
+                scale = scale * node.time_scale
+            elif event is EXIT:
+                scale = scales.pop()
+            elif isinstance(node, PondNote):
+                notes.append(node)
+                onsets.append(offset)
+                offset += node.real_duration * scale
+            elif isinstance(node, PondColumnMelody):
+                for note in node.iter_notes():
+                    notes.append(note)
+                    onsets.append(offset)
+                    offset += note.real_duration * scale
+            else:
+                inner_scale = scale * node.time_scale
+                notes.extend(node._notes)
+                onsets.extend(offset + onset * inner_scale for onset in node._onsets)
+                offset += node.written_duration * inner_scale
+        return offset
+
+    def onset(self, idx):
+        return self.note_index()[1][idx]
+
+    def note_at(self, beat):
+        notes, onsets = self.note_index()
+        if beat < 0 or beat >= self.written_duration:
+            return None
+        return notes[bisect_right(onsets, beat) - 1]
+
+    @staticmethod
+    def as_fragment(fragment):
+        if isinstance(fragment, PondNode):
+            return fragment
         elif isinstance(fragment, int):
-            self.__fragments.insert(index, PondNote(fragment))
+            return PondNote(fragment)
         elif isinstance(fragment, dict):
-            self.__fragments.insert(index, PondNote(**fragment))
+            return PondNote(**fragment)
+        raise ValueError(f"Object {fragment} cannot be "
+                         f"interpreted as PondNote or PondMelody")
+
+    def insert_fragment(self, index, fragment):
+        fragment = self.as_fragment(fragment)
+        appended = index >= len(self.__fragments)
+        self.__fragments.insert(index, fragment)
+        fragment.attach(self)
+        if appended:
+            self.__append_to_index([fragment])
         else:
-            raise ValueError(f"Object {fragment} cannot be "
-                             f"interpreted as PondNote or PondMelody")
+            self.invalidate()
+
+    def extend_fragments(self, fragments):
+        fragments = [self.as_fragment(fragment) for fragment in fragments]
+        self.__fragments.extend(fragments)
+        for fragment in fragments:
+            fragment.attach(self)
+        self.__append_to_index(fragments)
+
+    def __append_to_index(self, fragments):
+        total, notes, onsets = self._written_duration, self._notes, self._onsets
+        self.invalidate()
+        if total is None:
+            return
+        try:
+            durations = [fragment.real_duration for fragment in fragments]
+        except AssertionError:
+            # An incomplete tuplet has no duration yet. The index is built again
+            # on first use, once the tuplet is complete.
+            return
+        for fragment, duration in zip(fragments, durations):
+            if notes is not None:
+                self.index_fragment(notes, onsets, total, fragment)
+            total += duration
+        self._written_duration = total
+        self._notes, self._onsets = notes, onsets
 
     def clear_fragments(self):
+        for fragment in self.__fragments:
+            fragment.detach(self)
         self.__fragments = []
+        self.invalidate()
+
+    def clear_cache(self, timing=True):
+        cached = self._cache is not None
+        if timing:
+            cached = cached or self._written_duration is not None or self._notes is not None
+            self._written_duration = None
+            self._notes = None
+            self._onsets = None
+        self._cache = None
+        return cached
+
+    def __copy__(self):
+        """
+        Copies the whole subtree, so that nothing in the copy is attached to the
+        original melody or keeps it alive.
+        """
+        stack = []
+        for event, node in walk(self):
+            if event is ENTER:
+                melody = super(PondMelody, node).__copy__()
+                melody.__fragments = []
+                melody.clear_cache()
+                stack.append((melody, []))
+            elif event is EXIT:
+                melody, fragments = stack.pop()
+                melody.extend_fragments(fragments)
+                if not stack:
+                    return melody
+                stack[-1][1].append(melody)
+            elif event is NOTE:
+                stack[-1][1].append(copy.copy(node))
 
     def transpose(self, steps, override_static=False):
-        for fragment in self.fragments:
-            fragment.transpose(steps, override_static=override_static)
-        self.__transposition += steps
+        for event, node in walk(self):
+            if event is NOTE:
+                node.transpose(steps, override_static=override_static)
+            elif event is ENTER:
+                node.__transposition += steps
+
+    def view(self):
+        return PondMelodyView(self)
+
+    def valid_fragments(self, view=None):
+        fragments = self.fragments if view is None else view.order(self.fragments)
+        # Durations are never negative, so a true duration is a positive one.
+        return filter(lambda x: x.real_duration, fragments)
 
     def render_fragments(self):
-        valid_fragments = filter(lambda x: x.real_duration > 0, self.fragments)
-        return map(str, valid_fragments)
+        return map(str, self.valid_fragments())
+
+    def streamed_chunks(self):
+        """
+        Chunks that stand for the whole melody while streaming: its cached chunks,
+        or its variable reference while a document is written with variables.
+        None when the melody has to be rendered.
+        """
+        substitutions = melody_substitutions.get()
+        if substitutions is not None:
+            references, containing = substitutions
+            if id(self) in references:
+                return (references[id(self)],)
+            if id(self) in containing:
+                return None
+        if self._cache is None:
+            return None
+        return iter_chunk_list(self._cache)
+
+    def iter_chunks(self):
+        chunks = self.streamed_chunks()
+        if chunks is not None:
+            yield from chunks
+        else:
+            yield from self.render_chunks(stream=True)
+
+    @staticmethod
+    def join_chunks(fragments, separator):
+        for idx, fragment in enumerate(fragments):
+            if idx:
+                yield separator
+            yield fragment
 
     def ordered_notes(self):
-        ordered = []
-        for item in self.fragments:
-            if isinstance(item, PondNote):
-                ordered.append(item)
+        return list(self.note_index()[0])
+
+    def layout(self, view=None):
+        """
+        The strings of this melody interleaved with the fragments to render in
+        between them. render_chunks expands the fragments.
+        """
+        yield f"{self.time_string}{{"
+        yield from self.join_chunks(self.valid_fragments(view), '\n')
+        yield "}\n"
+
+    def render_chunks(self, stream=False, view=None):
+        if view is not None:
+            descend = None
+        elif stream:
+            descend = lambda melody: melody is self or melody.streamed_chunks() is None
+        else:
+            descend = lambda melody: melody is self
+        for event, node in walk(self, descend, lambda melody: melody.layout(view)):
+            if event is TEXT:
+                yield node
+            elif event is NOTE:
+                if view is not None:
+                    yield from view.fragment_chunks(node)
+                elif stream:
+                    yield from node.iter_chunks()
+                else:
+                    yield node.as_string()
+
+    def render_string(self):
+        return ''.join([item if isinstance(item, str) else item.as_string()
+                        for item in self.layout()])
+
+    def chunk_list(self):
+        """
+        The strings of the melody as a list whose items are strings, or the chunk
+        lists of the melodies inside it. Those must already be cached. The strings
+        in between are joined, so a melody of notes only has a single string.
+        """
+        chunks, strings = [], []
+        kinds = item_kinds
+        for item in self.layout():
+            kind = kinds.get(type(item)) or item_kind(item)
+            if kind is TEXT:
+                strings.append(item)
+            elif kind is ENTER:
+                if strings:
+                    chunks.append(''.join(strings))
+                    strings = []
+                chunks.append(item._cache)
             else:
-                ordered.extend(item.ordered_notes())
-        return ordered
+                strings.append(item.as_string())
+        if strings:
+            chunks.append(''.join(strings))
+        return chunks
 
     def as_string(self):
-        fragments = '\n'.join(self.render_fragments())
-        return f"{self.time_string}{{{fragments}}}\n"
+        # Melodies cache chunk lists that share the lists of the melodies inside
+        # them, and only the string asked for is joined. Caching whole strings
+        # at every level would take memory quadratic in the nesting depth.
+        if self._cache is None:
+            for event, melody in walk(self, lambda melody: melody._cache is None):
+                if event is EXIT:
+                    set_cache(melody, melody.chunk_list())
+        chunks = self._cache
+        if len(chunks) == 1 and type(chunks[0]) is str:
+            return chunks[0]
+        return ''.join(iter_chunk_list(chunks))
+
+    @property
+    def written_duration(self):
+        if self._written_duration is None:
+            totals = []
+            total = Fraction(0)
+            for event, node in walk(self, lambda melody: melody._written_duration is None):
+                if event is ENTER:
+                    totals.append(total)
+                    total = Fraction(0)
+                elif event is EXIT:
+                    node._written_duration = total
+                    total = totals.pop()
+                    if totals:
+                        total += node.real_duration
+                else:
+                    total += node.real_duration
+        return self._written_duration
 
     @property
     def real_duration(self):
-        total = 0
-        for element in self.fragments:
-            total += element.real_duration
-        return total
+        return self.written_duration
 
     def __len__(self):
-        return len(self.ordered_notes())
+        return len(self.note_index()[0])
 
 
 class PondFragment(PondMelody):
-    def as_string(self):
-        return ' '.join(self.render_fragments())
+    __slots__ = ()
+
+    def layout(self, view=None):
+        yield self.time_string
+        yield from self.join_chunks(self.valid_fragments(view), ' ')
 
 
 class PondPhrase(PondMelody):
-    def as_string(self):
-        try:
-            return (f"{self.time_string}{self.fragments[0]} "
-                    f"({' '.join(list(self.render_fragments())[1:])})")
-        except IndexError:
-            return super().as_string()
+    __slots__ = ()
+
+    def layout(self, view=None):
+        if not self.fragments:
+            yield from super().layout(view)
+            return
+        fragments = self.fragments if view is None else view.order(self.fragments)
+        yield self.time_string
+        yield next(iter(fragments))
+        yield " ("
+        valid_fragments = self.valid_fragments(view)
+        next(valid_fragments, None)
+        yield from self.join_chunks(valid_fragments, ' ')
+        yield ")"
 
 
 class PondTuplet(PondMelody):
+    __slots__ = ('data', 'string_data', '_real_duration')
+    timing_attributes = frozenset({'data'})
+
     def __init__(self, num=3, den=2, group_duration=4, notes=None):
+        self._real_duration = None
         super().__init__(notes)
         self.data = (num, den, group_duration)
         self.string_data = f"{num}/{den} {group_duration}"
 
     @property
-    def real_duration(self):
-        assert DurationInterface.is_complete_tuplet(self), ("Cannot correctly approximate an "
-                                                            "incomplete tuplet's duration.")
+    def time_scale(self):
         num, den, group_duration = self.data
-        tuplet_duration = DurationInterface.get_fragment_duration(self)
-        return tuplet_duration / (num / den)
+        return Fraction(den, num)
+
+    def clear_cache(self, timing=True):
+        cached = timing and self._real_duration is not None
+        if timing:
+            self._real_duration = None
+        return super().clear_cache(timing) or cached
+
+    @property
+    def real_duration(self):
+        if self._real_duration is None:
+            tuplet_duration = self.written_duration
+            assert DurationInterface.is_complete_tuplet(self, tuplet_duration), (
+                "Cannot correctly approximate an incomplete tuplet's duration.")
+            self._real_duration = tuplet_duration * self.time_scale
+        return self._real_duration
+
+    def layout(self, view=None):
+        string_data = self.string_data
+        if view is not None and view.scale != 1:
+            num, den, group_duration = self.data
+            group_duration = view.scale_duration(group_duration)
+            string_data = f"{num}/{den} {group_duration}"
+        yield f"{self.time_string}\\tuplet {string_data} {{"
+        yield from self.join_chunks(self.valid_fragments(view), ' ')
+        yield "}"
+
+
+class PondColumnMelody(PondNode):
+    """
+    Sibling of PondMelody for very long voices of plain notes. Notes are stored
+    column by column in compact arrays and only become PondNote objects when
+    requested through get_note or iter_notes. Those notes are new objects built
+    from the arrays, so changing them does not change the melody. Octaves are
+    stored in one signed byte each and must stay within octave_range.
+    """
+    __slots__ = ('__pitches', '__octaves', '__durations', '__articulations', '__dynamics',
+                 '__ties', '__articulation_table', '__dynamic_table', 'time_string')
+    rest_code = 255
+    duration_strings = list(DurationInterface.reverse_dotted_converter)
+    duration_codes = {string: code for code, string in enumerate(duration_strings)}
+    octave_range = range(-128, 128)
+
+    def __init__(self, notes=None, time_string=""):
+        super().__init__()
+        self.__pitches = bytearray()
+        self.__octaves = array('b')
+        self.__durations = bytearray()
+        self.__articulations = bytearray()
+        self.__dynamics = bytearray()
+        self.__ties = bytearray()
+        self.__articulation_table = [""]
+        self.__dynamic_table = [""]
+        if notes is not None:
+            self.extend(notes)
+        self.time_string = time_string
+
+    @staticmethod
+    def __intern(table, value):
+        try:
+            return table.index(value)
+        except ValueError:
+            table.append(value)
+            return len(table) - 1
+
+    def append_note(self, pitch, duration="4", articulation="", dynamic="",
+                    octave=0, tie=False):
+        if pitch == -1:
+            pitch_class = self.rest_code
+        else:
+            octave_shift, pitch_class = divmod(pitch, 12)
+            octave += octave_shift
+        if octave not in self.octave_range:
+            raise ValueError(f"PondColumnMelody can only store octaves from "
+                             f"{self.octave_range.start} to {self.octave_range.stop - 1}. "
+                             f"Attempted value: {octave}")
+        try:
+            duration_code = self.duration_codes[str(duration)]
+        except KeyError:
+            raise ValueError(f"DurationConverter requires a valid Lilypond duration. "
+                             f"Attempted value: {duration}")
+        self.__pitches.append(pitch_class)
+        self.__octaves.append(octave)
+        self.__durations.append(duration_code)
+        self.__articulations.append(self.__intern(self.__articulation_table, articulation))
+        self.__dynamics.append(self.__intern(self.__dynamic_table, dynamic))
+        self.__ties.append(1 if tie else 0)
+        self.invalidate()
+
+    def append_fragment(self, fragment):
+        if isinstance(fragment, PondNote):
+            if (fragment.has_marks() or fragment.expressions or
+                    fragment.phrase_mark or isinstance(fragment, PondChord)):
+                raise ValueError(f"PondColumnMelody can only store plain notes. "
+                                 f"Attempted value: {fragment}")
+            pitch = -1 if fragment.is_rest() else fragment.pitch.pitch
+            self.append_note(pitch, fragment.duration, fragment.articulation,
+                             fragment.dynamic, fragment.pitch.octave, bool(fragment.tie))
+        elif isinstance(fragment, int):
+            self.append_note(fragment)
+        elif isinstance(fragment, dict):
+            self.append_note(**fragment)
+        else:
+            raise ValueError(f"Object {fragment} cannot be "
+                             f"interpreted as a plain PondNote")
+
+    def extend(self, notes):
+        for note in notes:
+            self.append_fragment(note)
+
+    @classmethod
+    def from_melody(cls, melody):
+        return cls(melody.ordered_notes(), melody.time_string)
+
+    def get_note(self, idx):
+        """A new PondNote with the data of note idx, not linked to the melody."""
+        pitch_class = self.__pitches[idx]
+        duration = self.duration_strings[self.__durations[idx]]
+        if pitch_class == self.rest_code:
+            note = PondNote(PondPitch.rest(self.__octaves[idx]), duration)
+            note.static = True
+        else:
+            note = PondNote(PondPitch(pitch_class, self.__octaves[idx]), duration)
+        note.articulation = self.__articulation_table[self.__articulations[idx]]
+        note.dynamic = self.__dynamic_table[self.__dynamics[idx]]
+        note.make_tie(self.__ties[idx])
+        return note
+
+    def iter_notes(self):
+        for idx in range(len(self)):
+            yield self.get_note(idx)
+
+    def ordered_notes(self):
+        return list(self.iter_notes())
+
+    def view(self):
+        return PondMelodyView(self)
+
+    def transpose(self, steps, override_static=False):
+        pitch_table = bytearray(range(256))
+        octave_shifts = [0] * 256
+        for pitch_class in range(12):
+            octave_shifts[pitch_class], pitch_table[pitch_class] = divmod(pitch_class + steps, 12)
+        try:
+            octaves = array('b', map(add, self.__octaves,
+                                     map(octave_shifts.__getitem__, self.__pitches)))
+        except OverflowError:
+            raise ValueError(f"Transposing by {steps} steps takes the melody out of "
+                             f"the octaves PondColumnMelody can store") from None
+        self.__octaves = octaves
+        self.__pitches = self.__pitches.translate(pitch_table)
+        self.invalidate(timing=False)
+
+    @property
+    def real_duration(self):
+        total = 0
+        for code, string in enumerate(self.duration_strings):
+            count = self.__durations.count(code)
+            if count:
+                total += count * DurationInterface.get_real_duration(string)
+        return total
+
+    def note_strings(self):
+        pitch_strings = {}
+        for note_data in zip(self.__pitches, self.__octaves, self.__durations,
+                             self.__articulations, self.__ties, self.__dynamics):
+            pitch_class, octave, duration, articulation, tie, dynamic = note_data
+            try:
+                pitch_string = pitch_strings[pitch_class, octave]
+            except KeyError:
+                if pitch_class == self.rest_code:
+                    pitch_string = "r"
+                else:
+                    pitch_string = PondPitch(pitch_class, octave).as_string()
+                pitch_strings[pitch_class, octave] = pitch_string
+            yield (pitch_string + self.duration_strings[duration] +
+                   self.__articulation_table[articulation] + ("~" if tie else "") +
+                   self.__dynamic_table[dynamic])
+
+    def render_chunks(self, stream=False, view=None):
+        yield f"{self.time_string}{{"
+        if view is None:
+            strings = self.note_strings()
+        else:
+            notes = view.order(range(len(self)))
+            strings = (view.note_string(self.get_note(idx)) for idx in notes)
+        for idx, string in enumerate(strings):
+            yield f"\n{string}" if idx else string
+        yield "}\n"
+
+    def render_string(self):
+        return ''.join(self.render_chunks())
+
+    def __len__(self):
+        return len(self.__pitches)
+
+
+class PondMelodyView(PondObject):
+    """
+    Lazy, composable transformation of a PondMelody. Transposition, inversion,
+    retrograde and duration scaling are applied while rendering or iterating,
+    so creating a view never copies or mutates the underlying melody.
+    Notes marked as static keep their pitch, as with PondMelody.transpose.
+    In retrograde, each tie moves to the note before it and phrase marks swap,
+    so ties and slurs still point forward.
+    """
+    retrograde_phrase_marks = {" (": ")", ")": " ("}
+
+    def __init__(self, melody, steps=0, inverted=False, retrograde=False, scale=1,
+                 override_static=False):
+        if isinstance(melody, PondMelodyView):
+            raise ValueError("Compose views through their methods, e.g. view.transposed()")
+        self.melody = melody
+        self.steps = steps
+        self.inverted = inverted
+        self.retrograde = retrograde
+        self.scale = Fraction(scale)
+        self.override_static = override_static
+        self.__ties = None
+
+    def __derive(self, **changes):
+        data = dict(steps=self.steps, inverted=self.inverted, retrograde=self.retrograde,
+                    scale=self.scale, override_static=self.override_static)
+        data.update(changes)
+        return PondMelodyView(self.melody, **data)
+
+    def transposed(self, steps):
+        return self.__derive(steps=self.steps + steps)
+
+    def inversion(self, axis=0):
+        if isinstance(axis, PondPitch):
+            axis = axis.absolute_int
+        return self.__derive(steps=2 * axis - self.steps, inverted=not self.inverted)
+
+    def retrograded(self):
+        return self.__derive(retrograde=not self.retrograde)
+
+    def augmented(self, factor=2):
+        return self.__derive(scale=self.scale * Fraction(factor))
+
+    def diminished(self, factor=2):
+        return self.augmented(1 / Fraction(factor))
+
+    def map_pitch(self, pitch):
+        if pitch.pitch == -1:
+            return pitch
+        value = -pitch.absolute_int if self.inverted else pitch.absolute_int
+        return PondPitch.from_absolute_int(value + self.steps)
+
+    def scale_duration(self, duration):
+        if self.scale == 1:
+            return str(duration)
+        real_duration = DurationInterface.get_real_duration(duration) * self.scale
+        return DurationInterface.get_pond_duration(real_duration)
+
+    def order(self, fragments):
+        return reversed(fragments) if self.retrograde else fragments
+
+    def __rendering(self):
+        """
+        The view to render or iterate with. In retrograde, the tie of each note
+        depends on the note after it, so every pass gets its own copy of the view.
+        """
+        if not self.retrograde:
+            return self
+        view = self.__derive()
+        view.__ties = self.__following_ties()
+        return view
+
+    def __following_ties(self):
+        notes = self.__ordered_notes()
+        next(notes, None)
+        for note in notes:
+            yield note.tie
+
+    def __note_arguments(self, note):
+        pitch_map = self.map_pitch
+        if (note.static and not self.override_static) or (not self.steps and
+                                                          not self.inverted):
+            pitch_map = None
+        duration = None if self.scale == 1 else self.scale_duration(note.duration)
+        if self.__ties is None:
+            return pitch_map, duration, None, None
+        phrase_mark = self.retrograde_phrase_marks.get(note.phrase_mark, note.phrase_mark)
+        return pitch_map, duration, next(self.__ties, ""), phrase_mark
+
+    def note_string(self, note):
+        return note.render_string(*self.__note_arguments(note))
+
+    def fragment_chunks(self, fragment):
+        if isinstance(fragment, PondNote):
+            yield self.note_string(fragment)
+        else:
+            yield from fragment.render_chunks(view=self)
+
+    def iter_notes(self):
+        view = self.__rendering()
+        for note in self.__ordered_notes():
+            yield note.variant(*view.__note_arguments(note))
+
+    def iter_timed_notes(self):
+        """
+        Pairs (note, scale) in the order of iter_notes, where scale is the product
+        of the time scales of the tuplets around the note. The scale of the view
+        is already part of the duration of each note.
+        """
+        view = self.__rendering()
+        for note, scale in self.__timed_notes():
+            yield note.variant(*view.__note_arguments(note)), scale
+
+    def __ordered_notes(self):
+        for note, scale in self.__timed_notes():
+            yield note
+
+    def __timed_notes(self):
+        scale = 1
+        scales = []
+        for event, node in walk(self.melody, children=lambda melody: self.order(melody.fragments)):
+            if event is ENTER:
+                scales.append(scale)
+                scale = scale * node.time_scale
+            elif event is EXIT:
+                scale = scales.pop()
+            elif isinstance(node, PondNote):
+                yield node, scale
+            elif isinstance(node, PondColumnMelody):
+                for note in self.order(node.ordered_notes()):
+                    yield note, scale
+
+    def ordered_notes(self):
+        return list(self.iter_notes())
+
+    def iter_chunks(self):
+        return self.melody.render_chunks(stream=True, view=self.__rendering())
 
     def as_string(self):
-        return (f"{self.time_string}\\tuplet {self.string_data} "
-                f"{{{' '.join(self.render_fragments())}}}")
+        return ''.join(self.iter_chunks())
+
+    @property
+    def real_duration(self):
+        return self.melody.real_duration * self.scale
+
+    def __len__(self):
+        return len(self.melody)
 
 
-class PondNote(PondObject):
+class PondNote(PondNode):
+    __slots__ = ('pitch', 'duration', 'articulation', 'dynamic', 'tie', 'expressions',
+                 '_pre_marks', '_post_marks', '_auxiliary_pitches', 'phrase_mark', 'static')
+    timing_attributes = frozenset({'duration'})
+
     def __init__(self, pitch, duration="4", articulation="", dynamic="",
                  octave=0, tie=False, expression="", dotted=False, begin_phrase=False,
                  end_phrase=False):
-        if isinstance(pitch, PondPitch):
-            self.pitch = pitch
-        else:
-            self.pitch = PondPitch(pitch, octave)
+        super().__init__()
         assert duration != 0, f"PondNote of pitch {pitch} cannot have duration 0"
-        self.duration = str(duration) + '.' if dotted else str(duration)
-        self.articulation = articulation
-        self.dynamic = dynamic
-        self.tie = "~" if tie else ""
-        self.expressions = expression
-        self.pre_marks = []
-        self.post_marks = []
-        self.auxiliary_pitches = {}
-        self.phrase_mark = ""
-        self.static = False  # Cannot be transposed
+        # A new note has nothing to invalidate, so skip the PondNode.__setattr__ hook.
+        initialize = object.__setattr__
+        initialize(self, 'pitch', PondPitch(pitch, octave))
+        initialize(self, 'duration', str(duration) + '.' if dotted else str(duration))
+        initialize(self, 'articulation', articulation)
+        initialize(self, 'dynamic', dynamic)
+        initialize(self, 'tie', "~" if tie else "")
+        initialize(self, 'expressions', expression)
+        initialize(self, '_pre_marks', None)
+        initialize(self, '_post_marks', None)
+        initialize(self, '_auxiliary_pitches', None)
+        initialize(self, 'phrase_mark', "")
+        initialize(self, 'static', False)  # Cannot be transposed
         if begin_phrase:
             self.phrase_data('begin')
         elif end_phrase:
             self.phrase_data('end')
 
+    @property
+    def pre_marks(self):
+        if self._pre_marks is None:
+            self._pre_marks = []
+        return self._pre_marks
+
+    @pre_marks.setter
+    def pre_marks(self, value):
+        self._pre_marks = value
+        self.invalidate(timing=False)
+
+    @property
+    def post_marks(self):
+        if self._post_marks is None:
+            self._post_marks = []
+        return self._post_marks
+
+    @post_marks.setter
+    def post_marks(self, value):
+        self._post_marks = value
+        self.invalidate(timing=False)
+
+    @property
+    def auxiliary_pitches(self):
+        if self._auxiliary_pitches is None:
+            self._auxiliary_pitches = {}
+        return self._auxiliary_pitches
+
+    @auxiliary_pitches.setter
+    def auxiliary_pitches(self, value):
+        self._auxiliary_pitches = value
+        self.invalidate(timing=False)
+
+    def has_marks(self):
+        return bool(self._pre_marks or self._post_marks or self._auxiliary_pitches)
+
     def phrase_data(self, status="none"):
         if status == "begin":
             self.phrase_mark = " ("
@@ -148,37 +884,41 @@ class PondNote(PondObject):
         return self.pitch.absolute_int
 
     def make_rest(self):
-        self.pitch.make_rest()
+        self.pitch = self.pitch.make_rest()
         self.static = True
 
     def make_pitch(self):
-        self.pitch.make_pitch()
+        self.pitch = self.pitch.make_pitch()
         self.static = False
 
     def make_cadenza(self, value=True):
         if value:
-            self.pre_marks.append("\\CadenzaOn")
-            self.post_marks.append("\\CadenzaOff")
+            self.pre_marks.append("\\cadenzaOn ")
+            self.post_marks.append(" \\cadenzaOff")
         else:
-            self.pre_marks.remove("\\CadenzaOn")
-            self.post_marks.remove("\\CadenzaOff")
+            self.pre_marks.remove("\\cadenzaOn ")
+            self.post_marks.remove(" \\cadenzaOff")
+        self.invalidate(timing=False)
 
     def is_rest(self):
         return self.pitch.pitch == -1
 
     def ignore_accidental(self, value=True):
         if value:
-            self.pre_marks.append("\\once\\omit Accidental")
+            self.pre_marks.append("\\once\\omit Accidental ")
         else:
-            self.pre_marks.remove("\\once\\omit Accidental")
+            self.pre_marks.remove("\\once\\omit Accidental ")
+        self.invalidate(timing=False)
 
     def hide_notehead(self):
         self.pre_marks.append("\\hide NoteHead ")
         self.post_marks.append(" \\undo \\hide NoteHead")
+        self.invalidate(timing=False)
 
     def hide_note(self):
         self.pre_marks.append("\\hideNotes ")
         self.post_marks.append(" \\undo \\hideNotes")
+        self.invalidate(timing=False)
 
     @classmethod
     def create_rest(cls, duration):
@@ -186,28 +926,112 @@ class PondNote(PondObject):
         note.make_rest()
         return note
 
+    @classmethod
+    def builder(cls):
+        """
+        Returns a function (pitch, duration, articulation, dynamic, tie, static) that
+        creates notes without the conversions of __init__: pitch must be a PondPitch
+        and the other values are stored as given. PondParser uses it to read long
+        melodies quickly.
+        """
+        new = object.__new__
+        (set_cache, set_parents, set_pitch, set_duration, set_articulation, set_dynamic,
+         set_tie, set_expressions, set_pre_marks, set_post_marks, set_auxiliary_pitches,
+         set_phrase_mark, set_static) = (
+            getattr(owner, name).__set__ for owner, name in (
+                (PondNode, '_cache'), (PondNode, '_parents'), (PondNote, 'pitch'),
+                (PondNote, 'duration'), (PondNote, 'articulation'), (PondNote, 'dynamic'),
+                (PondNote, 'tie'), (PondNote, 'expressions'), (PondNote, '_pre_marks'),
+                (PondNote, '_post_marks'), (PondNote, '_auxiliary_pitches'),
+                (PondNote, 'phrase_mark'), (PondNote, 'static')))
+
+        def build(pitch, duration, articulation="", dynamic="", tie="", static=False):
+            note = new(cls)
+            set_cache(note, None)
+            set_parents(note, [])
+            set_pitch(note, pitch)
+            set_duration(note, duration)
+            set_articulation(note, articulation)
+            set_dynamic(note, dynamic)
+            set_tie(note, tie)
+            set_expressions(note, "")
+            set_pre_marks(note, None)
+            set_post_marks(note, None)
+            set_auxiliary_pitches(note, None)
+            set_phrase_mark(note, "")
+            set_static(note, static)
+            return note
+        return build
+
     def transpose(self, steps, override_static=False):
         if self.static and not override_static:
             return
-        self.pitch.transpose(steps)
-        for pitch in self.auxiliary_pitches.values():
-            pitch.transpose(steps)
+        self.pitch = self.pitch.transpose(steps)
+        if self._auxiliary_pitches:
+            self._auxiliary_pitches = {key: pitch.transpose(steps) for key, pitch
+                                       in self._auxiliary_pitches.items()}
+        if self._post_marks:
+            self._post_marks = [mark.transpose(steps) if isinstance(mark, PondPitch) else mark
+                                for mark in self._post_marks]
+        self.invalidate(timing=False)
 
     def set_static(self, value):
         self.static = bool(value)
 
-    def pitch_string(self):
-        return self.pitch.as_string()
+    def pitch_string(self, pitch_map=None):
+        if pitch_map is None:
+            return self.pitch.as_string()
+        return pitch_map(self.pitch).as_string()
+
+    def render_string(self, pitch_map=None, duration=None, tie=None, phrase_mark=None):
+        if (pitch_map is None and duration is None and tie is None and phrase_mark is None and
+                self._pre_marks is None and self._post_marks is None):
+            return (self.pitch_string() + self.duration + self.articulation + self.tie +
+                    self.dynamic + self.expressions + self.phrase_mark)
+        pre_marks = self._pre_marks or ()
+        post_marks = self._post_marks or ()
+        if pitch_map is not None:
+            post_marks = [pitch_map(mark) if isinstance(mark, PondPitch) else mark
+                          for mark in post_marks]
+        duration = self.duration if duration is None else duration
+        tie = self.tie if tie is None else tie
+        phrase_mark = self.phrase_mark if phrase_mark is None else phrase_mark
+        return (' '.join(map(str, pre_marks)) + self.pitch_string(pitch_map) + duration +
+                self.articulation + tie + self.dynamic + self.expressions +
+                ' '.join(map(str, post_marks)) + phrase_mark)
+
+    def variant(self, pitch_map=None, duration=None, tie=None, phrase_mark=None):
+        note = copy.copy(self)
+        if pitch_map is not None:
+            note.pitch = pitch_map(self.pitch)
+            if self._auxiliary_pitches:
+                note.auxiliary_pitches = {key: pitch_map(pitch) for key, pitch
+                                          in self._auxiliary_pitches.items()}
+            if self._post_marks:
+                note.post_marks = [pitch_map(mark) if isinstance(mark, PondPitch) else mark
+                                   for mark in self._post_marks]
+        if duration is not None:
+            note.duration = duration
+        if tie is not None:
+            note.tie = tie
+        if phrase_mark is not None:
+            note.phrase_mark = phrase_mark
+        return note
 
-    def as_string(self):
-        return (' '.join(map(str, self.pre_marks)) + self.pitch_string() + self.duration +
-                self.articulation + self.tie + self.dynamic + self.expressions +
-                ' '.join(map(str, self.post_marks)) + self.phrase_mark)
+    def __copy__(self):
+        note = super().__copy__()
+        if self._pre_marks is not None:
+            note._pre_marks = list(self._pre_marks)
+        if self._post_marks is not None:
+            note._post_marks = list(self._post_marks)
+        if self._auxiliary_pitches is not None:
+            note._auxiliary_pitches = dict(self._auxiliary_pitches)
+        return note
 
     def trill_marks(self, begin=True, pitched=None, clear=False, relative=True):
         if clear:
-            self.pre_marks = []
-            self.post_marks = []
+            self.pre_marks = None
+            self.post_marks = None
             return
         trill_mark = "\\startTrillSpan " if begin else "\\stopTrillSpan "
         if isinstance(pitched, PondPitch):
@@ -221,15 +1045,36 @@ class PondNote(PondObject):
             self.post_marks += [trill_mark, pitched]
         else:
             self.post_marks += [trill_mark]
+        self.invalidate(timing=False)
 
 
 class PondChord(PondNote):
+    __slots__ = ('pitches',)
+
     def __init__(self, pitches: list, *args):
+        pitches = [PondPitch(pitch) for pitch in pitches]
         super().__init__(pitches[0], *args)
         self.pitches = pitches
 
-    def pitch_string(self):
-        return f"<{' '.join(map(str, self.pitches))}>"
+    def transpose(self, steps, override_static=False):
+        if self.static and not override_static:
+            return
+        self.pitches = [pitch.transpose(steps) for pitch in self.pitches]
+        super().transpose(steps, override_static)
+
+    def pitch_string(self, pitch_map=None):
+        pitches = self.pitches
+        if pitch_map is not None:
+            pitches = [pitch_map(pitch) if isinstance(pitch, PondPitch) else pitch
+                       for pitch in pitches]
+        return f"<{' '.join(map(str, pitches))}>"
+
+    def variant(self, pitch_map=None, duration=None, tie=None, phrase_mark=None):
+        chord = super().variant(pitch_map, duration, tie, phrase_mark)
+        if pitch_map is not None:
+            chord.pitches = [pitch_map(pitch) if isinstance(pitch, PondPitch) else pitch
+                             for pitch in self.pitches]
+        return chord
 
 
 class PondNoteGroup(PondObject):
@@ -269,8 +1114,9 @@ class PondNoteGroup(PondObject):
             yield str(pitch) + tie
 
     def transpose(self, steps, override_static=False):
-        for pitch in self.all_pitches():
-            pitch.transpose(steps, override_static=override_static)
+        self.main_pitches = [pitch.transpose(steps) for pitch in self.main_pitches]
+        self.__auxiliary_pitches = {key: pitch.transpose(steps) for key, pitch
+                                    in self.__auxiliary_pitches.items()}
 
     def add_trill(self, pitch, octave=0, relative=False):
         if not isinstance(pitch, PondPitch):
@@ -301,6 +1147,11 @@ class PondNoteGroup(PondObject):
 
 
 class PondPitch(PondObject):
+    """
+    Immutable pitch. Instances are interned by absolute integer, so equal pitches
+    are the same object and can be shared between notes. Methods that used to
+    change the pitch (transpose, make_rest, make_pitch) return another pitch.
+    """
     pitch_names = {0: ["bis", "c"],
                    1: ["des", "cis"],
                    2: ["d", "d"],
@@ -315,32 +1166,56 @@ class PondPitch(PondObject):
                    11: ["b", "ces"],
                    -1: ["r", "r"]
                    }
+    name_lookup = {name: pitch for pitch, names in pitch_names.items() for name in names}
     default_key_data = [1, 1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 0]
+    __slots__ = ('__pitch', '__octave', '__string')
+    __pool = {}
+    __rests = {}
 
-    def __init__(self, pitch=0, octave=0):
+    def __new__(cls, pitch=0, octave=0):
+        if type(pitch) is int:
+            return cls.from_absolute_int(pitch + octave * 12)
+        if isinstance(pitch, PondPitch):
+            return pitch
         if isinstance(pitch, str):
-            pitch = self.__init_from_string(pitch)
+            pitch = cls.__init_from_string(pitch)
         if isinstance(pitch, tuple):
-            pitch = pitch[0]
-            octave = pitch[1]
-        self.__pitch = 0
-        self.__octave = octave
-        self.pitch = pitch
+            pitch, octave = pitch
+        return cls.from_absolute_int(pitch + octave * 12)
+
+    @classmethod
+    def __create(cls, pitch, octave):
+        new_pitch = object.__new__(cls)
+        new_pitch.__pitch = pitch
+        new_pitch.__octave = octave
+        new_pitch.__string = new_pitch.note_string() + new_pitch.octave_string()
+        return new_pitch
+
+    @classmethod
+    def from_absolute_int(cls, pitch_value):
+        try:
+            return cls.__pool[pitch_value]
+        except KeyError:
+            octave, pitch = divmod(pitch_value, 12)
+            new_pitch = cls.__pool[pitch_value] = cls.__create(pitch, octave)
+            return new_pitch
+
+    @classmethod
+    def rest(cls, octave=0):
+        """
+        The rest of the given octave. Rests keep an octave so that make_pitch
+        gives back a pitch in the same octave.
+        """
+        try:
+            return cls.__rests[octave]
+        except KeyError:
+            rest = cls.__rests[octave] = cls.__create(-1, octave)
+            return rest
 
     @property
     def pitch(self):
         return self.__pitch
 
-    @pitch.setter
-    def pitch(self, value):
-        self.__pitch = value
-        while self.__pitch > 11:
-            self.__pitch -= 12
-            self.__octave += 1
-        while self.__pitch < 0:
-            self.__pitch += 12
-            self.__octave -= 1
-
     @property
     def octave(self):
         return self.__octave
@@ -354,17 +1229,17 @@ class PondPitch(PondObject):
         return self.pitch + (self.octave * 12)
 
     def make_rest(self):
-        self.__pitch = -1
+        return self.rest(self.octave)
 
     def make_pitch(self):
-        self.__pitch = 0
+        return self.from_absolute_int(self.octave * 12)
 
     @classmethod
     def __init_from_string(cls, string):
-        for pitch, names in cls.pitch_names.items():
-            if string in names:
-                return pitch
-        raise ValueError(f"The note name {string} is currently not supported by PyPond")
+        try:
+            return cls.name_lookup[string]
+        except KeyError:
+            raise ValueError(f"The note name {string} is currently not supported by PyPond")
 
     def note_string(self, key_data=None, name_position=None):
         key_data = key_data or self.default_key_data
@@ -376,18 +1251,23 @@ class PondPitch(PondObject):
             return ""
         if self.octave > 0:
             return "'" * self.octave
-        return "," * self.octave
+        return "," * -self.octave
 
     def transpose(self, steps):
         if self.pitch == -1:
-            return
-        self.pitch += steps
+            return self
+        return self.from_absolute_int(self.absolute_int + steps)
 
     def as_string(self):
-        return self.note_string() + self.octave_string()
+        return self.__string
 
-    @classmethod
-    def from_absolute_int(cls, pitch_value):
-        new_pitch = PondPitch()
-        new_pitch.transpose(pitch_value)
-        return new_pitch
+    def __reduce__(self):
+        if self.pitch == -1:
+            return PondPitch.rest, (self.octave,)
+        return PondPitch.from_absolute_int, (self.absolute_int,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
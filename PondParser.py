@@ -0,0 +1,309 @@
+"""
+Reads the LilyPond code written by Pypond back into PondMusic objects.
+"""
+
+import gc
+import re
+from .PondMarks import Articulations, Dynamics, MiscMarks
+from .PondMusic import PondMelody, PondTuplet, PondPhrase, PondFragment, PondNote, PondChord, PondPitch
+
+
+class PondParser:
+    """
+    Parser for the subset of LilyPond that Pypond writes: notes and rests with
+    octave marks and durations, chords, ties, articulations, dynamics, phrase
+    slurs, \\tuplet and \\time. Post-events such as \\startTrillSpan and the
+    commands that close a mark, such as \\undo \\hideNotes, are kept as post marks
+    of the previous note, and other commands as pre marks of the following note.
+    Commands left over at the end of a melody go to its last note.
+    """
+    command_articulations = {value for name, value in vars(Articulations).items()
+                             if not name.startswith("_") and value.startswith("\\")}
+    dynamics = ({value for name, value in vars(Dynamics).items()
+                 if not name.startswith("_") and isinstance(value, str)} |
+                {Dynamics.custom_dynamic(identifier, number)
+                 for identifier in "pf" for number in range(6)} | {MiscMarks.end_tag})
+    post_events = {"\\startTrillSpan", "\\stopTrillSpan", "\\startTextSpan", "\\stopTextSpan",
+                   "\\glissando", "\\arpeggio", "\\laissezVibrer", "\\repeatTie",
+                   "\\sustainOn", "\\sustainOff", "\\cresc", "\\decresc", "\\dim"}
+    # Commands that end what a pre mark started, written after the note with a space.
+    closing_commands = {"\\cadenzaOff"}
+    pitch_pattern = "|".join(sorted(PondPitch.name_lookup, key=len, reverse=True))
+    # Notes are read in runs: one match covers consecutive notes and everything
+    # Pypond writes right after each of them, which is what makes parsing fast.
+    # Marks written in another order are read by the separate tokens below.
+    note_pattern = re.compile(
+        rf"({pitch_pattern})('+|,+)?(\d+\.*)?((?:-[\^+\-!>._])*)(~)?"
+        r"((?:\\[a-zA-Z]+|\\[<>!])*)\s*")
+    token_pattern = re.compile(
+        rf"(?P<notes>(?:(?:{pitch_pattern})(?:'+|,+)?(?:\d+\.*)?(?:-[\^+\-!>._])*~?"
+        r"(?:\\[a-zA-Z]+|\\[<>!])*\s*)+)"
+        r"|(?P<chord><(?P<chord_pitches>[^>]*)>(?P<chord_duration>\d+\.*)?)"
+        r"|(?P<tuplet>\\tuplet\s+(?P<num>\d+)/(?P<den>\d+)(?:\s+(?P<group>\d+))?\s*\{)"
+        r"|(?P<time>\\time\s+\d+/\d+\s*)"
+        r"|(?P<open>\{)"
+        r"|(?P<close>\})"
+        r"|(?P<slur_open>\()"
+        r"|(?P<slur_close>\))"
+        r"|(?P<tie>~)"
+        r"|(?P<articulation>-[\^+\-!>._])"
+        r"|(?P<undo>\\undo\s+(?:\\(?:hide|omit)\s+[A-Z][a-zA-Z]*|\\[a-zA-Z]+))"
+        r"|(?P<grob_command>(?:\\once\s*)?\\(?:hide|omit)\s+[A-Z][a-zA-Z]*)"
+        r"|(?P<command>\\[a-zA-Z]+|\\[<>!])"
+        r"|(?P<space>\s+)"
+        r"|(?P<error>.)")
+    command_pattern = re.compile(r"\\[a-zA-Z]+|\\[<>!]")
+    chord_pitch_pattern = re.compile(rf"({pitch_pattern})('+|,+)?")
+    note_count_pattern = re.compile(
+        rf"(?<![\w\\#])(?:{pitch_pattern})(?:'+|,+)?(?:\d+\.*)?(?!\w)"
+        rf"|<(?:\s*(?:{pitch_pattern})(?:'+|,+)?)+\s*>")
+    ignored_pattern = re.compile(r'"(?:[^"\\]|\\.)*"|%[^\n]*|\\key\s*\{?\s*\w+')
+    pitched_trill = "\\pitchedTrill "
+
+    __pitches = {}
+
+    @classmethod
+    def parse_pitch(cls, name, octave_marks):
+        key = name + (octave_marks or "")
+        try:
+            return cls.__pitches[key]
+        except KeyError:
+            pass
+        if name == "r":
+            pitch = PondPitch.rest()
+        else:
+            octave = 0
+            if octave_marks:
+                octave = len(octave_marks) if octave_marks[0] == "'" else -len(octave_marks)
+            pitch = PondPitch(PondPitch.name_lookup[name], octave)
+        cls.__pitches[key] = pitch
+        return pitch
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Returns the PondMelody for a single braced expression, or a PondFragment
+        holding everything at the top level otherwise.
+        """
+        # Everything the parser allocates stays alive in the tree, so the cyclic
+        # collector would only scan the growing tree again and again.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            return cls.__parse(text)
+        finally:
+            if collecting:
+                gc.enable()
+
+    @classmethod
+    def __parse(cls, text):
+        # Each level is [kind, items, data]; kind is "top", "melody", "tuplet" or "phrase".
+        levels = [["top", [], None]]
+        items = levels[-1][1]
+        pending_marks = []
+        pending_time = ""
+        last_note = None
+        # Last note of the levels closed so far, for commands left at the end.
+        previous_note = None
+        # Note of a \\pitchedTrill \\startTrillSpan whose trill pitch comes next.
+        trill_note = None
+        duration = "4"
+        parse_pitch, attach_command = cls.parse_pitch, cls.__attach_command
+        pitches, dynamics = cls.__pitches, cls.dynamics
+        find_notes, find_commands = cls.note_pattern.findall, cls.command_pattern.findall
+        build = PondNote.builder()
+        for match in cls.token_pattern.finditer(text):
+            kind = match.lastgroup
+            if kind == "space":
+                continue
+            if kind == "notes":
+                for pitch_name, octave, note_duration, articulation, tie, commands in \
+                        find_notes(match.group()):
+                    if trill_note is not None:
+                        trill_note, note = None, trill_note
+                        if not (note_duration or articulation or tie or commands):
+                            pitch = parse_pitch(pitch_name, octave)
+                            note.post_marks.append(pitch)
+                            note.auxiliary_pitches["trill"] = pitch
+                            continue
+                    if note_duration:
+                        duration = note_duration
+                    pitch = pitches.get(pitch_name + octave) or parse_pitch(pitch_name, octave)
+                    last_note = build(pitch, duration, articulation, "", tie, pitch_name == "r")
+                    if pending_time or pending_marks:
+                        pending_marks, pending_time = cls.__apply_marks(
+                            last_note, pending_marks, pending_time)
+                    if commands:
+                        if commands in dynamics:
+                            last_note.dynamic = commands
+                        else:
+                            for command in find_commands(commands):
+                                if attach_command(last_note, command, pending_marks):
+                                    trill_note = last_note
+                    items.append(last_note)
+                continue
+            trill_note = None
+            if kind == "chord":
+                duration = match.group("chord_duration") or duration
+                last_note = PondChord([parse_pitch(name, marks) for name, marks in
+                                       cls.chord_pitch_pattern.findall(match.group("chord_pitches"))],
+                                      duration)
+                if pending_time or pending_marks:
+                    pending_marks, pending_time = cls.__apply_marks(
+                        last_note, pending_marks, pending_time)
+                items.append(last_note)
+            elif kind == "tie":
+                cls.__require_note(last_note, match).make_tie()
+            elif kind == "articulation":
+                cls.__require_note(last_note, match).articulation += match.group()
+            elif kind == "command":
+                command = match.group()
+                if last_note is None:
+                    pending_marks.append(command + " ")
+                elif attach_command(last_note, command, pending_marks):
+                    trill_note = last_note
+            elif kind == "undo":
+                mark = " \\undo " + match.group()[len("\\undo"):].lstrip()
+                if last_note is None:
+                    pending_marks.append(mark.lstrip() + " ")
+                else:
+                    last_note.post_marks.append(mark)
+            elif kind == "grob_command":
+                pending_marks.append(match.group() + " ")
+            elif kind == "time":
+                pending_time += match.group()
+            elif kind == "open":
+                levels.append(["melody", [], pending_time])
+                if last_note is not None:
+                    previous_note = last_note
+                items, pending_time, last_note = levels[-1][1], "", None
+            elif kind == "tuplet":
+                data = (int(match.group("num")), int(match.group("den")),
+                        int(match.group("group") or 4))
+                levels.append(["tuplet", [], (pending_time, data)])
+                if last_note is not None:
+                    previous_note = last_note
+                items, pending_time, last_note = levels[-1][1], "", None
+            elif kind == "slur_open":
+                if not items:
+                    raise ValueError(f"Phrase without a first note at position {match.start()}")
+                levels.append(["phrase", [items.pop()], pending_time])
+                items, pending_time = levels[-1][1], ""
+            elif kind == "slur_close":
+                if levels[-1][0] == "phrase":
+                    items = cls.__close_level(levels)
+                else:
+                    cls.__require_note(last_note, match).phrase_data("end")
+            elif kind == "close":
+                while levels[-1][0] == "phrase":
+                    cls.__unwrap_phrase(levels)
+                if len(levels) == 1:
+                    raise ValueError(f"Unmatched '}}' at position {match.start()}")
+                if last_note is not None:
+                    previous_note = last_note
+                if pending_marks and previous_note is not None:
+                    pending_marks = cls.__flush_marks(previous_note, pending_marks)
+                items = cls.__close_level(levels)
+                last_note = None
+            else:
+                raise ValueError(f"Unexpected character {match.group()!r} "
+                                 f"at position {match.start()}")
+        while levels[-1][0] == "phrase":
+            cls.__unwrap_phrase(levels)
+        if len(levels) > 1:
+            raise ValueError("Unclosed '{' at end of text")
+        if last_note is not None:
+            previous_note = last_note
+        if pending_marks:
+            if previous_note is None:
+                raise ValueError(f"{''.join(pending_marks).strip()!r} does not belong to a note")
+            cls.__flush_marks(previous_note, pending_marks)
+        top = levels[0][1]
+        if len(top) == 1 and isinstance(top[0], PondMelody):
+            return top[0]
+        return PondFragment(top)
+
+    @staticmethod
+    def __apply_marks(note, pending_marks, pending_time):
+        """
+        Gives the pending \\time and commands to note as pre marks, and returns
+        empty ones for the next note.
+        """
+        if pending_time:
+            pending_marks.insert(0, pending_time)
+        note.pre_marks = pending_marks
+        return [], ""
+
+    @staticmethod
+    def __flush_marks(note, pending_marks):
+        """
+        Gives the commands left over after the last note of a melody to that
+        note as post marks, and returns empty pending marks.
+        """
+        note.post_marks.extend(" " + mark.rstrip() for mark in pending_marks)
+        return []
+
+    @classmethod
+    def __attach_command(cls, note, command, pending_marks):
+        """
+        Adds a command written after note to it, or to pending_marks when it
+        belongs to the next note. Returns True for the \\startTrillSpan of a
+        \\pitchedTrill, whose trill pitch comes next.
+        """
+        if command in cls.dynamics:
+            note.dynamic += command
+        elif command in cls.command_articulations:
+            note.articulation += command
+        elif command in cls.post_events:
+            # Written with a trailing space, as PondNote.trill_marks does.
+            note.post_marks.append(command + " ")
+            return command == "\\startTrillSpan" and cls.pitched_trill in (note._pre_marks or ())
+        elif command in cls.closing_commands:
+            # Written with a leading space, as PondNote.make_cadenza does.
+            note.post_marks.append(" " + command)
+        else:
+            pending_marks.append(command + " ")
+        return False
+
+    @staticmethod
+    def __require_note(note, match):
+        if note is None:
+            raise ValueError(f"{match.group()!r} at position {match.start()} "
+                             f"does not follow a note")
+        return note
+
+    @staticmethod
+    def __close_level(levels):
+        kind, items, data = levels.pop()
+        if kind == "melody":
+            fragment = PondMelody(items, time_string=data)
+        elif kind == "tuplet":
+            time_string, (num, den, group) = data
+            fragment = PondTuplet(num, den, group, items)
+            fragment.time_string = time_string
+        else:
+            fragment = PondPhrase(items, time_string=data)
+        levels[-1][1].append(fragment)
+        return levels[-1][1]
+
+    @staticmethod
+    def __unwrap_phrase(levels):
+        kind, items, data = levels.pop()
+        head = items[0]
+        if isinstance(head, PondNote):
+            head.phrase_data("begin")
+        levels[-1][1].extend(items)
+
+    @classmethod
+    def count_notes(cls, text):
+        """
+        Counts the notes, rests and chords in any LilyPond text without building
+        objects. Strings, comments and key signatures are skipped.
+        """
+        text = cls.ignored_pattern.sub(" ", text)
+        return sum(1 for _ in cls.note_count_pattern.finditer(text))
+
+    @classmethod
+    def parse_file(cls, path):
+        with open(path, 'rt') as file:
+            return cls.parse(file.read())
@@ -0,0 +1,525 @@
+"""
+Persistent melodies: immutable versions of a PondMelody tree that share their
+structure. Every edit returns a new version and copies only the path from the
+root to the notes it changes, so thousands of variants of one melody can be
+kept in memory, and each node renders its string once for all of them.
+"""
+
+import copy
+from fractions import Fraction
+from .PondCore import PondObject, DurationInterface
+from .PondMusic import (PondMelody, PondFragment, PondPhrase, PondTuplet, PondColumnMelody,
+                        PondNote, walk, ENTER, EXIT)
+
+
+def item_count(item):
+    return 1 if isinstance(item, PondNote) else item.count
+
+
+class PondVector:
+    """
+    Immutable sequence of notes and PondFrozenMelody objects, stored as a tree of
+    tuples of at most 2 * width children. Every node keeps its number of items,
+    notes and its duration, so notes are found by their position in the melody.
+    """
+    __slots__ = ('children', 'leaf', 'separator', 'length', 'count', 'duration', '_string')
+    width = 32
+
+    def __init__(self, children, leaf=True, separator=" ", measures=None):
+        self.children = tuple(children)
+        self.leaf = leaf
+        self.separator = separator
+        self._string = None
+        if measures is None:
+            measures = self.measure(self.children, leaf)
+        self.length, self.count, self.duration = measures
+
+    @staticmethod
+    def measure(children, leaf):
+        # Number of items, number of notes and duration of children.
+        if leaf:
+            return (len(children), sum(map(item_count, children)),
+                    sum((item.real_duration for item in children), Fraction(0)))
+        return (sum(child.length for child in children), sum(child.count for child in children),
+                sum((child.duration for child in children), Fraction(0)))
+
+    @classmethod
+    def build(cls, items, separator=" "):
+        items = list(items)
+        width = cls.width
+        nodes = [cls(items[idx:idx + width], True, separator)
+                 for idx in range(0, len(items), width)]
+        while len(nodes) > 1:
+            nodes = [cls(nodes[idx:idx + width], False, separator)
+                     for idx in range(0, len(nodes), width)]
+        return nodes[0] if nodes else cls((), True, separator)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        stack = [iter((self,))]
+        while stack:
+            for node in stack[-1]:
+                if node.leaf:
+                    yield from node.children
+                else:
+                    stack.append(iter(node.children))
+                    break
+            else:
+                stack.pop()
+
+    def __resized(self, node, children, removed, added, leaf):
+        # Nodes replacing node once its children are changed. Measures are updated
+        # with the removed and added children instead of counted again.
+        if not children:
+            return ()
+        if len(children) > 2 * self.width:
+            half = len(children) // 2
+            return (PondVector(children[:half], leaf, self.separator),
+                    PondVector(children[half:], leaf, self.separator))
+        measures = tuple(total - old + new for total, old, new in
+                         zip((node.length, node.count, node.duration),
+                             self.measure(removed, leaf), self.measure(added, leaf)))
+        return (PondVector(children, leaf, self.separator, measures),)
+
+    def splice(self, position, remove=0, items=()):
+        """
+        New vector where remove items from position on are replaced by items.
+        Only the nodes on the path to position are copied.
+        """
+        if not 0 <= position <= self.length - remove:
+            raise IndexError(f"Position {position} out of range for {self.length} items")
+        path = []
+        node = self
+        while not node.leaf:
+            last = len(node.children) - 1
+            for idx, child in enumerate(node.children):
+                if position < child.length or (not remove and idx == last):
+                    break
+                position -= child.length
+            path.append((node, idx))
+            node = child
+        items = tuple(items)
+        nodes = self.__resized(node, node.children[:position] + items +
+                               node.children[position + remove:],
+                               node.children[position:position + remove], items, True)
+        for node, idx in reversed(path):
+            nodes = self.__resized(node, node.children[:idx] + nodes + node.children[idx + 1:],
+                                   node.children[idx:idx + 1], nodes, False)
+        if len(nodes) == 1:
+            return nodes[0]
+        return PondVector(nodes, False, self.separator) if nodes else PondVector((), True,
+                                                                                 self.separator)
+
+    @property
+    def height(self):
+        height = 1
+        node = self
+        while not node.leaf:
+            node = node.children[0]
+            height += 1
+        return height
+
+    def concat(self, other):
+        """
+        New vector with the items of self followed by those of other. The lower
+        tree is joined to the side of the higher one at the same height, so the
+        result stays balanced; only the nodes along that side are copied.
+        """
+        if not other.length:
+            return self
+        if not self.length:
+            return other
+        # Each entry is (left, right, side): side tells which of them is higher.
+        stack = []
+        left, right = self, other
+        left_height, right_height = left.height, right.height
+        while left_height != right_height:
+            if left_height > right_height:
+                stack.append((left, "left"))
+                left = left.children[-1]
+                left_height -= 1
+            else:
+                stack.append((right, "right"))
+                right = right.children[0]
+                right_height -= 1
+        nodes = self.__split(left.children + right.children, left.leaf)
+        for node, side in reversed(stack):
+            if side == "left":
+                nodes = self.__split(node.children[:-1] + nodes, False)
+            else:
+                nodes = self.__split(nodes + node.children[1:], False)
+        if len(nodes) == 1:
+            return nodes[0]
+        return PondVector(nodes, False, self.separator)
+
+    def __split(self, children, leaf):
+        # One node with children, or two when there are too many for one node.
+        if len(children) > 2 * self.width:
+            half = len(children) // 2
+            return (PondVector(children[:half], leaf, self.separator),
+                    PondVector(children[half:], leaf, self.separator))
+        return (PondVector(children, leaf, self.separator),)
+
+    def item(self, position):
+        if not 0 <= position < self.length:
+            raise IndexError(f"Position {position} out of range for {self.length} items")
+        node = self
+        while not node.leaf:
+            for child in node.children:
+                if position < child.length:
+                    break
+                position -= child.length
+            node = child
+        return node.children[position]
+
+    def locate(self, note_idx):
+        """
+        Position of the item holding note note_idx, the item, and the index of
+        the note inside that item.
+        """
+        if not 0 <= note_idx < self.count:
+            raise IndexError(f"Note {note_idx} out of range for {self.count} notes")
+        node = self
+        position = 0
+        while not node.leaf:
+            for child in node.children:
+                if note_idx < child.count:
+                    break
+                note_idx -= child.count
+                position += child.length
+            node = child
+        for item in node.children:
+            count = item_count(item)
+            if note_idx < count:
+                return position, item, note_idx
+            note_idx -= count
+            position += 1
+
+    def map_notes(self, start, stop, change):
+        """
+        New vector where change(note) replaces every note from start to stop.
+        Nodes without any of those notes are shared.
+        """
+        if start >= self.count or stop <= 0:
+            return self
+        children, removed, added = [], [], []
+        offset = 0
+        for child in self.children:
+            count = item_count(child) if self.leaf else child.count
+            if count and offset < stop and offset + count > start:
+                removed.append(child)
+                if isinstance(child, PondNote):
+                    child = change(child)
+                else:
+                    child = child.map_notes(start - offset, stop - offset, change)
+                added.append(child)
+            children.append(child)
+            offset += count
+        measures = None
+        if 2 * len(removed) < len(children):
+            measures = tuple(total - old + new for total, old, new in
+                             zip((self.length, self.count, self.duration),
+                                 self.measure(removed, self.leaf), self.measure(added, self.leaf)))
+        return PondVector(children, self.leaf, self.separator, measures)
+
+    def render_string(self):
+        if self.leaf:
+            strings = (str(item) for item in self.children if item.real_duration > 0)
+        else:
+            strings = (child.as_string() for child in self.children if child.duration > 0)
+        return self.separator.join(strings)
+
+    def as_string(self):
+        if self._string is None:
+            # Children are rendered before their parents with an explicit stack.
+            stack = [(self, iter(() if self.leaf else self.children))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if child._string is None and not child.leaf:
+                        stack.append((child, iter(child.children)))
+                        break
+                else:
+                    stack.pop()
+                    node._string = node.render_string()
+        return self._string
+
+
+class PondFrozenMelody:
+    """
+    Immutable counterpart of a PondMelody, PondFragment, PondPhrase or PondTuplet,
+    given as kind. Renders the same LilyPond code and keeps it once rendered.
+    """
+    __slots__ = ('kind', 'items', 'time_string', 'data', '_string')
+    kinds = (PondMelody, PondFragment, PondPhrase, PondTuplet)
+
+    def __init__(self, kind, items, time_string="", data=None):
+        if kind not in self.kinds:
+            raise ValueError(f"{kind.__name__} cannot be frozen")
+        if not isinstance(items, PondVector):
+            items = PondVector.build(items, "\n" if kind is PondMelody else " ")
+        self.kind = kind
+        self.items = items
+        self.time_string = time_string
+        self.data = data
+        self._string = None
+
+    def with_items(self, items):
+        return PondFrozenMelody(self.kind, items, self.time_string, self.data)
+
+    def map_notes(self, start, stop, change):
+        return self.with_items(self.items.map_notes(start, stop, change))
+
+    @property
+    def count(self):
+        return self.items.count
+
+    @property
+    def written_duration(self):
+        return self.items.duration
+
+    @property
+    def time_scale(self):
+        if self.kind is not PondTuplet:
+            return 1
+        num, den, group_duration = self.data
+        return Fraction(den, num)
+
+    @property
+    def real_duration(self):
+        if self.kind is not PondTuplet:
+            return self.items.duration
+        assert DurationInterface.is_complete_tuplet(self, self.items.duration), (
+            "Cannot correctly approximate an incomplete tuplet's duration.")
+        return self.items.duration * self.time_scale
+
+    def render_string(self):
+        contents = self.items.as_string()
+        if self.kind is PondFragment:
+            return f"{self.time_string}{contents}"
+        if self.kind is PondTuplet:
+            num, den, group_duration = self.data
+            return f"{self.time_string}\\tuplet {num}/{den} {group_duration} {{{contents}}}"
+        if self.kind is PondPhrase and self.items.length:
+            # As in PondPhrase, the first valid fragment is left out after " (".
+            first_valid = next((item for item in self.items if item.real_duration > 0), None)
+            if first_valid is not None:
+                contents = contents[len(str(first_valid)) + 1:]
+            return f"{self.time_string}{self.items.item(0)} ({contents})"
+        return f"{self.time_string}{{{contents}}}\n"
+
+    def as_string(self):
+        if self._string is None:
+            self._string = self.render_string()
+        return self._string
+
+    def __str__(self):
+        return self.as_string()
+
+
+class PondPersistentMelody(PondObject):
+    """
+    Version of a melody that never changes. Edits such as transpose, make_rest,
+    make_tie, trill_marks, set_note, insert_note and delete_note return a new
+    PondPersistentMelody that shares every untouched part of this one, in time
+    proportional to the change. Notes are indexed in the order of ordered_notes.
+    get_note and iter_notes return copies, and to_melody builds an ordinary
+    PondMelody that can be changed in place.
+    """
+    __slots__ = ('root',)
+
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def from_melody(cls, melody):
+        levels = [[]]
+        for event, node in walk(melody):
+            if event is ENTER:
+                levels.append([])
+            elif event is EXIT:
+                items = levels.pop()
+                data = node.data if isinstance(node, PondTuplet) else None
+                levels[-1].append(PondFrozenMelody(type(node), items, node.time_string, data))
+            elif isinstance(node, PondColumnMelody):
+                levels[-1].append(PondFrozenMelody(PondMelody, node.iter_notes(),
+                                                   node.time_string))
+            else:
+                levels[-1].append(copy.copy(node))
+        root = levels[0][0]
+        if isinstance(root, PondNote):
+            root = PondFrozenMelody(PondMelody, [root])
+        return cls(root)
+
+    @classmethod
+    def from_notes(cls, notes, time_string=""):
+        return cls(PondFrozenMelody(PondMelody, map(copy.copy, notes), time_string))
+
+    def __unrendered(self):
+        # Frozen melodies that were never rendered, children before their parents.
+        stack = [(self.root, iter(self.root.items))]
+        while stack:
+            node, items = stack[-1]
+            for item in items:
+                if isinstance(item, PondFrozenMelody) and item._string is None:
+                    stack.append((item, iter(item.items)))
+                    break
+            else:
+                stack.pop()
+                yield node
+
+    def iter_notes(self):
+        stack = [iter(self.root.items)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, PondNote):
+                    yield copy.copy(item)
+                else:
+                    stack.append(iter(item.items))
+                    break
+            else:
+                stack.pop()
+
+    def iter_timed_notes(self):
+        """
+        Pairs (note, scale) in the order of iter_notes, where scale is the product
+        of the time scales of the tuplets around the note.
+        """
+        stack = [(iter(self.root.items), self.root.time_scale)]
+        while stack:
+            items, scale = stack[-1]
+            for item in items:
+                if isinstance(item, PondNote):
+                    yield copy.copy(item), scale
+                else:
+                    stack.append((iter(item.items), scale * item.time_scale))
+                    break
+            else:
+                stack.pop()
+
+    def ordered_notes(self):
+        return list(self.iter_notes())
+
+    def get_note(self, idx):
+        node, position = self.__note_path(idx)[-1]
+        return copy.copy(node.items.item(position))
+
+    def to_melody(self):
+        levels = [[]]
+        stack = [(self.root, iter(self.root.items))]
+        while stack:
+            node, items = stack[-1]
+            for item in items:
+                if isinstance(item, PondNote):
+                    levels[-1].append(copy.copy(item))
+                else:
+                    levels.append([])
+                    stack.append((item, iter(item.items)))
+                    break
+            else:
+                stack.pop()
+                fragments = levels.pop()
+                if node.kind is PondTuplet:
+                    melody = PondTuplet(*node.data, notes=fragments)
+                else:
+                    melody = node.kind(fragments)
+                melody.time_string = node.time_string
+                if not levels:
+                    return melody
+                levels[-1].append(melody)
+
+    def __note_path(self, idx):
+        if idx < 0:
+            idx += len(self)
+        path = []
+        node = self.root
+        while True:
+            position, item, idx = node.items.locate(idx)
+            path.append((node, position))
+            if isinstance(item, PondNote):
+                return path
+            node = item
+
+    @staticmethod
+    def __replace(path, remove, items):
+        node, position = path[-1]
+        new_node = node.with_items(node.items.splice(position, remove, items))
+        for node, position in reversed(path[:-1]):
+            new_node = node.with_items(node.items.splice(position, 1, (new_node,)))
+        return PondPersistentMelody(new_node)
+
+    def set_note(self, idx, note):
+        return self.__replace(self.__note_path(idx), 1, (copy.copy(note),))
+
+    def insert_note(self, idx, note):
+        """Inserts note before note idx, inside the same fragment, or at the end."""
+        if idx == len(self):
+            path = [(self.root, self.root.items.length)]
+        else:
+            path = self.__note_path(idx)
+        return self.__replace(path, 0, (copy.copy(note),))
+
+    def append_note(self, note):
+        return self.insert_note(len(self), note)
+
+    def delete_note(self, idx):
+        return self.__replace(self.__note_path(idx), 1, ())
+
+    def edit(self, start, stop, change, *args, **kwargs):
+        """
+        Applies change to a copy of every note from start to stop. change is the
+        name of a PondNote method, called with args and kwargs, or a function
+        called as change(note, *args, **kwargs).
+        """
+        def changed(note):
+            note = copy.copy(note)
+            if isinstance(change, str):
+                getattr(note, change)(*args, **kwargs)
+            else:
+                change(note, *args, **kwargs)
+            return note
+        if stop - start == 1:
+            path = self.__note_path(start)
+            node, position = path[-1]
+            return self.__replace(path, 1, (changed(node.items.item(position)),))
+        return PondPersistentMelody(self.root.map_notes(start, stop, changed))
+
+    def transpose(self, steps, start=0, stop=None, override_static=False):
+        stop = len(self) if stop is None else stop
+        return self.edit(start, stop, "transpose", steps, override_static=override_static)
+
+    def make_rest(self, idx):
+        return self.edit(idx, idx + 1, "make_rest")
+
+    def make_tie(self, idx, tie=True):
+        return self.edit(idx, idx + 1, "make_tie", tie)
+
+    def trill_marks(self, idx, **options):
+        return self.edit(idx, idx + 1, "trill_marks", **options)
+
+    def concat(self, other):
+        items = other.root.items
+        if items.separator != self.root.items.separator:
+            items = PondVector.build(items, self.root.items.separator)
+        return PondPersistentMelody(self.root.with_items(self.root.items.concat(items)))
+
+    def __add__(self, other):
+        return self.concat(other)
+
+    def __len__(self):
+        return self.root.count
+
+    @property
+    def written_duration(self):
+        return self.root.written_duration
+
+    @property
+    def real_duration(self):
+        return self.root.real_duration
+
+    def as_string(self):
+        for node in self.__unrendered():
+            node.as_string()
+        return self.root.as_string()
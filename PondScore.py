@@ -1,12 +1,28 @@
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
 from .PondCommand import PondAbstractCommand
-from .PondCore import PondObject
+from .PondCore import PondObject, DurationInterface, chunks_of
+from .PondMusic import (PondMelody, PondColumnMelody, PondFragment, PondPhrase, PondTuplet,
+                        PondNote, melody_substitutions)
+
+
+def render_staff(staff):
+    return ''.join(chunks_of(staff))
 
 
 class PondScore(PondAbstractCommand):
+    """
+    Staves are kept as objects and only serialized when the score is. With
+    workers set, the staves are serialized on that many processes and joined in
+    order.
+    """
 
-    def __init__(self, *subtags):
+    def __init__(self, *subtags, workers=None):
         super().__init__(*subtags)
         self.__stave = []
+        self.workers = workers
 
     @property
     def tag_name(self):
@@ -22,13 +38,39 @@ class PondScore(PondAbstractCommand):
                                  "you must use the PondStaff class")
         self.__stave.append(new_staff)
 
+    @property
+    def staves(self):
+        return tuple(self.__stave)
+
     def clear_staves(self):
         self.__stave.clear()
 
+    def render_staves(self):
+        """
+        Serializes every staff on a process pool and returns the strings in order.
+        Each staff is pickled as the argument of its task. The workers are started
+        with forkserver or spawn, since forking a process that runs other threads
+        can copy locks in a held state.
+        """
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        with ProcessPoolExecutor(self.workers, mp_context=context) as pool:
+            return list(pool.map(render_staff, self.__stave))
+
+    def iter_chunks(self):
+        yield f"\\{self.tag_name} {{\n<<"
+        staves = self.__stave
+        # Variable substitutions are not passed to worker processes.
+        if self.workers and len(staves) > 1 and melody_substitutions.get() is None:
+            staves = self.render_staves()
+        for idx, staff in enumerate(staves):
+            if idx:
+                yield ' '
+            yield from chunks_of(staff)
+        yield ">>}"
+
     def as_string(self):
-        return (f"\\{self.tag_name} {{\n" 
-                f"<<{' '.join(map(str, self.__stave))}>>"
-                f"}}")
+        return ''.join(self.iter_chunks())
 
 
 class PondKey(PondAbstractCommand):
@@ -51,14 +93,26 @@ class PondTimeSignature(PondAbstractCommand):
 
     def __init__(self, beat_number, beat_value, traditional=True):
         super().__init__()
+        if beat_number <= 0 or beat_value <= 0:
+            raise ValueError(f"Time signature values should be positive. "
+                             f"Current value: {beat_number}/{beat_value}")
         if traditional:
             self.validate_beats(beat_value)
+        self.beat_number = beat_number
+        self.beat_value = beat_value
         self.time = f"{beat_number}/{beat_value}"
 
     @property
     def tag_name(self):
         return "time"
 
+    @property
+    def bar_duration(self):
+        return Fraction(4 * self.beat_number, self.beat_value)
+
+    def split_bars(self, music, changes=None):
+        return PondBarSplitter(self, changes).split(music)
+
     @staticmethod
     def validate_beats(beat):
         power = 1
@@ -72,6 +126,139 @@ class PondTimeSignature(PondAbstractCommand):
         return f"\\{self.tag_name} {self.time}\n"
 
 
+class PondBarSplitter:
+    """
+    Cuts a stream of music into bars in a single pass. Notes crossing a barline
+    are split into tied notes, and each finished bar is yielded as a PondFragment.
+    Bars hold copies of the music, so the original notes are not attached to
+    them and do not keep every bar alive. Tuplets are kept whole.
+    The time signature changes at the bars given in changes ({bar_number: signature},
+    counting from 0), or when a PondTimeSignature is found in the stream.
+    """
+
+    def __init__(self, time_signature, changes=None, write_time=True):
+        self.changes = dict(changes or {})
+        self.write_time = write_time
+        self.time_signature = time_signature
+        self.bar_number = 0
+        self.__position = Fraction(0)
+        self.__bar = []
+        self.__time_changed = True
+
+    def change_time(self, time_signature):
+        if self.__position:
+            raise ValueError(f"Time signature {time_signature.time} can only change "
+                             f"at a barline, not inside bar {self.bar_number}")
+        self.time_signature = time_signature
+        self.__time_changed = True
+
+    def split(self, music):
+        for item in self.iter_events(music):
+            yield from self.feed(item)
+        yield from self.flush()
+
+    def feed(self, item):
+        if isinstance(item, PondTimeSignature):
+            self.change_time(item)
+            return
+        if not self.__bar and self.bar_number in self.changes:
+            self.change_time(self.changes.pop(self.bar_number))
+        bar_duration = self.time_signature.bar_duration
+        duration = item.real_duration
+        if self.__position + duration <= bar_duration:
+            self.__bar.append(copy.copy(item))
+            self.__position += duration
+            if self.__position == bar_duration:
+                yield self.__close_bar()
+            return
+        if not isinstance(item, PondNote):
+            raise ValueError(f"{type(item).__name__} of duration {duration} crosses "
+                             f"the barline of bar {self.bar_number}")
+        groups = []
+        position = self.__position
+        while duration:
+            part = min(bar_duration - position, duration)
+            groups.append(DurationInterface.get_duration_list(part))
+            duration -= part
+            position = 0
+            if self.bar_number + len(groups) in self.changes:
+                bar_duration = self.changes[self.bar_number + len(groups)].bar_duration
+        pieces = self.tied_pieces(item, [string for group in groups for string in group])
+        for group in groups:
+            for _ in group:
+                self.__bar.append(next(pieces))
+            self.__position += sum(map(DurationInterface.get_real_duration, group))
+            if self.__position == self.time_signature.bar_duration:
+                yield self.__close_bar()
+                if self.bar_number in self.changes:
+                    self.change_time(self.changes.pop(self.bar_number))
+
+    def flush(self):
+        if self.__bar:
+            yield self.__close_bar()
+
+    def __close_bar(self):
+        time_string = str(self.time_signature) if self.write_time and self.__time_changed else ""
+        bar = PondFragment(self.__bar, time_string=time_string)
+        self.__bar = []
+        self.__position = Fraction(0)
+        self.__time_changed = False
+        self.bar_number += 1
+        return bar
+
+    @staticmethod
+    def tied_pieces(note, durations):
+        last = len(durations) - 1
+        for idx, duration in enumerate(durations):
+            piece = copy.copy(note)
+            piece.duration = duration
+            if idx:
+                piece.articulation = ""
+                piece.dynamic = ""
+                piece.expressions = ""
+                piece.pre_marks = None
+                piece.post_marks = None
+            if idx != last:
+                piece.tie = "" if note.is_rest() else "~"
+            keeps_phrase_mark = ((idx == 0 and note.phrase_mark == " (") or
+                                 (idx == last and note.phrase_mark == ")"))
+            piece.phrase_mark = note.phrase_mark if keeps_phrase_mark else ""
+            yield piece
+
+    @classmethod
+    def iter_events(cls, music):
+        if isinstance(music, (PondNote, PondTuplet, PondTimeSignature)):
+            yield music
+        elif isinstance(music, PondPhrase):
+            yield from cls.__phrase_events(music)
+        elif isinstance(music, PondMelody):
+            for fragment in music.fragments:
+                yield from cls.iter_events(fragment)
+        elif isinstance(music, PondColumnMelody):
+            yield from music.iter_notes()
+        else:
+            for fragment in music:
+                yield from cls.iter_events(fragment)
+
+    @classmethod
+    def __phrase_events(cls, phrase):
+        previous = None
+        for idx, item in enumerate(cls.iter_events(phrase.fragments)):
+            if previous is not None:
+                yield previous
+            previous = cls.__phrase_mark(item, "begin") if idx == 0 else item
+        if previous is not None:
+            yield cls.__phrase_mark(previous, "end") if idx else previous
+
+    @staticmethod
+    def __phrase_mark(item, status):
+        if not isinstance(item, PondNote):
+            raise ValueError(f"Cannot place a phrase mark on {type(item).__name__}")
+        note = copy.copy(item)
+        note.phrase_data(status)
+        return note
+
+
 class PondStaff(PondObject):
 
     def __init__(self):
@@ -102,17 +289,28 @@ class PondStaff(PondObject):
     @time_signature.setter
     def time_signature(self, value):
         if isinstance(value, (PondTimeSignature, str)):
-            self.__key_signature = str(value)
+            self.__time_signature = str(value)
+
+    @property
+    def voices(self):
+        return tuple(self.__voices)
 
     def add_voice(self, voice):
-        self.__voices.append(str(voice))
+        self.__voices.append(voice if isinstance(voice, PondObject) else str(voice))
 
-    def get_voices(self):
+    def iter_voice_chunks(self):
         if len(self.__voices) > 1:
-            backslash_string = " \\\\ "
-            return f"<< {backslash_string.join(self.__voices)} >>"
+            yield "<< "
+            for idx, voice in enumerate(self.__voices):
+                if idx:
+                    yield " \\\\ "
+                yield from chunks_of(voice)
+            yield " >>"
         else:
-            return self.__voices[0]
+            yield from chunks_of(self.__voices[0])
+
+    def get_voices(self):
+        return ''.join(self.iter_voice_chunks())
 
     def add_with_command(self, key, value):
         self.with_comands[key] = value
@@ -129,15 +327,18 @@ class PondStaff(PondObject):
     def top_text(self):
         return '\n'.join(self.top_level_text)
 
+    def iter_chunks(self):
+        yield (f"\\{self.tag_name} "
+               f"{self.with_string()}"
+               f"{{\n"
+               f"{self.top_text}"
+               f"{self.key_signature}"
+               f"{self.time_signature}")
+        yield from self.iter_voice_chunks()
+        yield "\n}"
+
     def as_string(self):
-        return (f"\\{self.tag_name} "
-                f"{self.with_string()}"
-                f"{{\n"
-                f"{self.top_text}"
-                f"{self.key_signature}"
-                f"{self.time_signature}"
-                f"{self.get_voices()}\n"
-                f"}}")
+        return ''.join(self.iter_chunks())
 
 
 class PondVoice:
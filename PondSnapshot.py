@@ -0,0 +1,528 @@
+"""
+Compact binary snapshots of Pypond music trees.
+"""
+
+import mmap
+import os
+import struct
+from .PondMusic import (PondMelody, PondFragment, PondPhrase, PondTuplet, PondColumnMelody,
+                        PondNote, PondChord, PondPitch)
+from .PondScore import PondScore, PondStaff
+
+
+NOTE = 1
+CHORD = 2
+MELODY = 3
+FRAGMENT = 4
+PHRASE = 5
+TUPLET = 6
+STAFF = 7
+SCORE = 8
+TEXT = 9
+MARKED = 0x80
+
+REST = 1
+TIE = 2
+STATIC = 4
+PHRASE_BEGIN = 8
+PHRASE_END = 16
+ARTICULATION = 32
+DYNAMIC = 64
+EXPRESSION = 128
+
+header_struct = struct.Struct("<8sQ")
+note_struct = struct.Struct("<BBhI")
+container_struct = struct.Struct("<BIIQ")
+size_struct = struct.Struct("<Q")
+tuplet_struct = struct.Struct("<HHI")
+index_struct = struct.Struct("<I")
+pitch_struct = struct.Struct("<h")
+string_mark_struct = struct.Struct("<BI")
+pitch_mark_struct = struct.Struct("<Bh")
+pair_struct = struct.Struct("<II")
+pitch_pair_struct = struct.Struct("<Ih")
+
+
+class PondSnapshotWriter:
+    """
+    Writes a music tree into the snapshot format read by PondSnapshot.
+
+    The file starts with a magic string and the offset of the string table,
+    followed by the root record; the string table closes the file. Every string
+    (durations, articulations, marks...) is stored once and referenced by index.
+    A note record is a tag, a flags byte, its absolute pitch (twelve times the
+    octave for rests) and its duration, then only the strings and marks it uses.
+    A container record (melodies, staves and scores) is a tag, a string, its child
+    count and its size in bytes, so readers can skip over it without decoding it.
+    """
+    magic = b"PYPOND\x00\x01"
+    container_tags = {PondMelody: MELODY,
+                      PondFragment: FRAGMENT,
+                      PondPhrase: PHRASE,
+                      PondTuplet: TUPLET,
+                      }
+
+    def __init__(self):
+        self.buffer = bytearray(header_struct.size)
+        self.strings = {"": 0}
+
+    def string(self, value):
+        value = str(value)
+        try:
+            return self.strings[value]
+        except KeyError:
+            index = self.strings[value] = len(self.strings)
+            return index
+
+    def getvalue(self):
+        buffer = self.buffer
+        header_struct.pack_into(buffer, 0, self.magic, len(buffer))
+        buffer += index_struct.pack(len(self.strings))
+        for value in self.strings:
+            encoded = value.encode()
+            buffer += index_struct.pack(len(encoded))
+            buffer += encoded
+        return bytes(buffer)
+
+    def write(self, music):
+        """
+        Writes music and everything inside it. Open containers are kept on an
+        explicit stack, so the nesting depth is not bounded by the recursion limit.
+        """
+        stack = [(None, iter((music,)))]
+        while stack:
+            start, items = stack[-1]
+            for item in items:
+                opened = self.write_record(item)
+                if opened is not None:
+                    stack.append(opened)
+                    break
+            else:
+                stack.pop()
+                if start is not None:
+                    self.close_container(start)
+
+    def write_record(self, music):
+        """
+        Writes a note or a string, or opens the container record of anything else.
+        Returns None, or the start of the opened container and its children.
+        """
+        if isinstance(music, PondNote):
+            self.write_note(music)
+        elif isinstance(music, PondMelody):
+            return self.open_melody(music)
+        elif isinstance(music, PondColumnMelody):
+            return self.open_column_melody(music)
+        elif isinstance(music, PondStaff):
+            return self.open_staff(music)
+        elif isinstance(music, PondScore):
+            return self.open_score(music)
+        else:
+            self.buffer += string_mark_struct.pack(TEXT, self.string(music))
+        return None
+
+    def write_note(self, note):
+        buffer = self.buffer
+        flags = 0
+        pitch = note.pitch
+        if pitch.pitch == -1:
+            flags |= REST
+            absolute_int = pitch.octave * 12
+        else:
+            absolute_int = pitch.absolute_int
+        if note.tie:
+            flags |= TIE
+        if note.static:
+            flags |= STATIC
+        if note.phrase_mark == " (":
+            flags |= PHRASE_BEGIN
+        elif note.phrase_mark == ")":
+            flags |= PHRASE_END
+        if note.articulation:
+            flags |= ARTICULATION
+        if note.dynamic:
+            flags |= DYNAMIC
+        if note.expressions:
+            flags |= EXPRESSION
+        tag = CHORD if isinstance(note, PondChord) else NOTE
+        marked = note.has_marks()
+        if marked:
+            tag |= MARKED
+        buffer += note_struct.pack(tag, flags, absolute_int, self.string(note.duration))
+        if note.articulation:
+            buffer += index_struct.pack(self.string(note.articulation))
+        if note.dynamic:
+            buffer += index_struct.pack(self.string(note.dynamic))
+        if note.expressions:
+            buffer += index_struct.pack(self.string(note.expressions))
+        if tag & ~MARKED == CHORD:
+            buffer += index_struct.pack(len(note.pitches))
+            buffer += struct.pack(f"<{len(note.pitches)}h",
+                                  *(pitch.absolute_int for pitch in note.pitches))
+        if marked:
+            self.write_marks(note._pre_marks or ())
+            self.write_marks(note._post_marks or ())
+            auxiliary_pitches = note._auxiliary_pitches or {}
+            buffer += index_struct.pack(len(auxiliary_pitches))
+            for key, pitch in auxiliary_pitches.items():
+                buffer += pitch_pair_struct.pack(self.string(key), pitch.absolute_int)
+
+    def write_marks(self, marks):
+        buffer = self.buffer
+        buffer += index_struct.pack(len(marks))
+        for mark in marks:
+            if isinstance(mark, PondPitch):
+                buffer += pitch_mark_struct.pack(1, mark.absolute_int)
+            else:
+                buffer += string_mark_struct.pack(0, self.string(mark))
+
+    def open_container(self, tag, string, count):
+        start = len(self.buffer)
+        self.buffer += container_struct.pack(tag, self.string(string), count, 0)
+        return start
+
+    def close_container(self, start):
+        size = len(self.buffer) - start - container_struct.size
+        size_struct.pack_into(self.buffer, start + container_struct.size - size_struct.size, size)
+
+    def open_melody(self, melody):
+        tag = self.container_tags.get(type(melody))
+        if tag is None:
+            tag = next(tag for klass, tag in reversed(self.container_tags.items())
+                       if isinstance(melody, klass))
+        start = self.open_container(tag, melody.time_string, len(melody.fragments))
+        if tag == TUPLET:
+            num, den, group_duration = melody.data
+            self.buffer += tuplet_struct.pack(num, den, self.string(group_duration))
+        return start, iter(melody.fragments)
+
+    def open_column_melody(self, melody):
+        start = self.open_container(MELODY, melody.time_string, len(melody))
+        return start, melody.iter_notes()
+
+    def open_staff(self, staff):
+        buffer = self.buffer
+        start = self.open_container(STAFF, staff.key_signature, len(staff.voices))
+        buffer += index_struct.pack(self.string(staff.time_signature))
+        buffer += index_struct.pack(len(staff.top_level_text))
+        for text in staff.top_level_text:
+            buffer += index_struct.pack(self.string(text))
+        buffer += index_struct.pack(len(staff.with_comands))
+        for command, parameter in staff.with_comands.items():
+            buffer += pair_struct.pack(self.string(command), self.string(parameter))
+        return start, iter(staff.voices)
+
+    def open_score(self, score):
+        start = self.open_container(SCORE, score.subcommands, len(score.staves))
+        return start, iter(score.staves)
+
+
+class PondSnapshot:
+    """
+    Reader for the snapshot format written by PondSnapshotWriter. open() maps the
+    file into memory: containers are returned as PondSnapshotNode handles and only
+    the children that are accessed are decoded. load() builds the whole tree.
+    Column melodies are read back as PondMelody.
+    """
+
+    def __init__(self, data):
+        self.__data = data
+        if len(data) < header_struct.size:
+            raise ValueError(f"Snapshot is truncated: {len(data)} bytes is shorter than "
+                             f"the {header_struct.size} byte header")
+        magic, strings_offset = header_struct.unpack_from(data, 0)
+        if magic != PondSnapshotWriter.magic:
+            raise ValueError("Data is not a Pypond snapshot")
+        try:
+            self.strings = self.__read_strings(strings_offset)
+        except struct.error:
+            raise ValueError(f"Snapshot is truncated: its string table at byte "
+                             f"{strings_offset} does not fit in {len(data)} bytes") from None
+
+    @classmethod
+    def dumps(cls, music):
+        writer = PondSnapshotWriter()
+        writer.write(music)
+        return writer.getvalue()
+
+    @classmethod
+    def dump(cls, music, path):
+        with open(path, 'wb') as file:
+            file.write(cls.dumps(music))
+
+    @classmethod
+    def loads(cls, data):
+        return cls(data).load()
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as file:
+            # mmap cannot map an empty file, so check the size first.
+            size = os.fstat(file.fileno()).st_size
+            if size < header_struct.size:
+                raise ValueError(f"Snapshot {path} is empty or truncated: {size} bytes")
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(data)
+        except ValueError:
+            data.close()
+            raise
+
+    def close(self):
+        if isinstance(self.__data, mmap.mmap):
+            self.__data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __read_strings(self, offset):
+        data = self.__data
+        count, = index_struct.unpack_from(data, offset)
+        offset += index_struct.size
+        strings = []
+        for _ in range(count):
+            length, = index_struct.unpack_from(data, offset)
+            offset += index_struct.size
+            if offset + length > len(data):
+                raise ValueError(f"Snapshot is truncated: string {len(strings)} ends past "
+                                 f"byte {len(data)}")
+            strings.append(bytes(data[offset:offset + length]).decode())
+            offset += length
+        return strings
+
+    @property
+    def root(self):
+        return self.node(header_struct.size)
+
+    def load(self):
+        return self.read(header_struct.size)[0]
+
+    def node(self, offset):
+        if self.__data[offset] & ~MARKED in (NOTE, CHORD, TEXT):
+            return self.read(offset)[0]
+        return PondSnapshotNode(self, offset)
+
+    def read(self, offset):
+        """
+        Returns the object stored at offset and the offset of the next record.
+        Open containers are kept on an explicit stack, so the nesting depth is not
+        bounded by the recursion limit.
+        """
+        data = self.__data
+        # Each open container is (tag, string, data, end, count, children).
+        stack = []
+        while True:
+            tag = data[offset] & ~MARKED
+            if tag in (NOTE, CHORD):
+                item, offset = self.read_note(offset)
+            elif tag == TEXT:
+                tag, index = string_mark_struct.unpack_from(data, offset)
+                item, offset = self.strings[index], offset + string_mark_struct.size
+            else:
+                tag, string, count, size = container_struct.unpack_from(data, offset)
+                end = offset + container_struct.size + size
+                offset, extra = self.container_data(tag, offset)
+                if count:
+                    stack.append((tag, self.strings[string], extra, end, count, []))
+                    continue
+                item, offset = self.build_container(tag, self.strings[string], extra, []), end
+            # Add the item to its container, and build the containers it completes.
+            while stack:
+                children = stack[-1][-1]
+                children.append(item)
+                if len(children) < stack[-1][4]:
+                    break
+                tag, string, extra, end, count, children = stack.pop()
+                item, offset = self.build_container(tag, string, extra, children), end
+            else:
+                return item, offset
+
+    @staticmethod
+    def build_container(tag, string, data, children):
+        if tag == TUPLET:
+            tuplet = PondTuplet(*data, children)
+            tuplet.time_string = string
+            return tuplet
+        if tag == STAFF:
+            staff = PondStaff()
+            staff.key_signature = string
+            staff.time_signature, staff.top_level_text, staff.with_comands = data
+            for voice in children:
+                staff.add_voice(voice)
+            return staff
+        if tag == SCORE:
+            score = PondScore(string) if string else PondScore()
+            for staff in children:
+                score.add_staff(staff)
+            return score
+        klass = {MELODY: PondMelody, FRAGMENT: PondFragment, PHRASE: PondPhrase}[tag]
+        return klass(children, time_string=string)
+
+    def container_header(self, offset):
+        tag, string, count, size = container_struct.unpack_from(self.__data, offset)
+        return tag, self.strings[string], count
+
+    def container_data(self, tag, offset):
+        """
+        Reads the extra header of a container. Returns the offset of its first
+        child and the data read.
+        """
+        data = self.__data
+        strings = self.strings
+        offset += container_struct.size
+        if tag == TUPLET:
+            num, den, group_duration = tuplet_struct.unpack_from(data, offset)
+            group_duration = strings[group_duration]
+            if group_duration.isdigit():
+                group_duration = int(group_duration)
+            return offset + tuplet_struct.size, (num, den, group_duration)
+        if tag == STAFF:
+            time_signature, count = struct.unpack_from("<II", data, offset)
+            offset += 2 * index_struct.size
+            top_level_text = [strings[index] for index
+                              in struct.unpack_from(f"<{count}I", data, offset)]
+            offset += count * index_struct.size
+            count, = index_struct.unpack_from(data, offset)
+            offset += index_struct.size
+            with_commands = {}
+            for _ in range(count):
+                command, parameter = pair_struct.unpack_from(data, offset)
+                with_commands[strings[command]] = strings[parameter]
+                offset += pair_struct.size
+            return offset, (strings[time_signature], top_level_text, with_commands)
+        return offset, None
+
+    def read_note(self, offset):
+        data = self.__data
+        strings = self.strings
+        tag, flags, absolute_int, duration = note_struct.unpack_from(data, offset)
+        offset += note_struct.size
+        duration = strings[duration]
+        articulation = dynamic = expression = ""
+        if flags & ARTICULATION:
+            articulation = strings[index_struct.unpack_from(data, offset)[0]]
+            offset += index_struct.size
+        if flags & DYNAMIC:
+            dynamic = strings[index_struct.unpack_from(data, offset)[0]]
+            offset += index_struct.size
+        if flags & EXPRESSION:
+            expression = strings[index_struct.unpack_from(data, offset)[0]]
+            offset += index_struct.size
+        tie = bool(flags & TIE)
+        if tag & ~MARKED == CHORD:
+            count, = index_struct.unpack_from(data, offset)
+            offset += index_struct.size
+            pitches = [PondPitch.from_absolute_int(pitch) for pitch
+                       in struct.unpack_from(f"<{count}h", data, offset)]
+            offset += count * pitch_struct.size
+            note = PondChord(pitches, duration, articulation, dynamic, 0, tie, expression)
+        elif flags & REST:
+            note = PondNote(PondPitch.rest(absolute_int // 12), duration, articulation,
+                            dynamic, 0, tie, expression)
+        else:
+            note = PondNote(PondPitch.from_absolute_int(absolute_int), duration, articulation,
+                            dynamic, 0, tie, expression)
+        note.static = bool(flags & STATIC)
+        if flags & PHRASE_BEGIN:
+            note.phrase_data("begin")
+        elif flags & PHRASE_END:
+            note.phrase_data("end")
+        if tag & MARKED:
+            pre_marks, offset = self.read_marks(offset)
+            post_marks, offset = self.read_marks(offset)
+            count, = index_struct.unpack_from(data, offset)
+            offset += index_struct.size
+            auxiliary_pitches = {}
+            for _ in range(count):
+                key, pitch = pitch_pair_struct.unpack_from(data, offset)
+                auxiliary_pitches[strings[key]] = PondPitch.from_absolute_int(pitch)
+                offset += pitch_pair_struct.size
+            note._pre_marks = pre_marks or None
+            note._post_marks = post_marks or None
+            note._auxiliary_pitches = auxiliary_pitches or None
+        return note, offset
+
+    def read_marks(self, offset):
+        data = self.__data
+        count, = index_struct.unpack_from(data, offset)
+        offset += index_struct.size
+        marks = []
+        for _ in range(count):
+            if data[offset]:
+                marks.append(PondPitch.from_absolute_int(pitch_mark_struct.unpack_from(data, offset)[1]))
+                offset += pitch_mark_struct.size
+            else:
+                marks.append(self.strings[string_mark_struct.unpack_from(data, offset)[1]])
+                offset += string_mark_struct.size
+        return marks, offset
+
+    def skip(self, offset):
+        """
+        Returns the offset of the record after the one at offset, without decoding it.
+        """
+        data = self.__data
+        tag = data[offset] & ~MARKED
+        if tag == TEXT:
+            return offset + string_mark_struct.size
+        if tag not in (NOTE, CHORD):
+            return offset + container_struct.size + size_struct.unpack_from(
+                data, offset + container_struct.size - size_struct.size)[0]
+        flags = data[offset + 1]
+        marked = data[offset] & MARKED
+        offset += note_struct.size
+        offset += index_struct.size * bin(flags & (ARTICULATION | DYNAMIC | EXPRESSION)).count("1")
+        if tag == CHORD:
+            offset += index_struct.size + index_struct.unpack_from(data, offset)[0] * pitch_struct.size
+        if marked:
+            for _ in range(2):
+                count, = index_struct.unpack_from(data, offset)
+                offset += index_struct.size
+                for _ in range(count):
+                    offset += pitch_mark_struct.size if data[offset] else string_mark_struct.size
+            offset += index_struct.size + index_struct.unpack_from(data, offset)[0] * pitch_pair_struct.size
+        return offset
+
+
+class PondSnapshotNode:
+    """
+    Handle on a container stored in a PondSnapshot. Indexing returns notes, or
+    other handles for nested containers; nothing else is decoded. materialize()
+    builds the container with all its contents.
+    """
+
+    def __init__(self, snapshot, offset):
+        self.snapshot = snapshot
+        self.offset = offset
+        self.tag, self.string, self.count = snapshot.container_header(offset)
+        self.__children = None
+
+    @property
+    def kind(self):
+        return {MELODY: "melody", FRAGMENT: "fragment", PHRASE: "phrase", TUPLET: "tuplet",
+                STAFF: "staff", SCORE: "score"}[self.tag]
+
+    def child_offsets(self):
+        if self.__children is None:
+            offset, data = self.snapshot.container_data(self.tag, self.offset)
+            children = []
+            for _ in range(self.count):
+                children.append(offset)
+                offset = self.snapshot.skip(offset)
+            self.__children = children
+        return self.__children
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        return self.snapshot.node(self.child_offsets()[idx])
+
+    def __iter__(self):
+        for offset in self.child_offsets():
+            yield self.snapshot.node(offset)
+
+    def materialize(self):
+        return self.snapshot.read(self.offset)[0]
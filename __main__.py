@@ -0,0 +1,236 @@
+"""
+Command line batch renderer. Reads one JSON job per line from a file or stdin,
+renders the jobs in parallel and writes one JSON result per line:
+    python -m pypond jobs.ndjson --workers 4 > results.ndjson
+A job is either {"ly": "<lilypond code>"} or a score description:
+    {"id": "intro", "title": "Intro", "staves": [
+        {"key": "d", "mode": "minor", "time": "3/4", "split_bars": true,
+         "notes": [2, "f'", null, [2, 5, 9], {"pitch": 4, "articulation": "-."}],
+         "durations": ["4", "8", "8", "2", "4"]}]}
+A job without "staves" describes a single staff. Notes are absolute integers,
+note names, null for rests, lists for chords, or objects with pitch, duration,
+articulation, dynamic and tie.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+from .PondCommand import PondHeader
+from .PondFile import PondDoc, PondRender, PondRenderCache, PondRenderStats
+from .PondMusic import PondMelody, PondNote, PondChord
+from .PondParser import PondParser
+from .PondScore import PondScore, PondStaff, PondKey, PondTimeSignature, PondBarSplitter
+
+
+NOTE_OPTIONS = {"pitch", "duration", "articulation", "dynamic", "tie"}
+
+
+def parse_pitch(value):
+    if isinstance(value, str):
+        match = PondParser.chord_pitch_pattern.fullmatch(value)
+        if match is None:
+            raise ValueError(f"Invalid pitch {value!r}")
+        return PondParser.parse_pitch(*match.groups())
+    return value
+
+
+def build_note(value, duration="4"):
+    if value is None:
+        return PondNote.create_rest(duration)
+    if isinstance(value, list):
+        return PondChord([parse_pitch(pitch) for pitch in value], duration)
+    if isinstance(value, dict):
+        unknown = set(value) - NOTE_OPTIONS
+        if unknown:
+            raise ValueError(f"Unknown note options: {', '.join(sorted(unknown))}")
+        note = build_note(value.get("pitch"), str(value.get("duration", duration)))
+        note.articulation = value.get("articulation", "")
+        note.dynamic = value.get("dynamic", "")
+        note.make_tie(value.get("tie", False))
+        return note
+    return PondNote(parse_pitch(value), duration)
+
+
+def build_melody(spec):
+    notes = spec.get("notes", [])
+    durations = spec.get("durations")
+    if durations is None:
+        durations = [spec.get("duration", "4")] * len(notes)
+    elif len(durations) != len(notes):
+        raise ValueError(f"Got {len(durations)} durations for {len(notes)} notes")
+    return PondMelody([build_note(note, str(duration)) for note, duration in zip(notes, durations)])
+
+
+def build_staff(spec):
+    staff = PondStaff()
+    if "key" in spec:
+        mode = PondKey.minor if spec.get("mode") == "minor" else PondKey.major
+        staff.key_signature = PondKey(spec["key"], mode)
+    time_signature = None
+    if "time" in spec:
+        time_signature = PondTimeSignature(*map(int, spec["time"].split("/")))
+        staff.time_signature = time_signature
+    for voice in spec.get("voices", [spec]):
+        melody = build_melody(voice)
+        if time_signature is not None and spec.get("split_bars"):
+            melody = PondMelody(PondBarSplitter(time_signature, write_time=False).split(melody))
+        staff.add_voice(melody)
+    return staff
+
+
+def build_document(spec):
+    if not isinstance(spec, dict):
+        raise ValueError("A job must be a JSON object")
+    if "ly" in spec:
+        return str(spec["ly"])
+    document = PondDoc()
+    if "title" in spec:
+        document.header = PondHeader(title=json.dumps(spec["title"]))
+    else:
+        document.header = PondHeader()
+    score = PondScore()
+    for staff in spec.get("staves", [spec]):
+        score.add_staff(build_staff(staff))
+    document.score = score
+    return document
+
+
+async def run_in_daemon_thread(function, *args):
+    """
+    Like asyncio.to_thread, but the thread is a daemon: a call given up after a
+    timeout that never returns does not keep the process from exiting.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(method, value):
+        if not future.done():
+            method(value)
+
+    def run():
+        try:
+            result = function(*args)
+        except BaseException as error:
+            outcome = (future.set_exception, error)
+        else:
+            outcome = (future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(settle, *outcome)
+        except RuntimeError:
+            # The loop was closed while the call was running.
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return await future
+
+
+async def render_job(render, line_number, line, timeout=None, log=False):
+    result = {"line": line_number, "id": line_number}
+    try:
+        spec = json.loads(line)
+        if isinstance(spec, dict):
+            result["id"] = spec.get("id", line_number)
+        try:
+            document = await asyncio.wait_for(run_in_daemon_thread(build_document, spec),
+                                              timeout)
+        except asyncio.TimeoutError:
+            result["error"] = f"Building the job timed out after {timeout} seconds"
+            return result
+        render_result = await render.render_async(document, timeout)
+    except asyncio.TimeoutError:
+        result["error"] = f"Timed out after {timeout} seconds"
+    except Exception as error:
+        # Anything a bad job raises, or a missing lilypond, only fails this job.
+        result["error"] = f"{type(error).__name__}: {error}"
+    else:
+        result.update(source=render_result.source, output=render_result.output,
+                      returncode=render_result.returncode,
+                      warnings=PondRenderStats.warning_pattern.findall(render_result.log),
+                      errors=PondRenderStats.error_pattern.findall(render_result.log))
+        if log:
+            result["log"] = render_result.log
+    return result
+
+
+async def run_jobs(input_file, output_file, render, workers=4, timeout=None, log=False):
+    """
+    Reads jobs one line at a time and keeps at most twice workers jobs in flight,
+    so the job file never has to fit in memory. Results are written in the order
+    the jobs finish. Returns the number of failed jobs.
+    """
+    failed = 0
+    pending = set()
+
+    def emit(done):
+        nonlocal failed
+        for task in done:
+            result = task.result()
+            if "error" in result or result["returncode"] != 0:
+                failed += 1
+            output_file.write(json.dumps(result) + "\n")
+        output_file.flush()
+
+    line_number = 0
+    while True:
+        line = await asyncio.to_thread(input_file.readline)
+        if not line:
+            break
+        line_number += 1
+        if not line.strip():
+            continue
+        if len(pending) >= 2 * workers:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            emit(done)
+        pending.add(asyncio.ensure_future(render_job(render, line_number, line, timeout, log)))
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        emit(done)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pypond",
+                                     description="Render NDJSON job descriptions with Lilypond")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="NDJSON file with one job per line, '-' for stdin")
+    parser.add_argument("-o", "--output", default="-",
+                        help="file for the NDJSON results, '-' for stdout")
+    parser.add_argument("-j", "--workers", type=int, default=4,
+                        help="number of Lilypond processes running at once")
+    parser.add_argument("--folder", default="ly_files", help="folder for .ly and output files")
+    parser.add_argument("--format", default="png", help="Lilypond output format")
+    parser.add_argument("--resolution", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds allowed to build a job, and to run Lilypond on it")
+    parser.add_argument("--cache", default=None, help="folder for a render cache")
+    parser.add_argument("--log", action="store_true", help="include Lilypond's log in results")
+    parser.add_argument("--stats", action="store_true", help="print render stats to stderr")
+    args = parser.parse_args(argv)
+
+    render = PondRender(folder_path=args.folder, format=args.format,
+                        resolution=args.resolution, max_concurrency=args.workers)
+    if args.cache is not None:
+        render.set_config(cache=PondRenderCache(args.cache))
+    stats = PondRenderStats() if args.stats else None
+    render.set_config(stats=stats)
+    os.makedirs(args.folder, exist_ok=True)
+    input_file = sys.stdin if args.input == "-" else open(args.input, 'rt')
+    output_file = sys.stdout if args.output == "-" else open(args.output, 'wt')
+    try:
+        failed = asyncio.run(run_jobs(input_file, output_file, render, args.workers,
+                                      args.timeout, args.log))
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    if stats is not None:
+        print(stats, file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
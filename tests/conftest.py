@@ -0,0 +1,65 @@
+import importlib
+import importlib.machinery
+import importlib.util
+import os
+import stat
+import sys
+import pytest
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_PATH = os.path.dirname(TESTS_PATH)
+FAKE_LILYPOND = os.path.join(TESTS_PATH, "fake_lilypond.py")
+
+# The repository folder is the pypond package, whatever the folder is called.
+try:
+    importlib.import_module("pypond.PondCore")
+except ImportError:
+    spec = importlib.machinery.ModuleSpec("pypond", None, is_package=True)
+    spec.submodule_search_locations = [PACKAGE_PATH]
+    sys.modules["pypond"] = importlib.util.module_from_spec(spec)
+
+
+def command_folder(tmp_path, monkeypatch, keep_path):
+    folder = tmp_path / "bin"
+    folder.mkdir()
+    path = str(folder) + (os.pathsep + os.environ["PATH"] if keep_path else "")
+    monkeypatch.setenv("PATH", path)
+    return folder
+
+
+@pytest.fixture
+def fake_lilypond(tmp_path, monkeypatch):
+    """Puts a lilypond command that runs fake_lilypond.py first on PATH."""
+    command = command_folder(tmp_path, monkeypatch, True) / "lilypond"
+    command.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_LILYPOND}" "$@"\n')
+    command.chmod(command.stat().st_mode | stat.S_IEXEC)
+    return command
+
+
+@pytest.fixture
+def missing_lilypond(tmp_path, monkeypatch):
+    """Leaves only an empty folder on PATH, so lilypond cannot be found."""
+    return command_folder(tmp_path, monkeypatch, False)
+
+
+@pytest.fixture
+def worker_command():
+    return [sys.executable, FAKE_LILYPOND, "--worker"]
+
+
+@pytest.fixture
+def ly_folder(tmp_path):
+    folder = tmp_path / "ly_files"
+    folder.mkdir()
+    return str(folder)
+
+
+@pytest.fixture
+def importable_package(tmp_path, monkeypatch):
+    """Lets worker processes import the package as pypond."""
+    folder = tmp_path / "lib"
+    folder.mkdir()
+    (folder / "pypond").symlink_to(PACKAGE_PATH, target_is_directory=True)
+    # Spawned and forkserver processes start from the parent's sys.path.
+    monkeypatch.syspath_prepend(str(folder))
+    return folder
@@ -0,0 +1,61 @@
+"""
+Stand-in for the lilypond executable, used by the tests.
+
+Called like lilypond, it writes the source text to <output>.<format> and exits
+with 0, or prints an error and exits with 1 when the source contains FAIL.
+With --worker it follows the line protocol of PondRenderWorker instead: each
+"<file>\t<folder>" line is rendered into folder and answered with
+"pypond-job-done <status>". A source containing CRASH makes the worker exit,
+and one containing HANG makes either mode wait until it is killed.
+"""
+
+import os
+import sys
+import time
+
+
+def render(source, output_base, output_format):
+    with open(source) as file:
+        text = file.read()
+    print(f"Processing `{source}'")
+    if "HANG" in text:
+        sys.stdout.flush()
+        time.sleep(3600)
+    if "CRASH" in text:
+        sys.exit(3)
+    if "FAIL" in text:
+        print(f"{source}:1:1: error: failure requested")
+        return 1
+    with open(f"{output_base}.{output_format}", 'wt') as file:
+        file.write(text)
+    print(f"{source}:1:1: warning: fake warning")
+    return 0
+
+
+def run_command(arguments):
+    output, output_format, source = ".", "pdf", None
+    for argument in arguments:
+        if argument.startswith("-o"):
+            output = argument[2:]
+        elif argument.startswith("-f"):
+            output_format = argument[2:]
+        elif not argument.startswith("-"):
+            source = argument
+    if os.path.isdir(output):
+        output = os.path.join(output, os.path.splitext(os.path.basename(source))[0])
+    return render(source, output, output_format)
+
+
+def run_worker():
+    for line in sys.stdin:
+        source, folder = line.rstrip("\n").split("\t")
+        output = os.path.join(folder, os.path.splitext(os.path.basename(source))[0])
+        status = render(source, output, "png")
+        print(f"pypond-job-done {status}", flush=True)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--worker"]:
+        run_worker()
+    else:
+        sys.exit(run_command(sys.argv[1:]))
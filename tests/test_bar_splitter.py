@@ -0,0 +1,23 @@
+from pypond.PondMusic import PondMelody, PondNote, PondTuplet
+from pypond.PondScore import PondTimeSignature
+
+
+def test_bars_are_not_attached_to_the_original_notes():
+    melody = PondMelody([PondNote(pitch, "4") for pitch in range(8)] +
+                        [PondTuplet(3, 2, 4, [PondNote(0, "8") for _ in range(3)]),
+                         PondNote(0, "2.")])
+    bars = list(PondTimeSignature(4, 4).split_bars(melody))
+    assert [str(bar) for bar in bars] == ["\\time 4/4\nc4 cis4 d4 dis4", "e4 f4 fis4 g4",
+                                          "\\tuplet 3/2 4 {c8 c8 c8} c2."]
+    tuplet = melody.fragments[8]
+    assert all(note._parents == [melody] for note in melody.fragments)
+    assert all(note._parents == [tuplet] for note in tuplet.fragments)
+
+
+def test_bars_do_not_change_with_the_original_tuplet():
+    tuplet = PondTuplet(3, 2, 4, [PondNote(0, "8"), PondNote(2, "8"), PondNote(4, "8")])
+    melody = PondMelody([PondNote(0, "4"), tuplet])
+    bar = next(PondTimeSignature(2, 4).split_bars(melody))
+    tuplet.fragments[0].pitch = tuplet.fragments[0].pitch.transpose(1)
+    assert str(bar) == "\\time 2/4\nc4 \\tuplet 3/2 4 {c8 d8 e8}"
+    assert bar.real_duration == 2
@@ -0,0 +1,33 @@
+from pypond.PondBenchmark import check_baseline, missing_baseline
+
+BASELINE = {"calibration": 0.1,
+            "100k": {"as_string": {"seconds": 1.0, "peak_bytes": 8000000}}}
+
+
+def report(seconds, peak_bytes=8000000):
+    return {"100k": {"as_string": {"seconds": seconds, "peak_bytes": peak_bytes}}}
+
+
+def test_times_are_compared_relative_to_the_calibration():
+    # Twice as slow on a machine that is twice as slow is no regression.
+    assert check_baseline(report(2.0), BASELINE, calibration=0.2) == []
+    assert check_baseline(report(2.0), BASELINE, calibration=0.1) == [
+        ("100k", "as_string", "seconds", 1.0)]
+
+
+def test_memory_is_compared_directly():
+    assert check_baseline(report(1.0, 12000000), BASELINE, calibration=0.2) == [
+        ("100k", "as_string", "peak_bytes", 8000000)]
+
+
+def test_small_differences_are_noise():
+    baseline = {"calibration": 0.1, "1k": {"transpose": {"seconds": 0.002, "peak_bytes": 2000}}}
+    result = {"1k": {"transpose": {"seconds": 0.006, "peak_bytes": 60000}}}
+    assert check_baseline(result, baseline, calibration=0.1) == []
+
+
+def test_sizes_without_a_baseline_are_reported():
+    result = dict(report(1.0), **{"1M": {"as_string": {"seconds": 10.0, "peak_bytes": 0}}})
+    assert check_baseline(result, BASELINE, calibration=0.1) == []
+    assert missing_baseline(result, BASELINE) == [("1M", "as_string")]
+    assert missing_baseline(report(1.0), BASELINE) == []
@@ -0,0 +1,24 @@
+import pytest
+from pypond.PondMusic import PondColumnMelody, PondMelody, PondNote
+
+
+def test_column_melody_renders_like_melody():
+    notes = [PondNote(pitch, duration) for pitch, duration in ((0, "4"), (14, "8."), (-13, "2"))]
+    assert str(PondColumnMelody(notes)) == str(PondMelody(notes))
+
+
+def test_get_note_returns_a_copy():
+    melody = PondColumnMelody([PondNote(0, "4")])
+    melody.get_note(0).transpose(2)
+    assert str(melody.get_note(0)) == str(PondNote(0, "4"))
+
+
+def test_transpose_out_of_octave_range_leaves_melody_unchanged():
+    melody = PondColumnMelody([PondNote(0, "4"), PondNote(7, "4")])
+    text = str(melody)
+    with pytest.raises(ValueError):
+        melody.transpose(12 * 200)
+    assert str(melody) == text
+    with pytest.raises(ValueError):
+        melody.append_note(0, octave=200)
+    assert len(melody) == 2
@@ -0,0 +1,88 @@
+import re
+from pypond.PondFile import PondDoc
+from pypond.PondMusic import PondMelody, PondNote, PondTuplet
+from pypond.PondScore import PondScore, PondStaff
+
+DEFINITION = re.compile(r"^(pypond[A-Z]+) = ", re.MULTILINE)
+REFERENCE = re.compile(r"\\(pypond[A-Z]+)(?![A-Za-z])")
+
+
+def bar(start=0, length=16):
+    return PondMelody([PondNote(start + step % 12, "16") for step in range(length)])
+
+
+def document(*voices):
+    score = PondScore()
+    for voice in voices:
+        staff = PondStaff()
+        staff.add_voice(voice)
+        score.add_staff(staff)
+    doc = PondDoc()
+    doc.score = score
+    return doc
+
+
+def definitions(text):
+    """
+    Splits a deduplicated file into its variables and the code after them.
+    """
+    parts = DEFINITION.split(text[:text.index("\\score")])
+    variables = dict(zip(parts[1::2], (value.strip() for value in parts[2::2])))
+    return variables, text[text.index("\\score"):]
+
+
+def expand(text):
+    variables, score = definitions(text)
+    while REFERENCE.search(score):
+        score = REFERENCE.sub(lambda match: variables[match.group(1)], score)
+    return score
+
+
+def music(text):
+    # Commands and notes in order. Variables of tuplets add a pair of braces.
+    return re.findall(r"\\[A-Za-z]+|[^\s{}]+", text)
+
+
+def test_deduplicated_file_has_the_same_music():
+    def phrase():
+        return PondMelody([bar(), bar(2), PondTuplet(3, 2, 4, [PondNote(pitch, "8")
+                                                              for pitch in (0, 2, 4)])])
+    doc = document(PondMelody([phrase(), phrase(), bar()]), PondMelody([phrase(), bar(5)]))
+    doc.min_repeat_bytes = 16
+    plain = doc.create_file()
+    doc.deduplicate = True
+    text = doc.create_file()
+    assert len(doc.plan_variables()[0]) > 1
+    assert len(text) < len(plain)
+    assert music(expand(text)) == music(plain[plain.index("\\score"):])
+
+
+def test_identical_subtrees_become_one_variable():
+    doc = document(PondMelody([bar() for _ in range(4)]), PondMelody([bar(), bar(7)]))
+    doc.deduplicate = True
+    variables, substitutions = doc.plan_variables()
+    assert len(variables) == 1
+    name, melody = variables[0]
+    assert melody.as_string() == bar().as_string()
+    text = doc.create_file()
+    assert list(definitions(text)[0]) == [name]
+    assert len(REFERENCE.findall(text)) == 5
+    assert doc.deduplication_report()["variables"] == 1
+
+
+def test_variable_names_do_not_collide():
+    # 30 different bars, each written twice, need names past pypondZ.
+    doc = document(PondMelody([bar(start, 20) for start in range(30)] * 2))
+    doc.add_function("pypondA", "{ c4 }")
+    doc.add_function("pypondC", "{ d4 }")
+    doc.deduplicate = True
+    names = [name for name, melody in doc.plan_variables()[0]]
+    assert len(names) == 30
+    assert len(set(names)) == 30
+    assert not {"pypondA", "pypondC"} & set(names)
+    assert "pypondAB" in names
+    text = doc.create_file()
+    assert sorted(DEFINITION.findall(text)) == sorted(names + ["pypondA", "pypondC"])
+    doc.deduplicate = False
+    plain = doc.create_file()
+    assert music(expand(text)) == music(plain[plain.index("\\score"):])
@@ -0,0 +1,55 @@
+import io
+import tracemalloc
+from pypond.PondMusic import PondMelody, PondNote, PondTuplet
+
+DEPTH = 20000
+
+
+def nested(depth=DEPTH):
+    note = PondNote(0, "4")
+    melody = PondMelody([note])
+    for _ in range(depth):
+        melody = PondMelody([melody])
+    return melody, note
+
+
+def expected(depth=DEPTH, note="c4"):
+    return "{" * (depth + 1) + note + "}\n" * (depth + 1)
+
+
+def test_deep_melodies_render_in_linear_memory():
+    melody, note = nested()
+    tracemalloc.start()
+    try:
+        text = str(melody)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert text == expected()
+    # Caching the whole string at every level would take about 600 MB here.
+    assert peak < 20 * 1024 * 1024
+
+
+def test_deep_melodies_render_again_after_a_change():
+    melody, note = nested()
+    str(melody)
+    note.duration = "2"
+    assert str(melody) == expected(note="c2")
+    fp = io.StringIO()
+    melody.write_to(fp)
+    assert fp.getvalue() == expected(note="c2")
+
+
+def test_deep_melodies_keep_their_durations_and_notes():
+    melody, note = nested()
+    tuplet = PondTuplet(3, 2, 4, [PondNote(0, "8") for _ in range(3)])
+    note.duration = "2"
+    inner = melody
+    for _ in range(DEPTH):
+        inner = inner.fragments[0]
+    inner.append_fragment(tuplet)
+    assert melody.real_duration == 3
+    assert len(melody) == 4
+    melody.transpose(2)
+    assert str(melody.get_note(3)) == "d8"
+
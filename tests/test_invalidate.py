@@ -0,0 +1,68 @@
+from fractions import Fraction
+import pytest
+from pypond.PondMusic import PondFragment, PondMelody, PondNote, PondTuplet
+
+
+def shared_tree(levels, copies):
+    bar = PondMelody([PondNote(0, "4") for _ in range(4)])
+    root = bar
+    for _ in range(levels):
+        root = PondFragment([root] * copies)
+    return bar, root
+
+
+@pytest.fixture
+def cleared(monkeypatch):
+    """Melodies visited by invalidate, in the order of their clear_cache calls."""
+    calls = []
+    clear_cache = PondMelody.clear_cache
+
+    def counting(self, timing=True):
+        calls.append(self)
+        return clear_cache(self, timing)
+    monkeypatch.setattr(PondMelody, "clear_cache", counting)
+    return calls
+
+
+def test_shared_subtree_changes_reach_every_parent():
+    bar = PondMelody([PondNote(0, "4"), PondNote(2, "4")])
+    first, second = PondMelody([bar, PondNote(4, "2")]), PondFragment([bar, bar])
+    assert (str(first), str(second)) == ("{{c4\nd4}\n\ne2}\n", "{c4\nd4}\n {c4\nd4}\n")
+    assert (first.real_duration, second.real_duration) == (4, 4)
+    bar.fragments[1].duration = "2"
+    assert (str(first), str(second)) == ("{{c4\nd2}\n\ne2}\n", "{c4\nd2}\n {c4\nd2}\n")
+    assert (first.real_duration, second.real_duration) == (5, 6)
+
+
+def test_shared_ancestors_are_cleared_once(cleared):
+    bar, root = shared_tree(levels=5, copies=8)
+    str(root)
+    assert root.real_duration == 4 * 8 ** 5
+    del cleared[:]
+    bar.fragments[0].duration = "8"
+    assert len(cleared) == 6
+    assert root.real_duration == Fraction(7, 2) * 8 ** 5
+    assert str(root).count("c8") == 8 ** 5
+
+
+def test_string_changes_stop_at_dirty_ancestors(cleared):
+    bar, root = shared_tree(levels=3, copies=2)
+    str(root)
+    del cleared[:]
+    bar.fragments[0].articulation = "-."
+    bar.fragments[1].articulation = "-."
+    # The second change stops at the bar, which the first one already cleared.
+    assert cleared == [bar, *cleared[1:4], bar]
+    assert str(root).count("c4-.") == 2 * 2 ** 3
+
+
+def test_building_top_down_does_not_climb_the_tree(cleared):
+    root = melody = PondMelody()
+    for _ in range(2000):
+        child = PondMelody()
+        melody.append_fragment(child)
+        melody = child
+    # Each append only looks at the melody appended to and at its parent.
+    assert len(cleared) == 2 * 2000 - 1
+    melody.append_fragment(PondTuplet(3, 2, 4, [PondNote(0, "8")] * 3))
+    assert root.real_duration == 1
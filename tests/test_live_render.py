@@ -0,0 +1,42 @@
+from pypond.PondFile import PondLiveRender, PondRender
+from pypond.PondMusic import PondFragment, PondNote
+from pypond.PondScore import PondTimeSignature
+
+
+def bar(pitch):
+    return PondFragment([PondNote(pitch, "2"), PondNote(pitch, "2")])
+
+
+def test_unchanged_frames_are_skipped(fake_lilypond, ly_folder):
+    live = PondLiveRender(bars=2, render=PondRender(folder_path=ly_folder), latency_target=0)
+    live.add_staff()
+    live.push(bar(0))
+    first = live.render_frame()
+    second = live.render_frame()
+    assert second is first
+    stats = live.frame_stats()
+    assert (stats["frames"], stats["skipped"], stats["missed"]) == (1, 1, 1)
+    assert len(live.latencies) == 1
+    live.push(bar(2))
+    assert live.render_frame() is not first
+    assert live.frame_stats()["frames"] == 2
+
+
+def test_windows_of_staves_with_different_lengths_are_aligned():
+    live = PondLiveRender(bars=3)
+    upper = live.add_staff()
+    lower = live.add_staff(PondTimeSignature(3, 4), clef="bass")
+    for pitch in range(5):
+        upper.add_bar(bar(pitch))
+    lower.add_bar(PondFragment([PondNote(0, "2.")]))
+    lower.add_bar(PondFragment([PondNote(2, "2.")]))
+    lower.add_bar(PondFragment([PondNote(4, "2.")]))
+    lower.add_bar(PondFragment([PondNote(5, "2.")]))
+    staves = live.frame_document().create_file()
+    assert "\\set Score.currentBarNumber = #3" in staves
+    upper_voice = "".join(upper.window_chunks(3, 5))
+    lower_voice = "".join(lower.window_chunks(3, 5))
+    assert upper_voice.count(" |\n") == lower_voice.count(" |\n") == 2
+    assert upper_voice.endswith("e2 e2")
+    assert lower_voice.startswith("\\clef bass\n\\time 3/4\ne2.")
+    assert lower_voice.endswith("f2. |\ns1*3/4")
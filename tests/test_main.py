@@ -0,0 +1,69 @@
+import asyncio
+import io
+import json
+import time
+import pytest
+from pypond import __main__
+from pypond.PondFile import PondRender
+from pypond.PondScore import PondTimeSignature
+from pypond.__main__ import run_jobs
+
+JOBS = '{"ly": "{ c4 }"}\n{"id": "broken", "ly": "{ FAIL }"}\n{"notes": [0, 2], "durations": ["4", "4"]}\n'
+
+
+def run(render, jobs=JOBS, timeout=None):
+    output = io.StringIO()
+    failed = asyncio.run(run_jobs(io.StringIO(jobs), output, render, workers=2,
+                                  timeout=timeout))
+    results = sorted((json.loads(line) for line in output.getvalue().splitlines()),
+                     key=lambda result: result["line"])
+    return failed, results
+
+
+def test_jobs_report_their_exit_code(fake_lilypond, ly_folder):
+    failed, results = run(PondRender(folder_path=ly_folder))
+    assert failed == 1
+    assert [result.get("returncode") for result in results] == [0, 1, 0]
+    assert results[1]["id"] == "broken"
+    assert results[1]["errors"][0].endswith("error: failure requested")
+
+
+def test_missing_lilypond_fails_each_job(missing_lilypond, ly_folder):
+    failed, results = run(PondRender(folder_path=ly_folder))
+    assert failed == 3
+    assert [result["line"] for result in results] == [1, 2, 3]
+    assert all(result["error"].startswith("FileNotFoundError") for result in results)
+
+
+def test_a_job_that_raises_only_fails_itself(fake_lilypond, ly_folder):
+    jobs = '{"notes": [[]]}\n{"time": "0/4", "split_bars": true, "notes": [0]}\n' + JOBS
+    failed, results = run(PondRender(folder_path=ly_folder), jobs)
+    assert failed == 3
+    assert [result["line"] for result in results] == [1, 2, 3, 4, 5]
+    assert results[0]["error"].startswith("IndexError")
+    assert results[1]["error"].startswith("ValueError")
+    assert [result.get("returncode") for result in results[2:]] == [0, 1, 0]
+
+
+def test_time_signatures_must_be_positive():
+    for beats in [(0, 4), (4, 0), (-3, 4)]:
+        with pytest.raises(ValueError):
+            PondTimeSignature(*beats)
+
+
+def test_timeout_covers_building_the_job(fake_lilypond, ly_folder, monkeypatch):
+    build_document = __main__.build_document
+
+    def slow_build(spec):
+        if spec.get("id") == "slow":
+            time.sleep(5)
+        return build_document(spec)
+
+    monkeypatch.setattr(__main__, "build_document", slow_build)
+    jobs = '{"id": "slow", "notes": [0]}\n{"notes": [0]}\n'
+    start = time.perf_counter()
+    failed, results = run(PondRender(folder_path=ly_folder), jobs, timeout=1)
+    assert time.perf_counter() - start < 4
+    assert failed == 1
+    assert "timed out" in results[0]["error"]
+    assert results[1]["returncode"] == 0
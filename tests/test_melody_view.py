@@ -0,0 +1,28 @@
+from pypond.PondMusic import PondColumnMelody, PondFragment, PondMelody, PondNote
+
+
+def tied_phrase():
+    return PondMelody([PondNote(0, "4", tie=True, begin_phrase=True), PondNote(0, "4"),
+                       PondNote(2, "2", end_phrase=True)])
+
+
+def test_view_does_not_change_the_melody():
+    melody = tied_phrase()
+    text = str(melody)
+    assert str(melody.view().transposed(2)) == "{d4~ (\nd4\ne2)}\n"
+    assert str(melody) == text
+
+
+def test_retrograde_moves_ties_and_swaps_phrase_marks():
+    view = tied_phrase().view().retrograded()
+    assert str(view) == "{d2 (\nc4~\nc4)}\n"
+    assert [str(note) for note in view.ordered_notes()] == ["d2 (", "c4~", "c4)"]
+    assert str(view.retrograded()) == str(tied_phrase())
+
+
+def test_retrograde_ties_cross_fragments():
+    melody = PondMelody([PondFragment([PondNote(0, "4"), PondNote(2, "4", tie=True)]),
+                         PondNote(2, "4")])
+    assert str(melody.view().retrograded()) == "{d4~\nd4 c4}\n"
+    column = PondColumnMelody([PondNote(0, "4", tie=True), PondNote(0, "4"), PondNote(4, "8")])
+    assert str(column.view().retrograded()) == "{e8\nc4~\nc4}\n"
@@ -0,0 +1,121 @@
+import io
+import struct
+import pytest
+from pypond.PondMidi import PondMidi
+from pypond.PondMusic import PondMelody, PondNote
+from pypond.PondParser import PondParser
+from pypond.PondPersistent import PondPersistentMelody
+from pypond.PondScore import PondScore, PondStaff
+
+
+def read_number(data, offset):
+    value = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, offset
+
+
+def read_smf(data):
+    """Returns (format, ticks per quarter, tracks), each track a list of events."""
+    assert data[:4] == b"MThd"
+    length, midi_format, track_count, ticks = struct.unpack(">IHHH", data[4:14])
+    offset = 14
+    tracks = []
+    for _ in range(track_count):
+        assert data[offset:offset + 4] == b"MTrk"
+        size, = struct.unpack(">I", data[offset + 4:offset + 8])
+        body = data[offset + 8:offset + 8 + size]
+        offset += 8 + size
+        position = tick = 0
+        events = []
+        while position < len(body):
+            delta, position = read_number(body, position)
+            tick += delta
+            status = body[position]
+            if status == 0xFF:
+                kind = body[position + 1]
+                length, position = read_number(body, position + 2)
+                events.append((tick, "meta", kind, bytes(body[position:position + length])))
+                position += length
+            elif status & 0xF0 == 0xC0:
+                events.append((tick, "program", status & 0x0F, body[position + 1]))
+                position += 2
+            else:
+                kind = "on" if status & 0xF0 == 0x90 else "off"
+                events.append((tick, kind, status & 0x0F, body[position + 1], body[position + 2]))
+                position += 3
+        assert events[-1][1:3] == ("meta", 0x2F)
+        tracks.append(events)
+    assert offset == len(data)
+    return midi_format, ticks, tracks
+
+
+def note_ons(music):
+    midi_format, ticks, tracks = read_smf(PondMidi().dumps(music))
+    return [[(event[0], event[3], event[4]) for event in track if event[1] == "on"]
+            for track in tracks[1:]]
+
+
+TUPLET_MELODY = "{\\tuplet 3/2 {c8 d8 e8} f4}"
+
+
+def test_tuplets_are_timed_exactly():
+    assert note_ons(PondParser.parse(TUPLET_MELODY)) == [
+        [(0, 48, 80), (160, 50, 80), (320, 52, 80), (480, 53, 80)]]
+
+
+@pytest.mark.parametrize("wrap", [lambda melody: melody.view(),
+                                  PondPersistentMelody.from_melody])
+def test_views_and_persistent_melodies_keep_tuplet_timing(wrap):
+    melody = PondParser.parse(TUPLET_MELODY)
+    assert note_ons(wrap(melody)) == note_ons(melody)
+
+
+def test_transformed_views_are_timed_from_their_notes():
+    melody = PondParser.parse(TUPLET_MELODY)
+    assert note_ons(melody.view().retrograded()) == [
+        [(0, 53, 80), (480, 52, 80), (640, 50, 80), (800, 48, 80)]]
+    assert note_ons(melody.view().augmented()) == [
+        [(0, 48, 80), (320, 50, 80), (640, 52, 80), (960, 53, 80)]]
+
+
+def test_ties_join_notes_and_dynamics_set_velocity():
+    melody = PondParser.parse("{c4\\p~ c4 d4\\sfz e4 r4 f4\\ff}")
+    midi_format, ticks, tracks = read_smf(PondMidi().dumps(melody))
+    events = [event for event in tracks[1] if event[1] in ("on", "off")]
+    assert events == [(0, "on", 0, 48, 49), (960, "off", 0, 48, 0), (960, "on", 0, 50, 112),
+                      (1440, "off", 0, 50, 0), (1440, "on", 0, 52, 49),
+                      (1920, "off", 0, 52, 0), (2400, "on", 0, 53, 112),
+                      (2880, "off", 0, 53, 0)]
+
+
+def test_every_voice_is_a_track():
+    score = PondScore()
+    for voices in (["{c4 d4}", PondMelody([PondNote(4, "2")])], ["{g,2}"]):
+        staff = PondStaff()
+        staff.time_signature = "\\time 3/4\n"
+        for voice in voices:
+            staff.add_voice(voice)
+        score.add_staff(staff)
+    midi_format, ticks, tracks = read_smf(PondMidi(tempo=120).dumps(score))
+    assert (midi_format, ticks, len(tracks)) == (1, 480, 4)
+    assert (0, "meta", 0x51, struct.pack(">I", 500000)[1:]) in tracks[0]
+    assert (0, "meta", 0x58, bytes([3, 2, 24, 8])) in tracks[0]
+    assert [track[0][3] for track in tracks[1:]] == [b"Staff 1 voice 1", b"Staff 1 voice 2",
+                                                      b"Staff 2 voice 1"]
+    assert [event[2] for event in tracks[3] if event[1] == "on"] == [2]
+
+
+def test_streamed_and_buffered_files_are_equal():
+    melody = PondParser.parse(TUPLET_MELODY)
+
+    class Unseekable(io.BytesIO):
+        def seekable(self):
+            return False
+
+    fp = Unseekable()
+    PondMidi().write_to(melody, fp)
+    assert fp.getvalue() == PondMidi().dumps(melody)
@@ -0,0 +1,39 @@
+from fractions import Fraction
+from pypond.PondCore import DurationInterface
+from pypond.PondMusic import PondMelody, PondNote, PondTuplet
+
+
+def test_index_follows_appends():
+    melody = PondMelody([PondNote(0, "4"), PondNote(2, "8")])
+    assert melody.real_duration == Fraction(3, 2)
+    melody.append_fragment(PondNote(4, "2"))
+    assert len(melody) == 3
+    assert melody.real_duration == Fraction(7, 2)
+    assert str(melody.note_at(2)) == "e2"
+
+
+def test_incomplete_tuplet_can_be_appended_to_a_measured_melody():
+    melody = PondMelody([PondNote(0, "4")])
+    assert melody.real_duration == 1
+    tuplet = PondTuplet(3, 2, 4)
+    tuplet.append_fragment(PondNote(0, "8"))
+    melody.append_fragment(tuplet)
+    tuplet.append_fragment(PondNote(2, "8"))
+    tuplet.append_fragment(PondNote(4, "8"))
+    assert melody.real_duration == 2
+    assert len(melody) == 4
+    assert melody.onset(3) == Fraction(5, 3)
+
+
+def test_tuplet_duration_is_cached(monkeypatch):
+    tuplet = PondTuplet(3, 2, 4, [PondNote(pitch, "8") for pitch in (0, 2, 4)])
+    calls = []
+    check = DurationInterface.is_complete_tuplet
+    monkeypatch.setattr(DurationInterface, "is_complete_tuplet",
+                        lambda *args: calls.append(args) or check(*args))
+    assert tuplet.real_duration == 1
+    assert tuplet.real_duration == 1
+    assert len(calls) == 1
+    tuplet.data = (3, 2, 4)
+    assert tuplet.real_duration == 1
+    assert len(calls) == 2
@@ -0,0 +1,120 @@
+import pytest
+from pypond.PondMarks import Articulations, Dynamics, MiscMarks
+from pypond.PondMusic import (PondChord, PondFragment, PondMelody, PondNote, PondPitch,
+                              PondTuplet)
+from pypond.PondParser import PondParser
+
+
+def marks_of(klass):
+    return [value for name, value in vars(klass).items()
+            if not name.startswith("_") and isinstance(value, str)]
+
+
+def with_attribute(name, value):
+    def mark(note):
+        setattr(note, name, value)
+    return mark
+
+
+MARKS = (
+    [with_attribute("articulation", value) for value in marks_of(Articulations)] +
+    [with_attribute("dynamic", value) for value in marks_of(Dynamics) + [MiscMarks.end_tag]] +
+    [with_attribute("dynamic", Dynamics.custom_dynamic(identifier, number))
+     for identifier in "pf" for number in range(6)] +
+    [lambda note: note.make_tie(),
+     lambda note: note.phrase_data("end"),
+     lambda note: note.make_rest(),
+     lambda note: note.trill_marks(),
+     lambda note: note.trill_marks(begin=False),
+     lambda note: note.trill_marks(pitched=2),
+     lambda note: note.trill_marks(pitched="fis", relative=False),
+     lambda note: note.trill_marks(pitched=PondPitch(9, 1)),
+     lambda note: note.make_cadenza(),
+     lambda note: note.ignore_accidental(),
+     lambda note: note.hide_notehead(),
+     lambda note: note.hide_note(),
+     lambda note: (note.hide_note(), note.trill_marks(pitched=2), note.make_tie())]
+)
+
+
+@pytest.mark.parametrize("text", [
+    "{c4\nd8\ne'8\nf,,2.}\n",
+    "{c4-.\nd4->\ne8~\ne8\nr4}\n",
+    "{c4\\p\nd4\\<\ne4\\!\nf4\\ff}\n",
+    "{f4\\trill~\nf4\\fermata}\n",
+    "{<c e g>2\n<d f a>4\nr4}\n",
+    "{\\tuplet 3/2 4 {c8 d8 e8}\nf4}\n",
+    "\\time 3/4 {c4\nd4 (e4)\nf4}\n",
+    "{c4\\startTrillSpan \nd4\\stopTrillSpan \n"
+    "\\pitchedTrill e4\\startTrillSpan  f\nf8\\stopTrillSpan \nr8}\n",
+])
+def test_round_trip(text):
+    assert PondParser.parse(text).as_string() == text
+
+
+def test_pypond_output_round_trips():
+    trill = PondNote(4, "4")
+    trill.trill_marks(pitched=5)
+    end = PondNote(5, "8", dynamic="\\mf")
+    end.trill_marks(begin=False)
+    melody = PondMelody([PondNote(0, "4", articulation="-.", tie=True), PondNote(0, "8"),
+                         PondChord([0, 4, 7], "2"), trill, end, PondNote.create_rest("8"),
+                         PondTuplet(3, 2, 4, [PondNote(pitch, "8") for pitch in (0, 2, 4)])])
+    text = melody.as_string()
+    assert PondParser.parse(text).as_string() == text
+
+
+@pytest.mark.parametrize("mark", MARKS)
+@pytest.mark.parametrize("container", [PondMelody, PondFragment])
+@pytest.mark.parametrize("position", [0, 1])
+def test_every_mark_round_trips(mark, container, position):
+    notes = [PondNote(0, "4"), PondNote(2, "8")]
+    mark(notes[position])
+    text = container(notes).as_string()
+    melody = PondParser.parse(text)
+    assert melody.as_string() == text
+    parsed = melody.fragments[position]
+    assert (parsed.pre_marks, parsed.post_marks) == (notes[position].pre_marks,
+                                                     notes[position].post_marks)
+
+
+def test_closing_marks_stay_on_their_note():
+    text = "{\\hideNotes c4 \\undo \\hideNotes\nd4}\n"
+    first, second = PondParser.parse(text).fragments
+    assert first.post_marks == [" \\undo \\hideNotes"]
+    assert second.pre_marks == []
+
+
+def test_commands_at_the_end_go_to_the_last_note():
+    melody = PondParser.parse("{{c4} \\break} {d4 \\break}")
+    first, second = melody.fragments
+    assert first.fragments[0].fragments[0].post_marks == [" \\break"]
+    assert second.fragments[0].post_marks == [" \\break"]
+    with pytest.raises(ValueError, match="does not belong to a note"):
+        PondParser.parse("\\break")
+
+
+def test_post_events_attach_to_the_previous_note():
+    melody = PondParser.parse("{c4\\startTrillSpan \nd4\\stopTrillSpan \n\\break e4}")
+    first, second, third = melody.fragments
+    assert first.post_marks == ["\\startTrillSpan "]
+    assert second.post_marks == ["\\stopTrillSpan "]
+    assert third.pre_marks == ["\\break "]
+
+
+def test_pitched_trill_reads_the_trill_pitch():
+    note = PondParser.parse("{\\pitchedTrill e4\\startTrillSpan  f\nf8}").fragments[0]
+    assert note.pre_marks == ["\\pitchedTrill "]
+    assert note.post_marks == ["\\startTrillSpan ", PondPitch(5)]
+    assert note.auxiliary_pitches == {"trill": PondPitch(5)}
+
+
+def test_rests_are_static():
+    rest = PondParser.parse("{r4 c4}").fragments[0]
+    assert rest.static
+    assert rest.pitch is PondPitch.rest()
+
+
+def test_unmatched_brace():
+    with pytest.raises(ValueError):
+        PondParser.parse("{c4}}")
@@ -0,0 +1,81 @@
+import pytest
+from pypond.PondMusic import PondFragment, PondMelody, PondNote, PondTuplet
+from pypond.PondPersistent import PondPersistentMelody, PondVector
+
+
+def notes(count, duration="8"):
+    return [PondNote(idx % 24, duration) for idx in range(count)]
+
+
+def melody():
+    return PondMelody([PondNote(0, "4"), PondFragment(notes(3)),
+                       PondTuplet(3, 2, 4, notes(3)), PondNote(7, "2")])
+
+
+def test_edits_leave_the_old_version_unchanged():
+    original = melody()
+    version = PondPersistentMelody.from_melody(original)
+    text = str(version)
+    assert text == str(original)
+    edited = version.transpose(2, 1, 4).make_rest(0).make_tie(7).trill_marks(6, pitched=2)
+    assert str(version) == text
+    expected = melody()
+    expected.fragments[0].make_rest()
+    for note in expected.ordered_notes()[1:4]:
+        note.transpose(2)
+    expected.ordered_notes()[7].make_tie()
+    expected.ordered_notes()[6].trill_marks(pitched=2)
+    assert str(edited) == str(expected)
+    assert str(edited.to_melody()) == str(expected)
+
+
+def test_notes_are_inserted_and_deleted_in_place():
+    version = PondPersistentMelody.from_melody(melody())
+    inserted = version.insert_note(2, PondNote(11, "8"))
+    assert [str(note) for note in inserted.iter_notes()][1:4] == ["c8", "b8", "cis8"]
+    assert inserted.get_note(2).pitch.pitch == 11
+    assert inserted.real_duration == version.real_duration + PondNote(0, "8").real_duration
+    deleted = inserted.delete_note(2).delete_note(0)
+    assert [str(note) for note in deleted.iter_notes()] == \
+        [str(note) for note in version.iter_notes()][1:]
+    appended = version.append_note(PondNote(0, "1"))
+    assert str(appended.get_note(-1)) == "c1"
+    assert len(version) == 8
+
+
+def test_edited_notes_are_copies():
+    note = PondNote(0, "4")
+    version = PondPersistentMelody.from_notes([note])
+    changed = version.set_note(0, note)
+    note.transpose(1)
+    assert str(changed.get_note(0)) == str(version.get_note(0)) == "c4"
+
+
+def test_concatenation_stays_balanced():
+    version = PondPersistentMelody.from_notes(notes(1))
+    for idx in range(1, 3000):
+        single = PondPersistentMelody.from_notes([PondNote(idx % 24, "8")])
+        version = version + single if idx % 2 else single + version
+    assert version.root.items.height <= 4
+    order = list(range(2998, 0, -2)) + [0] + list(range(1, 3000, 2))
+    assert [note.pitch.absolute_int for note in version.iter_notes()] == \
+        [idx % 24 for idx in order]
+    assert str(version) == str(PondMelody([PondNote(idx % 24, "8") for idx in order]))
+    assert version.get_note(1500).pitch.absolute_int == order[1500] % 24
+
+
+@pytest.mark.parametrize("sizes", [(1, 5000), (5000, 1), (64, 64), (2000, 3000), (0, 10)])
+def test_concat_keeps_items_and_measures(sizes):
+    first, second = (PondVector.build(notes(size)) for size in sizes)
+    joined = first.concat(second)
+    assert list(joined) == list(first) + list(second)
+    assert (len(joined), joined.count, joined.duration) == (
+        sum(sizes), sum(sizes), first.duration + second.duration)
+    assert joined.height <= max(first.height, second.height) + 1
+    assert joined.as_string() == " ".join(map(str, list(first) + list(second)))
+
+
+def test_concat_uses_the_separator_of_the_first_melody():
+    joined = (PondPersistentMelody.from_melody(PondMelody(notes(2))) +
+              PondPersistentMelody.from_melody(PondFragment(notes(2))))
+    assert str(joined) == "{c8\ncis8\nc8\ncis8}\n"
@@ -0,0 +1,47 @@
+import copy
+import pickle
+import pytest
+from pypond.PondMusic import PondColumnMelody, PondMelody, PondNote, PondPitch
+from pypond.PondSnapshot import PondSnapshot
+
+
+def test_pitches_are_interned():
+    assert PondPitch(5, 2) is PondPitch.from_absolute_int(29)
+    assert PondPitch("fis") is PondPitch(6)
+    assert PondPitch(11).transpose(1) is PondPitch(0, 1)
+
+
+def test_rests_keep_their_octave():
+    note = PondNote(5, octave=2)
+    note.make_rest()
+    assert str(note) == "r4"
+    assert note.pitch.octave == 2
+    note.make_pitch()
+    assert str(note) == "c''4"
+
+
+def test_relative_trill_on_a_rest_uses_its_octave():
+    note = PondNote(5, octave=2)
+    note.make_rest()
+    note.trill_marks(pitched=2)
+    assert note.auxiliary_pitches["trill"] is PondPitch(2, 2)
+
+
+@pytest.mark.parametrize("restore", [
+    copy.copy,
+    lambda pitch: pickle.loads(pickle.dumps(pitch)),
+])
+def test_copied_rests_keep_their_octave(restore):
+    assert restore(PondPitch.rest(3)) is PondPitch.rest(3)
+
+
+@pytest.mark.parametrize("restore", [
+    lambda melody: PondSnapshot.loads(PondSnapshot.dumps(melody)),
+    lambda melody: PondMelody(PondColumnMelody.from_melody(melody).iter_notes()),
+])
+def test_stored_rests_keep_their_octave(restore):
+    rest = PondNote(0, "2", octave=-2)
+    rest.make_rest()
+    note = restore(PondMelody([rest])).ordered_notes()[0]
+    note.make_pitch()
+    assert str(note) == "c,,2"
@@ -0,0 +1,28 @@
+import asyncio
+import pytest
+from pypond.PondFile import PondRender
+
+
+async def render_all(render, documents, timeout=None):
+    return await asyncio.gather(*(render.render_async(document, timeout)
+                                  for document in documents))
+
+
+def test_render_async_captures_results(fake_lilypond, ly_folder):
+    render = PondRender(folder_path=ly_folder, max_concurrency=2)
+    results = asyncio.run(render_all(render, ["{ c'4 }", "{ FAIL }", "{ d'4 }"]))
+    assert [result.returncode for result in results] == [0, 1, 0]
+    assert "error: failure requested" in results[1].log
+
+
+def test_render_async_works_from_several_event_loops(fake_lilypond, ly_folder):
+    render = PondRender(folder_path=ly_folder, max_concurrency=1)
+    for _ in range(2):
+        results = asyncio.run(render_all(render, ["{ c'4 }", "{ d'4 }"]))
+        assert [result.returncode for result in results] == [0, 0]
+
+
+def test_render_async_timeout(fake_lilypond, ly_folder):
+    render = PondRender(folder_path=ly_folder)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(render.render_async("{ HANG }", timeout=0.5))
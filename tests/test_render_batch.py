@@ -0,0 +1,60 @@
+import os
+import threading
+from pypond import PondFile
+from pypond.PondFile import PondRender, COMMAND_NOT_FOUND
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+def test_render_batch_renders_every_document(fake_lilypond, ly_folder):
+    render = PondRender(folder_path=ly_folder, workers=2)
+    results = render.render_batch(["{ c'4 }", "{ d'4 }", "{ e'4 }"])
+    assert [result.returncode for result in results] == [0, 0, 0]
+    assert len({result.source for result in results}) == 3
+    for result, note in zip(results, ("c'4", "d'4", "e'4")):
+        assert result.output.endswith(".png")
+        assert note in read(result.output)
+        assert "warning: fake warning" in result.log
+
+
+def test_render_batch_reports_failed_documents(fake_lilypond, ly_folder):
+    render = PondRender(folder_path=ly_folder)
+    passed, failed = render.render_batch(["{ c'4 }", "{ FAIL }"])
+    assert passed.returncode == 0 and os.path.exists(passed.output)
+    assert failed.returncode == 1 and not os.path.exists(failed.output)
+    assert "error: failure requested" in failed.log
+
+
+def test_render_batch_without_lilypond(missing_lilypond, ly_folder):
+    render = PondRender(folder_path=ly_folder)
+    results = render.render_batch(["{ c'4 }", "{ d'4 }"])
+    assert [result.returncode for result in results] == [COMMAND_NOT_FOUND] * 2
+    assert all("cannot run lilypond" in result.log for result in results)
+
+
+def test_render_batches_do_not_share_files(fake_lilypond, ly_folder):
+    render = PondRender(folder_path=ly_folder)
+    first = render.render_batch(["{ c'4 }"])
+    second = render.render_batch(["{ d'4 }"])
+    assert first[0].source != second[0].source
+    assert "c'4" in read(first[0].output)
+
+
+def test_render_batch_runs_lilypond_from_threads(fake_lilypond, ly_folder, monkeypatch):
+    run_lilypond = PondFile.run_lilypond
+    callers = []
+
+    def recording_run(arguments):
+        callers.append((os.getpid(), threading.current_thread()))
+        return run_lilypond(arguments)
+
+    monkeypatch.setattr(PondFile, "run_lilypond", recording_run)
+    render = PondRender(folder_path=ly_folder, workers=2)
+    results = render.render_batch(["{ c'4 }", "{ d'4 }", "{ e'4 }"])
+    assert [result.returncode for result in results] == [0, 0, 0]
+    assert len(callers) == 3
+    assert all(pid == os.getpid() for pid, thread in callers)
+    assert threading.main_thread() not in {thread for pid, thread in callers}
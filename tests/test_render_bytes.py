@@ -0,0 +1,47 @@
+import threading
+from pypond.PondFile import (COMMAND_NOT_FOUND, TIMED_OUT, PondRender, PondRenderCache,
+                             PondRenderStats)
+
+
+def test_render_bytes_returns_the_pages(fake_lilypond, ly_folder):
+    result = PondRender(folder_path=ly_folder).render_bytes("{ c'4 }")
+    assert result.returncode == 0
+    assert len(result.pages) == 1 and b"{ c'4 }" in result.pages[0]
+
+
+def test_timeout_returns_the_partial_log(fake_lilypond, ly_folder):
+    result = PondRender(folder_path=ly_folder).render_bytes("{ HANG }", timeout=0.5)
+    assert result.returncode == TIMED_OUT
+    assert result.pages == ()
+    assert "Processing" in result.log
+    assert result.log.endswith("timed out after 0.5 seconds\n")
+
+
+def test_missing_lilypond_returns_a_failure(missing_lilypond, ly_folder):
+    result = PondRender(folder_path=ly_folder).render_bytes("{ c'4 }")
+    assert result.returncode == COMMAND_NOT_FOUND
+    assert "cannot run lilypond" in result.log
+
+
+def test_threads_share_the_cache_and_stats(fake_lilypond, ly_folder, tmp_path):
+    cache = PondRenderCache(str(tmp_path / "cache"))
+    stats = PondRenderStats()
+    render = PondRender(folder_path=ly_folder, cache=cache, stats=stats)
+    documents = [f"{{ c'{idx % 3} }}" for idx in range(12)]
+    results = [None] * len(documents)
+
+    def run(idx):
+        results[idx] = render.render_bytes(documents[idx])
+
+    threads = [threading.Thread(target=run, args=(idx,)) for idx in range(len(documents))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(result.returncode == 0 for result in results)
+    assert all(documents[idx].encode() in result.pages[0] for idx, result in enumerate(results))
+    cache_stats = cache.stats()
+    assert cache_stats["hits"] + cache_stats["misses"] == len(documents)
+    assert cache_stats["entries"] == 3
+    assert stats.cache_hits == cache_stats["hits"]
+    assert stats.calls["render"] == cache_stats["misses"]
@@ -0,0 +1,34 @@
+import os
+from pypond.PondFile import PondRender, PondRenderCache
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+def test_render_restores_cached_output(fake_lilypond, ly_folder, tmp_path):
+    cache = PondRenderCache(str(tmp_path / "cache"))
+    render = PondRender(folder_path=ly_folder, cache=cache)
+    render.update("{ c'4 }")
+    render.write()
+    first = render.render()
+    os.remove(first.output)
+    second = render.render()
+    assert (first.returncode, second.returncode) == (0, 0)
+    assert cache.stats()["hits"] == 1
+    assert "c'4" in read(second.output)
+
+
+def test_render_keys_the_cache_by_the_written_file(fake_lilypond, ly_folder, tmp_path):
+    cache = PondRenderCache(str(tmp_path / "cache"))
+    render = PondRender(folder_path=ly_folder, cache=cache)
+    render.update("{ c'4 }")
+    render.write()
+    render.update("{ d'4 }")
+    result = render.render()
+    assert "c'4" in read(result.output)
+    assert render.cache_key() not in cache
+    render.write()
+    assert "d'4" in read(render.render().output)
+    assert render.cache_key() in cache
@@ -0,0 +1,45 @@
+import os
+from pypond.PondFile import PondDoc, PondRender, PondRenderStats
+from pypond.PondMusic import PondChord, PondColumnMelody, PondMelody, PondNote, PondTuplet
+from pypond.PondScore import PondScore, PondStaff
+
+
+def document():
+    staff = PondStaff()
+    staff.add_voice(PondMelody([PondNote(0, "4"), PondChord([0, 4, 7], "2"),
+                                PondTuplet(3, 2, 4, [PondNote(pitch, "8") for pitch in (0, 2, 4)])]))
+    staff.add_voice("{c4 d4 r2}")
+    column = PondColumnMelody()
+    for pitch in range(4):
+        column.append_note(pitch, "4")
+    other = PondStaff()
+    other.add_voice(column)
+    score = PondScore()
+    score.add_staff(staff)
+    score.add_staff(other)
+    doc = PondDoc()
+    doc.score = score
+    return doc
+
+
+def test_measured_write_counts_bytes_and_notes(ly_folder):
+    stats = PondRenderStats()
+    render = PondRender(folder_path=ly_folder, stats=stats)
+    render.update(document())
+    render.write()
+    path = os.path.join(ly_folder, render._file_name)
+    assert stats.bytes_written == os.path.getsize(path)
+    assert stats.notes_serialized == 12
+    with open(path) as file:
+        assert file.read() == render.current_file
+    assert stats.calls == {"build": 1, "write": 1}
+
+
+def test_unchanged_write_is_only_built(ly_folder):
+    stats = PondRenderStats()
+    render = PondRender(folder_path=ly_folder, stats=stats)
+    render.update("{c4 d4}")
+    render.write()
+    render.write(force=False)
+    assert stats.calls == {"build": 2, "write": 1}
+    assert stats.notes_serialized == 2
@@ -0,0 +1,49 @@
+from pypond.PondFile import PondRender, PondRenderWorker, PondWorkerPool, TIMED_OUT
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+def test_worker_answers_each_job(worker_command, ly_folder):
+    render = PondRender(folder_path=ly_folder)
+    with PondRenderWorker(render, worker_command) as worker:
+        passed = worker.submit("{ c'4 }")
+        failed = worker.submit("{ FAIL }")
+        again = worker.submit("{ d'4 }")
+    assert [passed.returncode, failed.returncode, again.returncode] == [0, 1, 0]
+    assert "c'4" in read(passed.output) and "d'4" in read(again.output)
+    assert "error: failure requested" in failed.log
+    assert "pypond-job-done" not in passed.log
+    assert worker.restarts == 0
+    assert worker.latency_stats()["jobs"] == 3
+
+
+def test_worker_restarts_after_a_crash(worker_command, ly_folder):
+    render = PondRender(folder_path=ly_folder)
+    with PondRenderWorker(render, worker_command) as worker:
+        crashed = worker.submit("{ CRASH }")
+        assert crashed.returncode == -1
+        assert worker.restarts == 1 and worker.alive
+        assert worker.submit("{ c'4 }").returncode == 0
+
+
+def test_worker_timeout_kills_and_restarts(worker_command, ly_folder):
+    render = PondRender(folder_path=ly_folder)
+    with PondRenderWorker(render, worker_command, timeout=30) as worker:
+        hung = worker.submit("{ HANG }", timeout=0.5)
+        assert hung.returncode == TIMED_OUT
+        assert "Processing" in hung.log and "no answer" in hung.log
+        assert worker.restarts == 1
+        assert worker.submit("{ c'4 }").returncode == 0
+
+
+def test_pool_returns_results_in_order(worker_command, ly_folder):
+    render = PondRender(folder_path=ly_folder)
+    documents = [f"{{ {name}'4 }}" for name in "cdefg"]
+    with PondWorkerPool(2, render, worker_command) as pool:
+        results = pool.render_batch(documents)
+    assert [result.returncode for result in results] == [0] * 5
+    for document, result in zip(documents, results):
+        assert document in read(result.output)
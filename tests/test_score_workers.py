@@ -0,0 +1,39 @@
+import threading
+from pypond.PondMusic import PondMelody, PondNote, PondTuplet
+from pypond.PondScore import PondScore, PondStaff
+
+
+def score(workers=None):
+    result = PondScore(workers=workers)
+    for idx in range(3):
+        staff = PondStaff()
+        staff.add_voice(PondMelody([PondNote(idx + step, "8") for step in range(40)] +
+                                   [PondTuplet(3, 2, 4, [PondNote(idx, "8") for _ in range(3)])]))
+        result.add_staff(staff)
+    return result
+
+
+def test_workers_render_the_same_score(importable_package):
+    assert str(score(workers=2)) == str(score())
+
+
+def test_concurrent_scores_keep_their_own_staves(importable_package):
+    scores = [score(workers=2) for _ in range(2)]
+    scores[1].staves[0].voices[0].fragments[0].pitch = PondNote(11).pitch
+    expected = []
+    for each in scores:
+        each.workers = None
+        expected.append(str(each))
+        each.workers = 2
+    results = [None, None]
+
+    def render(idx):
+        results[idx] = str(scores[idx])
+
+    threads = [threading.Thread(target=render, args=(idx,)) for idx in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == expected
+    assert expected[0] != expected[1]
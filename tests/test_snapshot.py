@@ -0,0 +1,40 @@
+import pytest
+from pypond.PondMusic import PondMelody, PondNote
+from pypond.PondSnapshot import PondSnapshot
+
+
+def write(path, data):
+    with open(path, 'wb') as file:
+        file.write(data)
+    return str(path)
+
+
+def test_open_reads_a_snapshot(tmp_path):
+    melody = PondMelody([PondNote(0, "4", articulation="-."), PondNote(2, "8")])
+    path = write(tmp_path / "music.snap", PondSnapshot.dumps(melody))
+    with PondSnapshot.open(path) as snapshot:
+        assert str(snapshot.load()) == str(melody)
+
+
+def test_open_rejects_an_empty_file(tmp_path):
+    path = write(tmp_path / "empty.snap", b"")
+    with pytest.raises(ValueError, match="empty or truncated"):
+        PondSnapshot.open(path)
+
+
+@pytest.mark.parametrize("size", [4, 20, -3])
+def test_open_rejects_a_truncated_file(tmp_path, size):
+    data = PondSnapshot.dumps(PondMelody([PondNote(0, "4", articulation="-.")]))
+    path = write(tmp_path / "truncated.snap", data[:size])
+    with pytest.raises(ValueError, match="truncated"):
+        PondSnapshot.open(path)
+
+
+def test_deep_trees_round_trip():
+    melody = PondMelody([PondMelody(), PondNote(0, "4")])
+    for depth in range(20000):
+        melody = PondMelody([melody, PondNote(depth % 12, "8")] if depth % 1000 == 0 else [melody])
+    snapshot = PondSnapshot(PondSnapshot.dumps(melody))
+    assert str(snapshot.load()) == str(melody)
+    assert snapshot.root[0].kind == "melody"
+    assert str(snapshot.root[0].materialize()) == str(melody.fragments[0])